@@ -0,0 +1,147 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from api.dispatch import delete_on_commit
+from api.models import Event, EventVolunteer
+from api.urlTokens.token import URLToken
+
+
+class CalendarFeeds:
+    """
+    iCalendar feeds of the events a volunteer signed up for, or an organization runs.
+
+    Feeds are addressed by signed URLTokens so calendar clients can poll them without logging in. Every feed has a
+    version in the cache that is used as its ETag and replaced whenever the feed's events change, so answering a poll
+    with 304 Not Modified costs a single cache read. In production the cache is shared by all workers, so they agree on
+    the version and polls keep getting 304 whichever worker answers. Rendered feeds are cached under their version; a
+    feed that isn't cached is streamed from a database cursor and cached once fully rendered.
+    """
+    VOLUNTEER = 'volunteer'
+    ORGANIZATION = 'organization'
+    VERSION_KEY = 'calendar:version:%s:%d'
+    FEED_KEY = 'calendar:feed:%s:%d:%s'
+    TIMEOUT = 60 * 60 * 24
+    CHUNK_SIZE = 500
+
+    def get_token(self, kind, owner_id):
+        """
+        :param kind: VOLUNTEER or ORGANIZATION
+        :param owner_id: Id of the volunteer or organization
+        :return: Token code addressing the feed
+        """
+        return URLToken(data={"calendar": kind, "id": owner_id}, lifetime=settings.CALENDAR_FEED_LIFETIME).get_token()
+
+    def get_version(self, kind, owner_id):
+        """
+        :return: Current version of the feed, used as its ETag
+        """
+        key = self.VERSION_KEY % (kind, owner_id)
+        version = cache.get(key)
+        if version is None:
+            version = uuid.uuid4().hex
+            if not cache.add(key, version, self.TIMEOUT):
+                version = cache.get(key, version)
+        return version
+
+    def get_cached(self, kind, owner_id, version):
+        """
+        :return: The rendered feed at this version, or None if it isn't cached
+        """
+        return cache.get(self.FEED_KEY % (kind, owner_id, version))
+
+    def stream(self, kind, owner_id, version):
+        """
+        Renders the feed one event at a time from a database cursor and caches it once fully rendered
+        :return: Generator of iCalendar text chunks
+        """
+        parts = []
+        for part in self._render(kind, owner_id):
+            parts.append(part)
+            yield part
+        cache.set(self.FEED_KEY % (kind, owner_id, version), ''.join(parts), self.TIMEOUT)
+
+    def invalidate(self, kind, owner_ids):
+        """
+        Replaces the versions of the given feeds so their ETags and cached renderings no longer match. The versions are
+        replaced again once the current transaction commits, so a feed rendered before the commit isn't kept.
+        :param kind: VOLUNTEER or ORGANIZATION
+        :param owner_ids: Ids of the volunteers or organizations whose feed changed
+        """
+        delete_on_commit([self.VERSION_KEY % (kind, owner_id) for owner_id in owner_ids])
+
+    def event_changed(self, event):
+        """
+        Invalidates the feeds of the organization running the event and of every volunteer signed up for it
+        :param event: Event that was edited or is being deleted
+        """
+        self.invalidate(self.ORGANIZATION, [event.organization_id])
+        self.invalidate(self.VOLUNTEER, EventVolunteer.objects.filter(event_id=event.id)
+                        .values_list('volunteer_id', flat=True))
+
+    def organization_changed(self, organization_id):
+        """
+        Invalidates the feeds that show the organization's name: its own and those of the volunteers signed up for
+        its events
+        :param organization_id: Id of the organization that was renamed
+        """
+        self.invalidate(self.ORGANIZATION, [organization_id])
+        self.invalidate(self.VOLUNTEER, EventVolunteer.objects.filter(event__organization_id=organization_id)
+                        .values_list('volunteer_id', flat=True).distinct())
+
+    def _render(self, kind, owner_id):
+        if kind == self.VOLUNTEER:
+            events = Event.objects.filter(volunteers__id=owner_id)
+        else:
+            events = Event.objects.filter(organization_id=owner_id)
+        rows = events.order_by('start_time', 'id') \
+            .values_list('id', 'title', 'location', 'description', 'start_time', 'end_time', 'organization__name') \
+            .iterator(chunk_size=self.CHUNK_SIZE)
+
+        stamp = _format_time(timezone.now())
+        yield _lines(['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Voluntyr//Events//EN', 'CALSCALE:GREGORIAN',
+                      'METHOD:PUBLISH', 'X-WR-CALNAME:Voluntyr'])
+        for event_id, title, location, description, start_time, end_time, organization in rows:
+            yield _lines([
+                'BEGIN:VEVENT',
+                'UID:event-%d@voluntyr' % event_id,
+                'DTSTAMP:' + stamp,
+                'DTSTART:' + _format_time(start_time),
+                'DTEND:' + _format_time(end_time),
+                'SUMMARY:' + _escape(title),
+                'LOCATION:' + _escape(location),
+                'DESCRIPTION:' + _escape('%s\nOrganized by %s' % (description, organization)),
+                'URL:%s/Event/%d' % (settings.FRONTEND_HOST, event_id),
+                'END:VEVENT',
+            ])
+        yield _lines(['END:VCALENDAR'])
+
+
+calendar_feeds = CalendarFeeds()
+
+
+def _format_time(value):
+    return value.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def _escape(text):
+    return str(text).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n') \
+        .replace('\n', '\\n')
+
+
+def _lines(lines):
+    return ''.join(_fold(line) + '\r\n' for line in lines)
+
+
+def _fold(line):
+    """
+    Folds a content line into chunks of at most 75 characters, each continuation starting with a space (RFC 5545 3.1)
+    """
+    if len(line) <= 75:
+        return line
+    chunks = [line[:75]]
+    for start in range(75, len(line), 74):
+        chunks.append(' ' + line[start:start + 74])
+    return '\r\n'.join(chunks)
@@ -0,0 +1,138 @@
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredDispatcher:
+    """
+    Runs selected signal receivers after the current transaction commits, on a bounded pool of worker threads, so the
+    request that sent the signal doesn't wait on slow side effects such as sending email.
+
+    Receivers opt in with the deferred decorator, placed below @receiver. Every run is timed per receiver; see
+    get_metrics. In synchronous mode receivers run inline as soon as the signal is sent and their exceptions propagate,
+    which is what tests want. Unless synchronous is given, the mode is read from DEFERRED_DISPATCH['SYNCHRONOUS'] on
+    every submit, so tests can switch it with override_settings.
+    """
+
+    def __init__(self, max_workers, synchronous=None):
+        self.max_workers = max_workers
+        self.synchronous = synchronous
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._metrics = {}
+
+    def deferred(self, func):
+        """
+        Decorator for signal receivers that should run through this dispatcher
+        :param func: Receiver function
+        :return: Receiver that submits func instead of running it
+        """
+        name = '%s.%s' % (func.__module__, func.__name__)
+
+        @functools.wraps(func)
+        def deferred_receiver(sender, **kwargs):
+            self.submit(name, func, sender, **kwargs)
+        return deferred_receiver
+
+    def submit(self, name, func, *args, **kwargs):
+        """
+        Runs func after the current transaction commits, or straight away if there is no transaction
+        :param name: Name the run is recorded under in the metrics
+        :param func: Function to run
+        """
+        synchronous = self.synchronous
+        if synchronous is None:
+            synchronous = settings.DEFERRED_DISPATCH['SYNCHRONOUS']
+        if synchronous:
+            self._run(name, func, args, kwargs, reraise=True)
+        else:
+            transaction.on_commit(lambda: self._start(name, func, args, kwargs))
+
+    def flush(self, timeout=None):
+        """
+        Waits for every submitted function to finish
+        :param timeout: Maximum number of seconds to wait, None to wait forever
+        """
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending, timeout)
+
+    def get_metrics(self):
+        """
+        :return: Dictionary mapping receiver names to their number of calls and errors, and their total, average and
+                 maximum run time in seconds
+        """
+        with self._lock:
+            metrics = {name: dict(values) for name, values in self._metrics.items()}
+        for values in metrics.values():
+            values['average_seconds'] = values['total_seconds'] / values['calls']
+        return metrics
+
+    def reset_metrics(self):
+        with self._lock:
+            self._metrics = {}
+
+    def _start(self, name, func, args, kwargs):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='dispatch')
+            future = self._executor.submit(self._run_in_thread, name, func, args, kwargs)
+            self._pending.add(future)
+        future.add_done_callback(self._finished)
+
+    def _finished(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _run_in_thread(self, name, func, args, kwargs):
+        try:
+            self._run(name, func, args, kwargs, reraise=False)
+        finally:
+            # Worker threads are long lived, so don't leave their database connections open between runs
+            connection.close()
+
+    def _run(self, name, func, args, kwargs, reraise):
+        failed = False
+        start = time.perf_counter()
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            failed = True
+            if reraise:
+                raise
+            logger.exception('Deferred receiver %s failed', name)
+        finally:
+            self._record(name, time.perf_counter() - start, failed)
+
+    def _record(self, name, elapsed, failed):
+        with self._lock:
+            values = self._metrics.setdefault(name, {'calls': 0, 'errors': 0, 'total_seconds': 0.0,
+                                                     'max_seconds': 0.0})
+            values['calls'] += 1
+            values['errors'] += int(failed)
+            values['total_seconds'] += elapsed
+            values['max_seconds'] = max(values['max_seconds'], elapsed)
+
+
+dispatcher = DeferredDispatcher(max_workers=settings.DEFERRED_DISPATCH['MAX_WORKERS'])
+
+
+def delete_on_commit(keys):
+    """
+    Drops cache keys now and, inside a transaction, again once it commits. Another request can read the rows before
+    the commit and cache them in between, which the second delete drops.
+    :param keys: Cache keys
+    """
+    keys = list(keys)
+    cache.delete_many(keys)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,123 @@
+from collections import namedtuple
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api.models import Event, EventSeries
+from api.registration import promote_waitlist
+from api.signals import signal_events_bulk_created, signal_event_updated
+
+BATCH_SIZE = 500
+EDITABLE_FIELDS = ['title', 'location', 'description', 'start_time', 'end_time', 'date', 'capacity']
+
+# old and new value of one edited event field
+FieldChange = namedtuple('FieldChange', ['old', 'new'])
+
+
+class EventUpdateError(ValueError):
+    pass
+
+
+def is_valid_capacity(value):
+    """
+    Checks a capacity given in a request body
+    :param value: Decoded JSON value
+    :return: True if the value is a positive integer or None for no limit
+    """
+    return value is None or (isinstance(value, int) and not isinstance(value, bool) and value >= 1)
+
+
+def bulk_create_events(organization_id, events, batch_size=BATCH_SIZE):
+    """
+    Inserts many events of one organization with bulk_create and sends signal_events_bulk_created once for all of
+    them, in the same transaction. bulk_create doesn't send post_save, so the signal's receivers take over the work
+    done per event on post_save, such as creating chat rooms.
+    :param organization_id: Id of the organization running the events
+    :param events: List of unsaved Event objects
+    :param batch_size: Number of rows per INSERT
+    :return: List of the new events' ids
+    """
+    if not events:
+        return []
+    with transaction.atomic():
+        created = Event.objects.bulk_create(events, batch_size=batch_size)
+        if connection.features.can_return_ids_from_bulk_insert:
+            event_ids = [event.id for event in created]
+        else:
+            # The transaction holds the database's write lock, so the newest rows are the ones just inserted
+            event_ids = sorted(Event.objects.order_by('-id').values_list('id', flat=True)[:len(events)])
+        signal_events_bulk_created.send(Event, organization_id=organization_id, event_ids=event_ids)
+    return event_ids
+
+
+def create_series(series):
+    """
+    Saves an event series and creates all of its events in bulk
+    :param series: Unsaved EventSeries
+    :return: List of the ids of the series' events
+    """
+    with transaction.atomic():
+        series.save()
+        events = [Event(start_time=start_time, end_time=end_time, date=start_time.date(), title=series.title,
+                        location=series.location, description=series.description, capacity=series.capacity,
+                        organization_id=series.organization_id, series=series)
+                  for start_time, end_time in series.get_occurrences()]
+        return bulk_create_events(series.organization_id, events)
+
+
+def update_event(organization_id, event_id, values):
+    """
+    Applies a partial edit to an event. Only the editable columns are loaded, the given values are cleaned with the
+    model's fields and compared to the stored ones, and only the columns that actually changed are written. If any
+    did, signal_event_updated is sent with the diff once the edit is committed, so its receivers don't run while the
+    event's row is locked. Raising the capacity hands the new seats to the waitlist.
+    :param organization_id: Id of the organization running the event
+    :param event_id: Id of the event
+    :param values: Dictionary of new values by field name, e.g. a request body. An "id" key is ignored.
+    :return: Dictionary of FieldChange by field name; empty if nothing changed
+    :raises Event.DoesNotExist: If the organization has no event with this id
+    :raises EventUpdateError: If a field isn't editable or a value is invalid
+    """
+    unknown = sorted(key for key in values if key != 'id' and key not in EDITABLE_FIELDS)
+    if unknown:
+        raise EventUpdateError("Fields can't be edited: " + ', '.join(unknown))
+
+    with transaction.atomic():
+        event = Event.objects.select_for_update(of=('self',)).select_related('organization') \
+            .only('organization__name', 'seats_taken', *EDITABLE_FIELDS) \
+            .get(id=event_id, organization_id=organization_id)
+        changes = {}
+        for name in EDITABLE_FIELDS:
+            if name not in values:
+                continue
+            new = _clean(name, values[name])
+            old = getattr(event, name)
+            if new != old:
+                changes[name] = FieldChange(old, new)
+                setattr(event, name, new)
+
+        if not changes:
+            return changes
+        if event.end_time < event.start_time:
+            raise EventUpdateError("Events can't end before they start")
+        if event.capacity is not None and event.capacity < event.seats_taken:
+            raise EventUpdateError("capacity: %d volunteers are already registered" % event.seats_taken)
+        event.save(update_fields=list(changes))
+
+    signal_event_updated.send(Event, event=event, changes=changes)
+    if 'capacity' in changes:
+        promote_waitlist(event.id)
+    return changes
+
+
+def _clean(name, value):
+    try:
+        value = Event._meta.get_field(name).clean(value, None)
+    except ValidationError as e:
+        raise EventUpdateError('%s: %s' % (name, ' '.join(e.messages)))
+    if name == 'capacity' and value == 0:
+        raise EventUpdateError('capacity: Ensure this value is greater than or equal to 1.')
+    if name in ('start_time', 'end_time') and timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
@@ -0,0 +1,124 @@
+import codecs
+import csv
+
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from api.events import bulk_create_events, is_valid_capacity
+from api.models import Event
+
+REQUIRED_COLUMNS = ['title', 'location', 'description', 'start_time', 'end_time']
+OPTIONAL_COLUMNS = ['capacity']
+CHUNK_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+
+
+class EventImportError(ValueError):
+    pass
+
+
+def import_events(organization_id, lines, chunk_size=CHUNK_SIZE):
+    """
+    Imports events from CSV text. Rows are read one at a time and valid rows are written with bulk_create in chunks,
+    each chunk in its own transaction, so memory use doesn't grow with the size of the file.
+
+    The CSV needs a header row with the columns title, location, description, start_time and end_time, and may have
+    a capacity column. Times are ISO 8601; times without an offset are in the server's time zone.
+    :param organization_id: Id of the organization the events are for
+    :param lines: Iterable of the CSV's lines, e.g. a file opened in text mode
+    :param chunk_size: Number of events written per transaction
+    :return: Dictionary with the number of events created, the number of rows that failed and the errors of up to
+             MAX_REPORTED_ERRORS failed rows, each as {"row": <line number>, "errors": {<column>: <message>}}
+    :raises EventImportError: If the header is missing required columns or can't be read
+    """
+    reader = csv.DictReader(lines)
+    try:
+        fieldnames = reader.fieldnames or []
+    except csv.Error as e:
+        raise EventImportError('CSV header is invalid: %s' % e)
+    missing = [column for column in REQUIRED_COLUMNS if column not in fieldnames]
+    if missing:
+        raise EventImportError('CSV is missing columns: ' + ', '.join(missing))
+
+    report = {"created": 0, "failed": 0, "errors": []}
+    chunk = []
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            break
+        except csv.Error as e:
+            # The reader has consumed the malformed row and continues with the next one
+            event, errors = None, {"row": str(e)}
+        else:
+            event, errors = _parse_row(organization_id, row)
+        if errors:
+            report['failed'] += 1
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append({"row": reader.line_num, "errors": errors})
+            continue
+        chunk.append(event)
+        if len(chunk) >= chunk_size:
+            report['created'] += len(bulk_create_events(organization_id, chunk, batch_size=chunk_size))
+            chunk = []
+    report['created'] += len(bulk_create_events(organization_id, chunk, batch_size=chunk_size))
+    return report
+
+
+def is_utf8(upload):
+    """
+    Decodes an uploaded file chunk by chunk, without keeping it in memory, and rewinds it. import_events commits each
+    chunk as it goes, so the encoding has to be checked before importing rather than fail halfway through.
+    :param upload: UploadedFile
+    :return: True if the whole file is valid UTF-8
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in upload.chunks():
+            decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    finally:
+        upload.seek(0)
+    return True
+
+
+def _parse_row(organization_id, row):
+    """
+    :return: Tuple of the unsaved Event and a dictionary of errors by column; the event is None if there are errors
+    """
+    values = {}
+    errors = {}
+    for column in ['title', 'location', 'description', 'capacity']:
+        raw = (row.get(column) or '').strip()
+        if column == 'capacity' and not raw:
+            raw = None
+        try:
+            values[column] = Event._meta.get_field(column).clean(raw, None)
+        except ValidationError as e:
+            errors[column] = ' '.join(e.messages)
+    if 'capacity' in values and not is_valid_capacity(values['capacity']):
+        errors['capacity'] = 'Ensure this value is greater than or equal to 1.'
+    for column in ['start_time', 'end_time']:
+        try:
+            values[column] = _parse_time(row.get(column))
+        except ValueError:
+            errors[column] = 'Enter a valid ISO 8601 date/time.'
+
+    if not errors and values['end_time'] < values['start_time']:
+        errors['end_time'] = "Events can't end before they start."
+    if errors:
+        return None, errors
+    return Event(date=timezone.localtime(values['start_time']).date(), organization_id=organization_id,
+                 **values), None
+
+
+def _parse_time(value):
+    parsed = parse_datetime((value or '').strip())
+    if parsed is None:
+        raise ValueError('Invalid date time')
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
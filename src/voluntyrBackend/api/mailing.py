@@ -0,0 +1,81 @@
+import itertools
+
+from django.conf import settings
+from django.core.mail import get_connection, send_mass_mail
+
+from api.models import Volunteer
+
+RECIPIENT_CHUNK_SIZE = 500
+
+
+def iter_volunteer_emails(event_id, chunk_size=RECIPIENT_CHUNK_SIZE):
+    """
+    Streams the email addresses of the volunteers registered for an event. The addresses are read with a single
+    values_list join across the event's roster and the volunteers' EndUsers, so no model instances are built.
+    :param event_id: Id of the event
+    :param chunk_size: Number of rows fetched from the database cursor at a time
+    :return: Iterator of email addresses
+    """
+    return Volunteer.objects.filter(event__id=event_id) \
+        .values_list('end_user__email', flat=True) \
+        .iterator(chunk_size=chunk_size)
+
+
+def iter_chunks(iterable, chunk_size=RECIPIENT_CHUNK_SIZE):
+    """
+    Groups an iterable into lists of at most chunk_size items
+    :param iterable: Iterable to group
+    :param chunk_size: Maximum length of each chunk
+    :return: Generator of lists
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def make_emails(to_emails, from_email, subject, message):
+    """
+    Builds the datatuples for send_mass_mail, one per recipient
+    :param to_emails: Iterable of volunteer emails
+    :param from_email: From email address
+    :param subject: Subject of the emails
+    :param message: Message of the emails
+    :return: Generator of the emails to send
+    """
+    return ((subject, message, from_email, [email]) for email in to_emails)
+
+
+def send_event_mass_mail(event_id, subject, message, from_email=None, chunk_size=RECIPIENT_CHUNK_SIZE):
+    """
+    Sends the same email to every volunteer registered for an event. Recipients are streamed from the database and
+    handed to the mailer chunk_size at a time over a single connection, so memory use does not grow with the roster.
+    :param event_id: Id of the event
+    :param subject: Subject of the emails
+    :param message: Message of the emails
+    :param from_email: From email address, default is settings.DEFAULT_FROM_EMAIL
+    :param chunk_size: Number of recipients per chunk
+    :return: Number of emails sent
+    """
+    if from_email is None:
+        from_email = settings.DEFAULT_FROM_EMAIL
+
+    chunks = iter_chunks(iter_volunteer_emails(event_id, chunk_size), chunk_size)
+    first = next(chunks, None)
+    # Like send_mass_mail, don't connect to the mail server when there is nobody to email
+    if first is None:
+        return 0
+
+    sent = 0
+    connection = get_connection()
+    connection.open()
+    try:
+        for recipients in itertools.chain([first], chunks):
+            sent += send_mass_mail(make_emails(recipients, from_email, subject, message), connection=connection)
+    finally:
+        connection.close()
+    return sent
@@ -0,0 +1,94 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from api import registration
+from api.dispatch import dispatcher
+from api.models import EndUser, Event, Organization, Volunteer, WaitlistEntry
+from chat.models import Membership, Room
+
+
+class Command(BaseCommand):
+    help = 'Registers many volunteers for one capacity-limited event concurrently and checks the event is never ' \
+           'oversubscribed. Creates its own throwaway organization, event and volunteers and deletes them afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--volunteers', type=int, default=200, help='Number of concurrent signups')
+        parser.add_argument('--capacity', type=int, default=50, help='Capacity of the event')
+        parser.add_argument('--threads', type=int, default=16, help='Number of worker threads')
+
+    def handle(self, *args, **options):
+        tag = uuid.uuid4().hex[:12]
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            event, volunteers = self._create_fixtures(tag, options['capacity'], options['volunteers'])
+            try:
+                outcomes, elapsed = self._run(event.id, volunteers, options['threads'])
+                self._report(event, outcomes, elapsed, options['capacity'])
+            finally:
+                self._delete_fixtures(tag, event)
+
+    def _run(self, event_id, volunteers, threads):
+        def signup(volunteer):
+            try:
+                # SQLite reports lock contention as an error instead of waiting on row locks; retry like a client would
+                for attempt in range(50):
+                    try:
+                        return registration.register(event_id, volunteer)
+                    except OperationalError:
+                        time.sleep(0.01 * (attempt + 1))
+                raise CommandError('Signup for %s kept failing on database locks' % volunteer)
+            finally:
+                connection.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            outcomes = list(executor.map(signup, volunteers))
+        elapsed = time.perf_counter() - start
+        dispatcher.flush()
+        return outcomes, elapsed
+
+    def _report(self, event, outcomes, elapsed, capacity):
+        event.refresh_from_db()
+        roster = event.volunteers.count()
+        waitlist = WaitlistEntry.objects.filter(event=event).count()
+        registered = outcomes.count(registration.REGISTERED)
+        waitlisted = outcomes.count(registration.WAITLISTED)
+
+        self.stdout.write('%d signups in %.2fs (%.0f signups/s)' % (len(outcomes), elapsed, len(outcomes) / elapsed))
+        self.stdout.write('capacity=%d seats_taken=%d roster=%d waitlist=%d registered=%d waitlisted=%d'
+                          % (capacity, event.seats_taken, roster, waitlist, registered, waitlisted))
+
+        expected_roster = min(capacity, len(outcomes))
+        if roster > capacity or event.seats_taken != roster or registered != roster or waitlisted != waitlist \
+                or roster != expected_roster:
+            raise CommandError('Event was oversubscribed or its seat count drifted')
+        for name, metrics in sorted(dispatcher.get_metrics().items()):
+            self.stdout.write('%s: %d calls, %d errors, %.1fms average, %.1fms max'
+                              % (name, metrics['calls'], metrics['errors'], metrics['average_seconds'] * 1000,
+                                 metrics['max_seconds'] * 1000))
+        self.stdout.write(self.style.SUCCESS('No oversubscription'))
+
+    def _create_fixtures(self, tag, capacity, count):
+        org_user = EndUser.objects.create_user('benchmark-%s-org@voluntyr.invalid' % tag, uuid.uuid4().hex, 'bench')
+        organization = Organization.objects.create(end_user=org_user, name='Benchmark %s' % tag,
+                                                   street_address='-', city='-', state='-', phone_number='-')
+        start = timezone.now()
+        event = Event.objects.create(start_time=start, end_time=start, date=start.date(), title='Benchmark %s' % tag,
+                                     location='-', description='-', capacity=capacity, organization=organization)
+        volunteers = []
+        for i in range(count):
+            end_user = EndUser.objects.create(email='benchmark-%s-%d@voluntyr.invalid' % (tag, i), authy_id='bench')
+            volunteers.append(Volunteer.objects.create(end_user=end_user, first_name='Benchmark', last_name=str(i),
+                                                       phone_number='-'))
+        return event, volunteers
+
+    def _delete_fixtures(self, tag, event):
+        Membership.objects.filter(room__event=event).delete()
+        Room.objects.filter(event=event).delete()
+        event.delete()
+        EndUser.objects.filter(email__startswith='benchmark-%s-' % tag).delete()
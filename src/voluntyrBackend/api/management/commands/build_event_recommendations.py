@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from api.recommendations import build_event_recommendations
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the per-volunteer "events you may like" lists from event co-attendance. Run periodically.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=10, help='Number of events kept per volunteer')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows written per bulk insert')
+
+    def handle(self, *args, **options):
+        written = build_event_recommendations(top_k=options['top'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Stored %d event recommendations' % written))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.imports import import_events, EventImportError, CHUNK_SIZE
+from api.models import Organization
+
+
+class Command(BaseCommand):
+    help = 'Imports events for an organization from a CSV file with title, location, description, start_time, ' \
+           'end_time and optional capacity columns. Prints the rows that failed validation.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('organization_id', type=int, help='Id of the organization the events are for')
+        parser.add_argument('path', help='Path of the CSV file')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Events written per transaction')
+
+    def handle(self, *args, **options):
+        if not Organization.objects.filter(id=options['organization_id']).exists():
+            raise CommandError('Organization %d does not exist' % options['organization_id'])
+        try:
+            with open(options['path'], newline='', encoding='utf-8-sig') as csv_file:
+                report = import_events(options['organization_id'], csv_file, chunk_size=options['chunk_size'])
+        except (OSError, EventImportError) as e:
+            raise CommandError(str(e))
+
+        for failure in report['errors']:
+            errors = '; '.join('%s: %s' % (column, message) for column, message in sorted(failure['errors'].items()))
+            self.stderr.write('Row %d: %s' % (failure['row'], errors))
+        if report['failed'] > len(report['errors']):
+            self.stderr.write('... and %d more failed rows' % (report['failed'] - len(report['errors'])))
+        self.stdout.write(self.style.SUCCESS('Imported %d events, %d rows failed' % (report['created'],
+                                                                                    report['failed'])))
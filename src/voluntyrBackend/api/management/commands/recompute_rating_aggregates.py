@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from api.ratings import recompute_rating_aggregates
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the per-event and per-organization rating aggregates and averages from the submitted ratings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows written per bulk insert')
+
+    def handle(self, *args, **options):
+        events, organizations = recompute_rating_aggregates(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Rebuilt rating aggregates for %d events and %d organizations'
+                                             % (events, organizations)))
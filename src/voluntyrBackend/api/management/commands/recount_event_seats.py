@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from api.registration import recount_seats
+
+
+class Command(BaseCommand):
+    help = 'Sets the seats_taken counter of every event to its number of registered volunteers. Run it once after ' \
+           'deploying the counter, since registrations that already exist were never counted; safe to run again.'
+
+    def handle(self, *args, **options):
+        events = recount_seats()
+        self.stdout.write(self.style.SUCCESS('Recounted the seats of %d events' % events))
@@ -1,6 +1,7 @@
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 from django.db import models
 from django.utils import timezone
+import calendar
 import datetime
 from .managers import EndUserManager
 import pytz
@@ -69,17 +70,178 @@ class Event(models.Model):
     location = models.CharField(max_length=200)
     description = models.CharField(max_length=200)
     organization = models.ForeignKey('Organization', on_delete=models.PROTECT)
-    volunteers = models.ManyToManyField(Volunteer, blank=True)
+    volunteers = models.ManyToManyField(Volunteer, blank=True, through='EventVolunteer')
+    capacity = models.PositiveIntegerField(null=True, blank=True)
+    seats_taken = models.PositiveIntegerField(default=0)
+    series = models.ForeignKey('EventSeries', on_delete=models.SET_NULL, null=True, blank=True,
+                               related_name='events')
 
     class Meta:
         ordering = ['date', 'start_time']
+        indexes = [models.Index(fields=['organization', '-start_time', '-id'])]
 
     def __str__(self):
         return '%s by %s' % (self.title, self.organization)
 
 
+class EventSeries(models.Model):
+    """
+    A recurring event. The first occurrence is given by start_time and end_time; later ones repeat every interval
+    days, weeks or months, at the same local time, until count occurrences exist or until is passed.
+    """
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    MONTHLY = 'monthly'
+    FREQUENCY_CHOICES = [
+        (DAILY, 'Daily'),
+        (WEEKLY, 'Weekly'),
+        (MONTHLY, 'Monthly')
+    ]
+    MAX_OCCURRENCES = 366
+    MAX_INTERVAL = 366
+
+    organization = models.ForeignKey('Organization', on_delete=models.PROTECT)
+    title = models.CharField(max_length=100)
+    location = models.CharField(max_length=200)
+    description = models.CharField(max_length=200)
+    capacity = models.PositiveIntegerField(null=True, blank=True)
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    frequency = models.CharField(choices=FREQUENCY_CHOICES, max_length=10)
+    interval = models.PositiveIntegerField(default=1)
+    count = models.PositiveIntegerField(null=True, blank=True)
+    until = models.DateTimeField(null=True, blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def get_occurrences(self):
+        """
+        Expands the recurrence rule, stopping after MAX_OCCURRENCES occurrences
+        :return: List of (start_time, end_time) tuples in order
+        """
+        tz = timezone.get_current_timezone()
+        # Step in local wall time so occurrences keep their time of day across DST changes
+        start = timezone.localtime(self.start_time, tz).replace(tzinfo=None)
+        duration = self.end_time - self.start_time
+
+        occurrences = []
+        while len(occurrences) < (self.count or self.MAX_OCCURRENCES):
+            local_start = self._shift(start, len(occurrences))
+            occurrence = timezone.make_aware(local_start, tz, is_dst=False)
+            if self.until is not None and occurrence > self.until:
+                break
+            occurrences.append((occurrence, occurrence + duration))
+        return occurrences
+
+    def exceeds_max_occurrences(self):
+        """
+        Checks whether the recurrence rule has more occurrences than get_occurrences would expand
+        :return: True if count, or until without a count, allows more than MAX_OCCURRENCES occurrences
+        """
+        if self.count is not None:
+            return self.count > self.MAX_OCCURRENCES
+        tz = timezone.get_current_timezone()
+        start = timezone.localtime(self.start_time, tz).replace(tzinfo=None)
+        following = timezone.make_aware(self._shift(start, self.MAX_OCCURRENCES), tz, is_dst=False)
+        return following <= self.until
+
+    def _shift(self, start, index):
+        steps = index * self.interval
+        if self.frequency == self.DAILY:
+            return start + datetime.timedelta(days=steps)
+        if self.frequency == self.WEEKLY:
+            return start + datetime.timedelta(weeks=steps)
+        month = start.month - 1 + steps
+        year = start.year + month // 12
+        month = month % 12 + 1
+        return start.replace(year=year, month=month, day=min(start.day, calendar.monthrange(year, month)[1]))
+
+
+class EventVolunteer(models.Model):
+    """
+    A volunteer's registration for an event. Keeps the table of the original auto-created many-to-many relation and
+    adds when the volunteer signed up.
+    """
+    event = models.ForeignKey(Event, on_delete=models.CASCADE)
+    volunteer = models.ForeignKey(Volunteer, on_delete=models.CASCADE)
+    date_registered = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'api_event_volunteers'
+        unique_together = [['event', 'volunteer']]
+        indexes = [models.Index(fields=['event', 'date_registered', 'id'])]
+
+
+class WaitlistEntry(models.Model):
+    """
+    A volunteer waiting for a seat at a full event. Entries are promoted to registrations in the order they joined.
+    """
+    event = models.ForeignKey(Event, on_delete=models.CASCADE)
+    volunteer = models.ForeignKey(Volunteer, on_delete=models.CASCADE)
+    date_joined = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['date_joined', 'id']
+        constraints = [models.UniqueConstraint(fields=['event', 'volunteer'], name='unique_event_volunteer_waitlist')]
+
+
 class Rating(models.Model):
     event = models.ForeignKey(Event, on_delete=models.PROTECT)
     volunteer = models.ForeignKey(Volunteer, on_delete=models.PROTECT)
     rating = models.IntegerField()
     rating_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['event', 'volunteer'], name='unique_event_volunteer_rating')]
+
+
+class EventRecommendation(models.Model):
+    """
+    Precomputed collaborative filtering score of an upcoming event for a volunteer, rebuilt in batch by the
+    build_event_recommendations management command.
+    """
+    volunteer = models.ForeignKey(Volunteer, on_delete=models.CASCADE)
+    event = models.ForeignKey(Event, on_delete=models.CASCADE)
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ['volunteer', '-score']
+        indexes = [models.Index(fields=['volunteer', '-score'])]
+
+
+class RatingAggregate(models.Model):
+    """
+    Running count, sum and 1-5 star histogram of ratings, maintained as ratings are submitted and rebuilt by the
+    recompute_rating_aggregates management command.
+    """
+    STARS = range(1, 6)
+
+    count = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    stars_1 = models.IntegerField(default=0)
+    stars_2 = models.IntegerField(default=0)
+    stars_3 = models.IntegerField(default=0)
+    stars_4 = models.IntegerField(default=0)
+    stars_5 = models.IntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+    def get_average(self):
+        if self.count == 0:
+            return 0
+        return round(self.total / self.count, 2)
+
+    def get_histogram(self):
+        return {str(star): getattr(self, 'stars_%d' % star) for star in self.STARS}
+
+    def get_summary(self):
+        return {"average": self.get_average(), "count": self.count, "histogram": self.get_histogram()}
+
+
+class EventRatingAggregate(RatingAggregate):
+    event = models.OneToOneField(Event, on_delete=models.CASCADE, primary_key=True, related_name='rating_aggregate')
+
+
+class OrganizationRatingAggregate(RatingAggregate):
+    organization = models.OneToOneField(Organization, on_delete=models.CASCADE, primary_key=True,
+                                        related_name='rating_aggregate')
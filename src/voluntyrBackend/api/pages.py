@@ -0,0 +1,83 @@
+from django.core.cache import cache
+from django.utils import timezone
+
+from api.dispatch import delete_on_commit
+from api.models import Event, Organization, OrganizationRatingAggregate
+from api.serializers import EventsSerializer, VolunteerOrganizationSerializer
+
+
+class OrganizationPageCache:
+    """
+    Cached fragments of the organization page volunteers see.
+
+    The page is cached as two fragments so each is only rebuilt when its own data changes:
+        - Header: the serialized organization and its rating summary. Dropped when the organization, its end user or
+          its ratings change.
+        - Events: the serialized upcoming events. Dropped when one of the organization's events is saved or deleted,
+          and set to expire when the next of them starts, so started events drop out without a write.
+
+    Fragments are only dropped, never updated in place, so this relies on the cache being shared by all workers, as the
+    Redis cache is in production; with a per-process cache the other workers would keep serving a stale fragment. They
+    are dropped again when the transaction that changed them commits, so a page read before the commit isn't kept.
+    """
+    HEADER_KEY = 'organization-page:header:%d'
+    EVENTS_KEY = 'organization-page:events:%d'
+    HEADER_TIMEOUT = 60 * 60 * 24
+    EVENTS_TIMEOUT = 60 * 60 * 24
+
+    def get_header(self, organization_id):
+        """
+        :param organization_id: Id of the organization
+        :return: Dictionary with the organization's details under "organization" and its rating summary under
+                 "ratings", or None if the organization doesn't exist
+        """
+        key = self.HEADER_KEY % organization_id
+        header = cache.get(key)
+        if header is None:
+            try:
+                organization = Organization.objects.select_related('end_user', 'rating_aggregate') \
+                    .get(id=organization_id)
+            except Organization.DoesNotExist:
+                return None
+            try:
+                ratings = organization.rating_aggregate.get_summary()
+            except OrganizationRatingAggregate.DoesNotExist:
+                ratings = OrganizationRatingAggregate(organization=organization).get_summary()
+            header = {'organization': VolunteerOrganizationSerializer(organization).data, 'ratings': ratings}
+            cache.set(key, header, self.HEADER_TIMEOUT)
+        return header
+
+    def get_events(self, organization_id):
+        """
+        :param organization_id: Id of the organization
+        :return: List of the organization's serialized upcoming events
+        """
+        key = self.EVENTS_KEY % organization_id
+        events = cache.get(key)
+        if events is None:
+            now = timezone.now()
+            upcoming = list(Event.objects.filter(organization_id=organization_id, start_time__gte=now))
+            events = EventsSerializer(upcoming, many=True).data
+            timeout = self.EVENTS_TIMEOUT
+            if upcoming:
+                next_start = min(event.start_time for event in upcoming)
+                timeout = min(timeout, max(1, int((next_start - now).total_seconds())))
+            cache.set(key, events, timeout)
+        return events
+
+    def organizations_changed(self, organization_ids):
+        """
+        Drops the cached headers of the given organizations
+        :param organization_ids: Ids of the organizations whose details or ratings changed
+        """
+        delete_on_commit([self.HEADER_KEY % organization_id for organization_id in organization_ids])
+
+    def events_changed(self, organization_id):
+        """
+        Drops the cached upcoming events of an organization
+        :param organization_id: Id of the organization whose events changed
+        """
+        delete_on_commit([self.EVENTS_KEY % organization_id])
+
+
+organization_pages = OrganizationPageCache()
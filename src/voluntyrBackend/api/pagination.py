@@ -0,0 +1,96 @@
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class KeysetPaginator:
+    """
+    Keyset (seek) pagination over a (timestamp, id) ordering.
+
+    Pages are selected with a WHERE clause on the last row of the previous page instead of an OFFSET, so with an index
+    on the same columns every page costs the same no matter how deep it is. Cursors are opaque url safe strings
+    encoding that last row's timestamp and id.
+    """
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 200
+
+    def __init__(self, time_field, id_field='id', descending=False):
+        """
+        :param time_field: Name of the timestamp field to order by
+        :param id_field: Name of the unique field breaking timestamp ties
+        :param descending: True to page from the newest rows to the oldest
+        """
+        self.time_field = time_field
+        self.id_field = id_field
+        self.descending = descending
+
+    def paginate(self, queryset, cursor=None, limit=None):
+        """
+        :param queryset: Queryset to page through. May be a values() queryset, as long as it includes both fields.
+        :param cursor: Cursor returned with the previous page, None for the first page
+        :param limit: Maximum number of rows on the page, defaults to DEFAULT_LIMIT and is capped at MAX_LIMIT
+        :return: Tuple of the page's rows and the cursor of the next page, None if this is the last page
+        :raises InvalidCursor: If the cursor or limit is malformed
+        """
+        limit = self.get_limit(limit)
+        prefix = '-' if self.descending else ''
+        queryset = queryset.order_by(prefix + self.time_field, prefix + self.id_field)
+        if cursor:
+            queryset = queryset.filter(self._after(*self.decode_cursor(cursor)))
+
+        rows = list(queryset[:limit + 1])
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, self.encode_cursor(self._value(rows[-1], self.time_field), self._value(rows[-1], self.id_field))
+
+    def get_limit(self, limit):
+        if limit is None or limit == '':
+            return self.DEFAULT_LIMIT
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            raise InvalidCursor('limit must be an integer')
+        if limit < 1:
+            raise InvalidCursor('limit must be positive')
+        return min(limit, self.MAX_LIMIT)
+
+    @staticmethod
+    def encode_cursor(timestamp, row_id):
+        raw = '%s|%s' % (timestamp.isoformat(), row_id)
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        :param cursor: Cursor made by encode_cursor
+        :return: Tuple of the timestamp and id it encodes
+        :raises InvalidCursor: If the cursor is malformed
+        """
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+            timestamp, row_id = raw.split('|')
+            timestamp = parse_datetime(timestamp)
+            row_id = int(row_id)
+        except (binascii.Error, UnicodeError, ValueError):
+            raise InvalidCursor('Malformed cursor')
+        if timestamp is None:
+            raise InvalidCursor('Malformed cursor')
+        return timestamp, row_id
+
+    def _after(self, timestamp, row_id):
+        lookup = 'lt' if self.descending else 'gt'
+        return Q(**{'%s__%s' % (self.time_field, lookup): timestamp}) | \
+            Q(**{self.time_field: timestamp, '%s__%s' % (self.id_field, lookup): row_id})
+
+    @staticmethod
+    def _value(row, field):
+        if isinstance(row, dict):
+            return row[field]
+        return getattr(row, field)
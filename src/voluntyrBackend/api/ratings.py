@@ -0,0 +1,75 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F, Func, ExpressionWrapper, FloatField, DecimalField, Count, Sum, Q
+from django.db.models.functions import Cast
+
+from api.models import Organization, Rating, RatingAggregate, EventRatingAggregate, OrganizationRatingAggregate
+from api.pages import organization_pages
+
+
+def record_rating(event, volunteer, rating):
+    """
+    Stores a rating and folds it into the organization's running average and the materialized event and
+    organization aggregates, all in one transaction. The unique (event, volunteer) constraint rejects duplicates, and
+    every aggregate is updated with F() expressions so concurrent ratings can't overwrite each other.
+    :param event: Event being rated
+    :param volunteer: Volunteer submitting the rating
+    :param rating: Rating between 1 and 5, inclusive
+    :return: True if the rating was stored, False if this volunteer already rated this event
+    """
+    new_rating = ExpressionWrapper((F('rating') * F('raters') + rating) / (F('raters') + 1),
+                                   output_field=FloatField())
+    try:
+        with transaction.atomic():
+            Rating.objects.create(event=event, volunteer=volunteer, rating=rating)
+            Organization.objects.filter(id=event.organization_id).update(
+                rating=Func(Cast(new_rating, DecimalField(max_digits=12, decimal_places=6)), 2,
+                            function='ROUND', output_field=FloatField()),
+                raters=F('raters') + 1)
+            _increment(EventRatingAggregate, {'event_id': event.id}, rating)
+            _increment(OrganizationRatingAggregate, {'organization_id': event.organization_id}, rating)
+    except IntegrityError:
+        return False
+    organization_pages.organizations_changed([event.organization_id])
+    return True
+
+
+def _increment(model, key, rating):
+    model.objects.get_or_create(**key)
+    star = 'stars_%d' % rating
+    model.objects.filter(**key).update(count=F('count') + 1, total=F('total') + rating, **{star: F(star) + 1})
+
+
+def _grouped_ratings(group_by):
+    """
+    :param group_by: Rating field to group by
+    :return: Values queryset with count, total and one column per star for each group, computed in a single query
+    """
+    annotations = {'count': Count('id'), 'total': Sum('rating')}
+    for star in RatingAggregate.STARS:
+        annotations['stars_%d' % star] = Count('id', filter=Q(rating=star))
+    return Rating.objects.values(group_by).annotate(**annotations).order_by()
+
+
+def recompute_rating_aggregates(batch_size=1000):
+    """
+    Rebuilds the event and organization rating aggregates from the Rating table with grouped SQL and resets each
+    organization's running average from them, correcting any drift.
+    :param batch_size: Number of rows written per bulk_create
+    :return: Tuple of the number of event and organization aggregates written
+    """
+    with transaction.atomic():
+        EventRatingAggregate.objects.all().delete()
+        events = [EventRatingAggregate(event_id=row.pop('event'), **row) for row in _grouped_ratings('event')]
+        EventRatingAggregate.objects.bulk_create(events, batch_size=batch_size)
+
+        OrganizationRatingAggregate.objects.all().delete()
+        organizations = [OrganizationRatingAggregate(organization_id=row.pop('event__organization'), **row)
+                         for row in _grouped_ratings('event__organization')]
+        OrganizationRatingAggregate.objects.bulk_create(organizations, batch_size=batch_size)
+
+        Organization.objects.filter(rating_aggregate__isnull=True).update(rating=0, raters=0)
+        for aggregate in organizations:
+            Organization.objects.filter(id=aggregate.organization_id) \
+                .update(rating=aggregate.get_average(), raters=aggregate.count)
+    organization_pages.organizations_changed(Organization.objects.values_list('id', flat=True))
+    return len(events), len(organizations)
@@ -0,0 +1,164 @@
+import heapq
+import math
+import time
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from api.dispatch import delete_on_commit
+from api.models import Event, EventRecommendation
+
+
+class EventRecommender:
+    """
+    Precomputed "you may also like" suggestions for volunteers.
+
+    Keeps two kinds of cached state:
+        - Candidate lists: the upcoming events, globally and per organization, as (event_id, organization_id, start)
+          tuples in start time order.
+        - Registered sets: the ids of the events each volunteer is registered for.
+
+    Suggesting events only reads that state and loads the chosen events, so it costs a constant number of queries
+    regardless of how many events or volunteers exist. Candidate lists are dropped whenever an event is saved or
+    deleted and rebuilt on next use; registered sets are dropped the same way on signal_volunteer_event_registration
+    and signal_volunteer_event_registration_batch.
+    """
+    GLOBAL_CANDIDATES_KEY = 'recommendations:candidates'
+    ORGANIZATION_CANDIDATES_KEY = 'recommendations:candidates:%d'
+    REGISTERED_KEY = 'recommendations:registered:%d'
+    CANDIDATES_TIMEOUT = 60 * 15
+    REGISTERED_TIMEOUT = 60 * 60 * 24
+
+    def suggest(self, volunteer_id, organization_id, limit=3):
+        """
+        Returns up to limit upcoming events the volunteer isn't registered for. Events run by organization_id are
+        suggested first, then the soonest upcoming events from any organization.
+        :param volunteer_id: Id of the volunteer
+        :param organization_id: Id of the organization to prefer
+        :param limit: Maximum number of events to return
+        :return: List of Event objects
+        """
+        now = time.time()
+        registered = self.get_registered(volunteer_id)
+
+        chosen = []
+        for event_id, org_id, start in self.get_candidates(organization_id):
+            if len(chosen) >= limit:
+                break
+            if start >= now and event_id not in registered:
+                chosen.append(event_id)
+        for event_id, org_id, start in self.get_candidates():
+            if len(chosen) >= limit:
+                break
+            if start >= now and event_id not in registered and event_id not in chosen:
+                chosen.append(event_id)
+
+        events = Event.objects.select_related('organization').in_bulk(chosen)
+        return [events[event_id] for event_id in chosen if event_id in events]
+
+    def get_candidates(self, organization_id=None):
+        """
+        :param organization_id: Id of an organization, or None for events from every organization
+        :return: List of (event_id, organization_id, start timestamp) tuples for the upcoming events
+        """
+        if organization_id is None:
+            key = self.GLOBAL_CANDIDATES_KEY
+        else:
+            key = self.ORGANIZATION_CANDIDATES_KEY % organization_id
+        candidates = cache.get(key)
+        if candidates is None:
+            rows = Event.objects.filter(start_time__gte=timezone.now())
+            if organization_id is not None:
+                rows = rows.filter(organization_id=organization_id)
+            rows = rows.values_list('id', 'organization_id', 'start_time')
+            candidates = [(event_id, org_id, start.timestamp()) for event_id, org_id, start in rows]
+            cache.set(key, candidates, self.CANDIDATES_TIMEOUT)
+        return candidates
+
+    def get_registered(self, volunteer_id):
+        """
+        :param volunteer_id: Id of the volunteer
+        :return: Set of the ids of the events this volunteer is registered for
+        """
+        key = self.REGISTERED_KEY % volunteer_id
+        registered = cache.get(key)
+        if registered is None:
+            registered = set(Event.volunteers.through.objects.filter(volunteer_id=volunteer_id)
+                             .values_list('event_id', flat=True))
+            cache.set(key, registered, self.REGISTERED_TIMEOUT)
+        return registered
+
+    def registrations_changed(self, volunteer_id):
+        """
+        Drops the volunteer's cached registered set so it is rebuilt from the database on next use. Concurrent
+        registrations can't lose each other's changes the way an in-place update of the shared cache would.
+        :param volunteer_id: Id of the volunteer whose registrations changed
+        """
+        delete_on_commit([self.REGISTERED_KEY % volunteer_id])
+
+    def events_changed(self, organization_id):
+        """
+        Drops the cached candidate lists affected by a change to an organization's events so they are rebuilt from
+        the database on next use
+        :param organization_id: Id of the organization whose events changed
+        """
+        cache.delete_many([self.GLOBAL_CANDIDATES_KEY, self.ORGANIZATION_CANDIDATES_KEY % organization_id])
+
+
+recommender = EventRecommender()
+
+
+def build_event_recommendations(top_k=10, batch_size=1000):
+    """
+    Rebuilds the EventRecommendation table from the volunteer x event co-attendance matrix.
+
+    The matrix is read once from the Event.volunteers through table and kept sparse, as the set of events each
+    volunteer attended. Each upcoming event is scored against the events a volunteer attended by cosine similarity of
+    their attendee sets, and the top_k unregistered upcoming events are stored for every volunteer.
+    :param top_k: Number of recommendations kept per volunteer
+    :param batch_size: Number of rows written per bulk_create
+    :return: Number of recommendations written
+    """
+    attended = defaultdict(set)
+    attendance = defaultdict(int)
+    rows = Event.volunteers.through.objects.values_list('volunteer_id', 'event_id').iterator(chunk_size=batch_size)
+    for volunteer_id, event_id in rows:
+        attended[volunteer_id].add(event_id)
+        attendance[event_id] += 1
+
+    upcoming = set(Event.objects.filter(start_time__gte=timezone.now()).values_list('id', flat=True))
+
+    # Co-attendance counts between every upcoming event and the other events its attendees joined
+    co_attendance = defaultdict(lambda: defaultdict(int))
+    for events in attended.values():
+        for candidate in events & upcoming:
+            for event_id in events:
+                if event_id != candidate:
+                    co_attendance[event_id][candidate] += 1
+
+    similar = {}
+    for event_id, counts in co_attendance.items():
+        similar[event_id] = [(candidate, count / math.sqrt(attendance[event_id] * attendance[candidate]))
+                             for candidate, count in counts.items()]
+
+    written = 0
+    with transaction.atomic():
+        EventRecommendation.objects.all().delete()
+        batch = []
+        for volunteer_id, events in attended.items():
+            scores = defaultdict(float)
+            for event_id in events:
+                for candidate, similarity in similar.get(event_id, ()):
+                    if candidate not in events:
+                        scores[candidate] += similarity
+            for candidate, score in heapq.nlargest(top_k, scores.items(), key=lambda item: item[1]):
+                batch.append(EventRecommendation(volunteer_id=volunteer_id, event_id=candidate, score=score))
+            if len(batch) >= batch_size:
+                EventRecommendation.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+        EventRecommendation.objects.bulk_create(batch)
+        written += len(batch)
+    return written
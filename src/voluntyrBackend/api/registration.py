@@ -0,0 +1,215 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from api.models import Event, Volunteer, WaitlistEntry
+from api.signals import signal_volunteer_event_registration, signal_volunteer_event_registration_batch
+
+REGISTERED = 'registered'
+WAITLISTED = 'waitlisted'
+WITHDRAWN = 'withdrawn'
+LEFT_WAITLIST = 'left_waitlist'
+MISSING = 'missing'
+
+Registration = Event.volunteers.through
+
+
+def register(event_id, volunteer):
+    """
+    Gives the volunteer a seat at the event, or a place on its waitlist if the event is full. Registering twice is a
+    no-op, so racing duplicate requests can't register the volunteer twice or take two seats.
+    :param event_id: Id of the event
+    :param volunteer: Volunteer registering
+    :return: REGISTERED or WAITLISTED
+    """
+    taken, created = _take_seat(event_id, volunteer.id)
+    if taken:
+        if created:
+            _send_registration(event_id, volunteer, True)
+        return REGISTERED
+
+    WaitlistEntry.objects.get_or_create(event_id=event_id, volunteer=volunteer)
+    # A seat may have been released between the failed reservation and joining the waitlist
+    promote_waitlist(event_id)
+    if Registration.objects.filter(event_id=event_id, volunteer_id=volunteer.id).exists():
+        return REGISTERED
+    return WAITLISTED
+
+
+def withdraw(event_id, volunteer):
+    """
+    Removes the volunteer from the event or its waitlist. A released seat is handed to the next waitlisted volunteer.
+    :param event_id: Id of the event
+    :param volunteer: Volunteer withdrawing
+    :return: WITHDRAWN if the volunteer had a seat, LEFT_WAITLIST if they were waitlisted, else None
+    """
+    with transaction.atomic():
+        deleted, _ = Registration.objects.filter(event_id=event_id, volunteer_id=volunteer.id).delete()
+        if deleted:
+            _release_seats([event_id])
+    if deleted:
+        _send_registration(event_id, volunteer, False)
+        promote_waitlist(event_id)
+        return WITHDRAWN
+
+    deleted, _ = WaitlistEntry.objects.filter(event_id=event_id, volunteer_id=volunteer.id).delete()
+    if deleted:
+        return LEFT_WAITLIST
+    return None
+
+
+def toggle(event_id, volunteer):
+    """
+    Withdraws the volunteer if they are registered or waitlisted for the event, else registers them
+    :param event_id: Id of the event
+    :param volunteer: Volunteer toggling their registration
+    :return: REGISTERED, WAITLISTED, WITHDRAWN or LEFT_WAITLIST
+    """
+    outcome = withdraw(event_id, volunteer)
+    if outcome is None:
+        outcome = register(event_id, volunteer)
+    return outcome
+
+
+def register_many(event_ids, volunteer):
+    """
+    Registers the volunteer for several events at once. Seats are reserved with one UPDATE and the registrations are
+    written with one bulk_create while the events' rows are locked; events that are full put the volunteer on their
+    waitlist instead. signal_volunteer_event_registration_batch is sent once for all new registrations.
+    :param event_ids: Ids of the events
+    :param volunteer: Volunteer registering
+    :return: Dictionary mapping REGISTERED, WAITLISTED and MISSING to sorted lists of event ids
+    """
+    event_ids = set(event_ids)
+    with transaction.atomic():
+        # Lock in id order so concurrent batches can't deadlock each other
+        events = list(Event.objects.select_for_update().filter(id__in=event_ids).order_by('id')
+                      .values_list('id', 'capacity', 'seats_taken'))
+        registered = set(Registration.objects.filter(event_id__in=event_ids, volunteer_id=volunteer.id)
+                         .values_list('event_id', flat=True))
+        free, full = [], []
+        for event_id, capacity, seats_taken in events:
+            if event_id in registered:
+                continue
+            if capacity is None or seats_taken < capacity:
+                free.append(event_id)
+            else:
+                full.append(event_id)
+
+        if free:
+            Event.objects.filter(id__in=free).update(seats_taken=F('seats_taken') + 1)
+            Registration.objects.bulk_create([Registration(event_id=event_id, volunteer_id=volunteer.id)
+                                              for event_id in free])
+        if full:
+            WaitlistEntry.objects.bulk_create([WaitlistEntry(event_id=event_id, volunteer=volunteer)
+                                               for event_id in full], ignore_conflicts=True)
+
+    if free:
+        _send_registration_batch(free, volunteer, True)
+    return {
+        REGISTERED: sorted(registered.union(free)),
+        WAITLISTED: sorted(full),
+        MISSING: sorted(event_ids.difference(event_id for event_id, _, _ in events)),
+    }
+
+
+def withdraw_many(event_ids, volunteer):
+    """
+    Removes the volunteer from several events and their waitlists at once, with one delete per table and one UPDATE of
+    the seat counters. signal_volunteer_event_registration_batch is sent once for all removed registrations, then the
+    released seats are handed to the next waitlisted volunteers.
+    :param event_ids: Ids of the events
+    :param volunteer: Volunteer withdrawing
+    :return: Dictionary mapping WITHDRAWN and LEFT_WAITLIST to sorted lists of event ids
+    """
+    event_ids = set(event_ids)
+    with transaction.atomic():
+        rows = Registration.objects.filter(event_id__in=event_ids, volunteer_id=volunteer.id)
+        withdrawn = sorted(rows.select_for_update().values_list('event_id', flat=True))
+        if withdrawn:
+            rows.delete()
+            _release_seats(withdrawn)
+
+        entries = WaitlistEntry.objects.filter(event_id__in=event_ids, volunteer_id=volunteer.id)
+        left_waitlist = sorted(entries.values_list('event_id', flat=True))
+        if left_waitlist:
+            entries.delete()
+
+    if withdrawn:
+        _send_registration_batch(withdrawn, volunteer, False)
+        for event_id in withdrawn:
+            promote_waitlist(event_id)
+    return {
+        WITHDRAWN: withdrawn,
+        LEFT_WAITLIST: left_waitlist,
+    }
+
+
+def promote_waitlist(event_id):
+    """
+    Moves waitlisted volunteers into free seats, oldest entry first, until the event is full or the waitlist is empty
+    :param event_id: Id of the event
+    :return: List of the promoted volunteers' ids
+    """
+    promoted = []
+    while True:
+        with transaction.atomic():
+            entry = WaitlistEntry.objects.select_for_update(skip_locked=True).filter(event_id=event_id).first()
+            if entry is None:
+                break
+            taken, created = _take_seat(event_id, entry.volunteer_id)
+            if not taken:
+                break
+            entry.delete()
+        if created:
+            promoted.append(entry.volunteer_id)
+
+    for volunteer in Volunteer.objects.select_related('end_user').filter(id__in=promoted):
+        _send_registration(event_id, volunteer, True)
+    return promoted
+
+
+def recount_seats():
+    """
+    Sets every event's seats_taken to its number of registrations, for registrations made before the counter existed
+    or outside this module. Runs as a single UPDATE.
+    :return: Number of events updated
+    """
+    registrations = Registration.objects.filter(event_id=OuterRef('pk')).order_by().values('event_id') \
+        .annotate(count=Count('id')).values('count')
+    return Event.objects.update(seats_taken=Coalesce(Subquery(registrations), Value(0)))
+
+
+def _release_seats(event_ids):
+    # A counter that is already 0 is out of date, see recount_seats; leave it rather than breaking the withdrawal
+    Event.objects.filter(id__in=event_ids, seats_taken__gt=0).update(seats_taken=F('seats_taken') - 1)
+
+
+def _take_seat(event_id, volunteer_id):
+    """
+    Reserves a seat with a conditional counter update and records the registration in the same transaction. The
+    counter update locks the event row, so concurrent reservations can't oversubscribe it.
+    :return: Tuple (taken, created). taken is False if the event is full; created is False if the volunteer was
+             already registered, in which case no seat is used.
+    """
+    try:
+        with transaction.atomic():
+            reserved = Event.objects.filter(id=event_id) \
+                .filter(Q(capacity__isnull=True) | Q(seats_taken__lt=F('capacity'))) \
+                .update(seats_taken=F('seats_taken') + 1)
+            if not reserved:
+                return Registration.objects.filter(event_id=event_id, volunteer_id=volunteer_id).exists(), False
+            Registration.objects.create(event_id=event_id, volunteer_id=volunteer_id)
+    except IntegrityError:
+        return True, False
+    return True, True
+
+
+def _send_registration(event_id, volunteer, attending):
+    signal_volunteer_event_registration.send(Volunteer, vol_id=volunteer.id, event_id=event_id, volunteer=volunteer,
+                                             attending=attending)
+
+
+def _send_registration_batch(event_ids, volunteer, attending):
+    signal_volunteer_event_registration_batch.send(Volunteer, volunteer=volunteer, event_ids=event_ids,
+                                                   attending=attending)
@@ -105,7 +105,8 @@ class SearchEventsSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Event
-        fields = ['id', 'title', 'start_time', 'end_time', 'date', 'location', 'description', 'organization']
+        fields = ['id', 'title', 'start_time', 'end_time', 'date', 'location', 'description', 'organization',
+                  'capacity', 'seats_taken']
 
     organization = VolunteerSearchOrganizationHelperSerializer(many=False)
 
@@ -126,7 +127,8 @@ class OrganizationEventSerializer(serializers.ModelSerializer):
     """
     class Meta:
         model = Event
-        fields = ['id', 'title', 'start_time', 'end_time', 'date', 'location', 'description', 'volunteers']
+        fields = ['id', 'title', 'start_time', 'end_time', 'date', 'location', 'description', 'volunteers',
+                  'capacity', 'seats_taken']
 
 
 class VolunteerOrganizationSerializer(serializers.ModelSerializer):
@@ -1,90 +1,166 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from django.conf import settings
-from django.core.mail import send_mass_mail
 from django.core.mail import send_mail
 import django.dispatch
-from django.utils import timezone
+from .calendars import calendar_feeds
+from .dispatch import dispatcher
+from .mailing import send_event_mass_mail
+from .pages import organization_pages
+from .recommendations import recommender
 from .urlTokens.token import URLToken
 
-from api.models import Event
+from api.models import Event, Organization, EndUser
 
 # create custom signal for when volunteer changes their event registration. attending = True for registering, False for unregistering
 signal_volunteer_event_registration = django.dispatch.Signal(providing_args=["vol_id", "event_id", "volunteer", "attending"])
+# sent once for a batch of registration changes made together, instead of signal_volunteer_event_registration per event
+signal_volunteer_event_registration_batch = django.dispatch.Signal(providing_args=["volunteer", "event_ids", "attending"])
+# sent once for events created together with bulk_create, which doesn't send post_save
+signal_events_bulk_created = django.dispatch.Signal(providing_args=["organization_id", "event_ids"])
+# sent when an organization edits an event; changes maps each changed field to its api.events.FieldChange
+signal_event_updated = django.dispatch.Signal(providing_args=["event", "changes"])
 
 
-@receiver(post_save, sender=Event)
+@receiver(signal_event_updated)
+@dispatcher.deferred
 def edit_handler(sender, **kwargs):
-    if not kwargs['created'] and 'volunteers' not in kwargs['update_fields']:
-        event = kwargs['instance']
+    changes = kwargs['changes']
+    if changes:
+        event = kwargs['event']
 
-        volunteer_emails = _get_volunteer_emails(event=event)
         subject = event.organization.name + " update their " + event.title + " event."
         message = "You are receiving this message because you are registered for this event and the organizer has " \
-                  "updated some details about the event. \nPlease find a link to the updated event below.\n\n" \
+                  "updated some details about the event: " + ", ".join(name.replace('_', ' ') for name in changes) + \
+                  ". \nPlease find a link to the updated event below.\n\n" \
                   "\nYour event: https://voluntyr.herokuapp.com/Event/" + str(event.id)
 
-        emails = _make_emails(volunteer_emails, settings.DEFAULT_FROM_EMAIL, subject, message)
-        send_mass_mail(emails)
+        send_event_mass_mail(event.id, subject, message, settings.DEFAULT_FROM_EMAIL)
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def event_recommendations_handler(sender, **kwargs):
+    recommender.events_changed(kwargs['instance'].organization_id)
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def organization_page_events_handler(sender, **kwargs):
+    organization_pages.events_changed(kwargs['instance'].organization_id)
+
+
+@receiver(post_save, sender=Event)
+def calendar_event_saved_handler(sender, **kwargs):
+    if kwargs['created']:
+        calendar_feeds.invalidate(calendar_feeds.ORGANIZATION, [kwargs['instance'].organization_id])
+    else:
+        calendar_feeds.event_changed(kwargs['instance'])
+
+
+# Before the delete cascades to the event's registrations, which are needed to find the volunteers' feeds
+@receiver(pre_delete, sender=Event)
+def calendar_event_deleted_handler(sender, **kwargs):
+    calendar_feeds.event_changed(kwargs['instance'])
+
+
+@receiver(signal_events_bulk_created)
+def events_bulk_created_handler(sender, **kwargs):
+    organization_id = kwargs['organization_id']
+    recommender.events_changed(organization_id)
+    organization_pages.events_changed(organization_id)
+    calendar_feeds.invalidate(calendar_feeds.ORGANIZATION, [organization_id])
+
+
+@receiver(post_save, sender=Organization)
+def organization_page_header_handler(sender, **kwargs):
+    organization_pages.organizations_changed([kwargs['instance'].id])
+    if kwargs['created']:
+        organization_pages.events_changed(kwargs['instance'].id)
+
+
+@receiver(post_save, sender=Organization)
+def calendar_organization_saved_handler(sender, **kwargs):
+    update_fields = kwargs['update_fields']
+    if not kwargs['created'] and (update_fields is None or 'name' in update_fields):
+        calendar_feeds.organization_changed(kwargs['instance'].id)
+
+
+@receiver(post_save, sender=EndUser)
+def organization_page_end_user_handler(sender, **kwargs):
+    update_fields = kwargs['update_fields']
+    if not kwargs['created'] and (update_fields is None or 'email' in update_fields):
+        organization_pages.organizations_changed(Organization.objects.filter(end_user_id=kwargs['instance'].id)
+                                                 .values_list('id', flat=True))
+
+
+@receiver(signal_volunteer_event_registration)
+def registration_calendar_handler(sender, **kwargs):
+    calendar_feeds.invalidate(calendar_feeds.VOLUNTEER, [kwargs['vol_id']])
+
+
+@receiver(signal_volunteer_event_registration_batch)
+def registration_batch_calendar_handler(sender, **kwargs):
+    calendar_feeds.invalidate(calendar_feeds.VOLUNTEER, [kwargs['volunteer'].id])
+
+
+@receiver(signal_volunteer_event_registration)
+def registration_recommendations_handler(sender, **kwargs):
+    recommender.registrations_changed(kwargs['vol_id'])
 
 
 @receiver(signal_volunteer_event_registration)
+@dispatcher.deferred
 def volunteer_signed_up_event_handler(sender, **kwargs):
     if kwargs['attending']:
         vol_id = kwargs["vol_id"]
         event_id = kwargs["event_id"]
-        event = Event.objects.get(id=event_id)
+        event = Event.objects.select_related('organization').get(id=event_id)
         volunteer = kwargs["volunteer"]
-        suggesting_events = _make_suggest_events_list(vol_id, event_id, volunteer)
+        suggesting_events = recommender.suggest(vol_id, event.organization_id)
         email = [volunteer.end_user.email]
         subject = "Thank you for registering to volunteer with " + event.organization.name
         message = generate_suggestion_email_message(suggesting_events, email, event_id)
         send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, email)
 
 
-def _get_volunteer_emails(event):
-    volunteers = event.volunteers.all()
-    emails = []
-    for volunteer in volunteers:
-        emails.append(volunteer.end_user.email)
-    return emails
-
-
-def _make_emails(to_emails, from_email, subject, message):
-    """
-    Builds a tuple of the emails to send
-    :param to_emails: List of volunteer emails
-    :param from_email: From email address
-    :param subject: Subject of the emails
-    :param message: Message of the emails
-    :return: Tuple of the emails to send
-    """
-    emails = []
-    for volunteer in to_emails:
-        emails.append((subject, message, from_email, [volunteer]))
-    return tuple(emails)
+@receiver(signal_volunteer_event_registration_batch)
+def registration_batch_recommendations_handler(sender, **kwargs):
+    recommender.registrations_changed(kwargs['volunteer'].id)
 
 
-def _make_suggest_events_list(vol_id, event_id, volunteer):
-    event_lst = []
-    current_event = Event.objects.get(id=event_id)
-    events = Event.objects.all().filter(start_time__gte=timezone.now())
-    for event in events:
-        if event.organization == current_event.organization and volunteer not in event.volunteers.all():
-            event_lst.append(event)
-    if len(event_lst) < 3:
+@receiver(signal_volunteer_event_registration_batch)
+@dispatcher.deferred
+def volunteer_signed_up_events_batch_handler(sender, **kwargs):
+    if kwargs['attending']:
+        volunteer = kwargs['volunteer']
+        events = list(Event.objects.select_related('organization').filter(id__in=kwargs['event_ids'])
+                      .order_by('start_time'))
+        # The events may have been deleted before this ran
+        if not events:
+            return
+        organizations = []
         for event in events:
-            if volunteer not in event.volunteers.all():
-                event_lst.append(event)
-    if len(event_lst) > 3:
-        event_lst = event_lst[:3]
-    return event_lst
+            if event.organization.name not in organizations:
+                organizations.append(event.organization.name)
+        suggesting_events = recommender.suggest(volunteer.id, events[0].organization_id)
+        email = [volunteer.end_user.email]
+        subject = "Thank you for registering to volunteer with " + ", ".join(organizations)
+        message = "\n".join("Thank you for registering for " + str(event.title) + " organized by " +
+                            str(event.organization) for event in events)
+        message += generate_suggestions_message(suggesting_events)
+        send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, email)
 
 
 def generate_suggestion_email_message(suggesting_events, email, event_id):
     current_event = Event.objects.get(id=event_id)
     message = "Thank you for registering for " + str(current_event.title) +\
               " organized by " + str(current_event.organization)
+    return message + generate_suggestions_message(suggesting_events)
+
+
+def generate_suggestions_message(suggesting_events):
+    message = ""
     if len(suggesting_events) > 0:
         message += "\n\nWe have found " + str(len(suggesting_events)) + " other volunteer opportunities that you may " \
                                                                         "be interested in: "
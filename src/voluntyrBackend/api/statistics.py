@@ -0,0 +1,68 @@
+from django.db.models import Count
+from django.utils import timezone
+
+from api.models import Event
+
+
+def organization_statistics(organization_id, chunk_size=1000):
+    """
+    Signup counts, fill rates, attendance and rating summaries for every event run by an organization, computed with
+    a single grouped query. Ratings come from the materialized event rating aggregates, a one-to-one join, so joining
+    them doesn't multiply the counted volunteers.
+    :param organization_id: Id of the organization
+    :param chunk_size: Number of rows fetched from the database at a time
+    :return: Dictionary with the per-event rows under "events", in start time order, and totals over all of them
+             under "summary". Attendance counts the volunteers of events that have already started.
+    """
+    now = timezone.now()
+    rows = Event.objects.filter(organization_id=organization_id) \
+        .values('id', 'title', 'start_time', 'capacity', 'rating_aggregate__count', 'rating_aggregate__total') \
+        .annotate(signups=Count('volunteers')) \
+        .order_by('start_time', 'id')
+
+    summary = {"events": 0, "upcoming_events": 0, "signups": 0, "attendance": 0, "fill_rate": None,
+               "ratings": {"average": 0, "count": 0}}
+    capacity_total = 0
+    capacity_signups = 0
+    rating_total = 0
+    events = []
+    for row in rows.iterator(chunk_size=chunk_size):
+        rating_count = row['rating_aggregate__count'] or 0
+        rating_sum = row['rating_aggregate__total'] or 0
+        events.append({
+            "id": row['id'],
+            "title": row['title'],
+            "start_time": row['start_time'],
+            "signups": row['signups'],
+            "capacity": row['capacity'],
+            "fill_rate": _fill_rate(row['signups'], row['capacity']),
+            "ratings": {"average": _average(rating_sum, rating_count), "count": rating_count},
+        })
+
+        summary['events'] += 1
+        summary['signups'] += row['signups']
+        if row['start_time'] >= now:
+            summary['upcoming_events'] += 1
+        else:
+            summary['attendance'] += row['signups']
+        if row['capacity']:
+            capacity_total += row['capacity']
+            capacity_signups += row['signups']
+        summary['ratings']['count'] += rating_count
+        rating_total += rating_sum
+
+    summary['fill_rate'] = _fill_rate(capacity_signups, capacity_total)
+    summary['ratings']['average'] = _average(rating_total, summary['ratings']['count'])
+    return {"summary": summary, "events": events}
+
+
+def _fill_rate(signups, capacity):
+    if not capacity:
+        return None
+    return round(signups / capacity, 2)
+
+
+def _average(total, count):
+    if not count:
+        return 0
+    return round(total / count, 2)
@@ -1,21 +1,44 @@
+import csv
 import json
+import os
+import tempfile
+import threading
 from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
 
 from authy.api import AuthyApiClient
 from django.conf import settings
 from django.core import mail
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from rest_framework.test import APIRequestFactory, RequestsClient
 from rest_framework_simplejwt.views import TokenRefreshView
 
-from api.models import Event, Organization, EndUser
+from api.dispatch import DeferredDispatcher, delete_on_commit
+from api.events import FieldChange
+from api.models import Event, Organization, EndUser, Volunteer, Rating, OrganizationRatingAggregate, WaitlistEntry, \
+    EventSeries
+from api.imports import CHUNK_SIZE
+from api.pages import organization_pages
+from api.ratings import record_rating
+from api.recommendations import recommender
+from api.signals import signal_volunteer_event_registration, signal_volunteer_event_registration_batch, \
+    signal_event_updated
 from api.urlTokens.token import URLToken
 from api.views import ObtainTokenPairView, VolunteerSignupAPIView, OrganizationSignupAPIView, CheckEmailAPIView
+from chat.models import Membership, Room
 from .views import RecoverPasswordView
 
 authy_api = AuthyApiClient(settings.ACCOUNT_SECURITY_API_KEY)
 
+# Runs deferred signal receivers inline, so tests can assert on their effects such as sent emails
+synchronous_dispatch = override_settings(DEFERRED_DISPATCH=dict(settings.DEFERRED_DISPATCH, SYNCHRONOUS=True))
+
 
 # TODO: test for double signup of events
 
@@ -139,6 +162,7 @@ class Utilities:
                 self.assertIn(expected_contained_message, email.body)
 
 
+@synchronous_dispatch
 class RatingTest(TestCase, Utilities):
     today = datetime.today().day
     month = datetime.today().month
@@ -399,6 +423,54 @@ class RatingTest(TestCase, Utilities):
         self.rate_event(event_id=2, rating=1, expected_status=202, expected_content={"Result": "Rating accepted"})
         self.assert_org_rating(1, 200, {'rating': 3.0, 'raters': 2})
 
+    def test_rating_average(self):
+        for event_id in (1, 2, 4):
+            self.volunteer_signup_for_event(self.volunteerTokens['access'], event_id)
+
+        self.rate_event(event_id=1, rating=5, expected_status=202, expected_content={"Result": "Rating accepted"})
+        self.rate_event(event_id=2, rating=1, expected_status=202, expected_content={"Result": "Rating accepted"})
+        self.rate_event(event_id=4, rating=1, expected_status=202, expected_content={"Result": "Rating accepted"})
+        self.assert_org_rating(1, 200, {'rating': 2.33, 'raters': 3})
+
+        self.rate_event(event_id=4, rating=5, expected_status=400,
+                        expected_content={"Error": "This volunteer has already rated this event"})
+        self.assertEqual(Rating.objects.filter(event__id=4).count(), 1)
+        self.assert_org_rating(1, 200, {'rating': 2.33, 'raters': 3})
+
+    def test_rating_aggregates(self):
+        for event_id in (1, 2, 4):
+            self.volunteer_signup_for_event(self.volunteerTokens['access'], event_id)
+        self.rate_event(event_id=1, rating=5, expected_status=202, expected_content={"Result": "Rating accepted"})
+        self.rate_event(event_id=2, rating=1, expected_status=202, expected_content={"Result": "Rating accepted"})
+        self.rate_event(event_id=4, rating=1, expected_status=202, expected_content={"Result": "Rating accepted"})
+
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.volunteerTokens['access']})
+        response = client.get("http://testserver/api/event/1/ratings/")
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(json.loads(response.content), {
+            "average": 5.0, "count": 1, "histogram": {"1": 0, "2": 0, "3": 0, "4": 0, "5": 1}})
+
+        response = client.get("http://testserver/api/event/3/ratings/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['count'], 0)
+
+        organization_client = RequestsClient()
+        organization_client.headers.update({'Authorization': 'Bearer ' + self.organizationTokens['access']})
+        self.assertEqual(organization_client.get("http://testserver/api/event/1/ratings/").status_code, 200)
+        self.assertEqual(RequestsClient().get("http://testserver/api/event/1/ratings/").status_code, 401)
+
+        expected = {"average": 2.33, "count": 3, "histogram": {"1": 2, "2": 0, "3": 0, "4": 0, "5": 1}}
+        response = client.get("http://testserver/api/organization/1/")
+        self.assertDictEqual(json.loads(response.content)['ratings'], expected)
+
+        Organization.objects.filter(id=1).update(rating=4.5, raters=10)
+        OrganizationRatingAggregate.objects.all().delete()
+        call_command('recompute_rating_aggregates', stdout=StringIO())
+        self.assert_org_rating(1, 200, {'rating': 2.33, 'raters': 3})
+        response = client.get("http://testserver/api/organization/1/")
+        self.assertDictEqual(json.loads(response.content)['ratings'], expected)
+
     def test_not_registered(self):
         client = RequestsClient()
         client.headers.update({'Authorization': 'Bearer ' + self.volunteerTokens['access']})
@@ -815,6 +887,38 @@ class VolunteerOrganizationPageTests(TestCase, Utilities):
         self.assertEqual(status, 400, "Received unexpected status code")
         self.assertDictEqual(content, {"Error": "Organization with the given Id does not exist."})
 
+    def test_organization_page_cache(self):
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.volunteerTokens['access']})
+        path = "http://testserver/api/organization/%d/" % 1
+        client.get(path)
+
+        # Only the token's user is looked up once both fragments are cached
+        with self.assertNumQueries(1):
+            content = json.loads(client.get(path).content)
+        self.assertEqual(len(content['events']), 2)
+
+        event = Event.objects.get(id=1)
+        event.title = "Renamed event"
+        event.save(update_fields=['title'])
+        organization = Organization.objects.get(id=1)
+        organization.organization_motto = "New motto"
+        organization.save()
+
+        content = json.loads(client.get(path).content)
+        self.assertEqual(content['events'][0]['title'], "Renamed event")
+        self.assertEqual(content['organization']['organization_motto'], "New motto")
+
+    def test_organization_page_events_expire_at_next_start(self):
+        start = timezone.now() + timedelta(minutes=10)
+        Event.objects.create(start_time=start, end_time=start, date=start.date(), title="Soon", location="IU",
+                             description="Starts soon", organization=Organization.objects.get(id=1))
+        with mock.patch('api.pages.cache') as page_cache:
+            page_cache.get.return_value = None
+            organization_pages.get_events(1)
+        timeout = page_cache.set.call_args[0][2]
+        self.assertAlmostEqual(timeout, 600, delta=60)
+
     def test_view_with_org_token(self):
         client = RequestsClient()
         client.headers.update({'Authorization': 'Bearer ' + self.organizationTokens['access']})
@@ -854,6 +958,7 @@ class VolunteerOrganizationPageTests(TestCase, Utilities):
             self.assertDictEqual(e, a, "Event dict did not match expected")
 
 
+@synchronous_dispatch
 class OrganizationEventTests(TestCase, Utilities):
     tomorrow = datetime.today() + timedelta(days=1)
 
@@ -946,7 +1051,38 @@ class OrganizationEventTests(TestCase, Utilities):
                          [{'name': self.volunteerDicts[0]['first_name'] + " " + self.volunteerDicts[0]['last_name']},
                           {'name': self.volunteerDicts[1]['first_name'] + " " + self.volunteerDicts[1]['last_name']}])
 
+    def test_roster(self):
+        for tokens in self.volunteerTokens[-3:]:
+            self.volunteer_signup_for_event(tokens['access'], self.eventId)
+
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.organizationTokens['access']})
+        path = "http://testserver/api/event/%d/roster/" % self.eventId
+
+        content = json.loads(client.get(path, params={'limit': 2}).content)
+        self.assertEqual(content['count'], 3)
+        self.assertListEqual([volunteer['email'] for volunteer in content['volunteers']],
+                             [self.volunteerDicts[0]['email'], self.volunteerDicts[1]['email']])
+        self.assertEqual(content['volunteers'][0]['name'], "First user volunteer")
+        self.assertIsNotNone(content['next'])
+
+        content = json.loads(client.get(path, params={'limit': 2, 'cursor': content['next']}).content)
+        self.assertListEqual([volunteer['email'] for volunteer in content['volunteers']],
+                             [self.volunteerDicts[2]['email']])
+        self.assertIsNone(content['next'])
+
+        content = json.loads(client.get(path, params={'search': 'second'}).content)
+        self.assertEqual(content['count'], 3)
+        self.assertListEqual([volunteer['email'] for volunteer in content['volunteers']],
+                             [self.volunteerDicts[1]['email']])
 
+        response = client.get(path, params={'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+        response = client.get("http://testserver/api/event/%d/roster/" % (self.eventId + 1))
+        self.assertEqual(response.status_code, 400)
+
+
+@synchronous_dispatch
 class EventEmailTests(TestCase, Utilities):
     today = datetime.today().day
     month = datetime.today().month
@@ -1032,6 +1168,24 @@ class EventEmailTests(TestCase, Utilities):
         response = client.post(path, json=email_dict)
         self.assertEqual(response.status_code, 200)
 
+    def test_email_recipients(self):
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.organizationTokens_real['access']})
+        path = "http://testserver/api/event/%d/email/" % 1
+
+        email_dict = {
+            'message': 'This is a test email from EventEmailTests.test_email_recipients',
+            'subject': 'Test case email',
+            'replyto': 'testcase@gmail.com'
+        }
+        pre_email_outbox_len = len(mail.outbox)
+
+        response = client.post(path, json=email_dict)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), pre_email_outbox_len + 1)
+        self.assertEqual(mail.outbox[-1].to, [self.volunteerDict['email']])
+        self.assertIn(email_dict['message'], mail.outbox[-1].body)
+
     def test_no_volunteers(self):
         client = RequestsClient()
         client.headers.update({'Authorization': 'Bearer ' + self.organizationTokens_real['access']})
@@ -1043,8 +1197,10 @@ class EventEmailTests(TestCase, Utilities):
             'replyto': 'testcase@gmail.com'
         }
 
-        response = client.post(path, json=email_dict)
+        with mock.patch('api.mailing.get_connection') as get_connection:
+            response = client.post(path, json=email_dict)
         self.assertEqual(response.status_code, 200)
+        get_connection.assert_not_called()
 
     def test_bad_event(self):
         client = RequestsClient()
@@ -1124,6 +1280,7 @@ class OrganizationCreateEvent(TestCase, Utilities):
         self.assertEqual(create_event_response.status_code, expected, msg=create_event_response.content)
 
 
+@synchronous_dispatch
 class OrganizationEditEvent(TestCase, Utilities):
     """
     Test the endpoint to edit event
@@ -1198,6 +1355,58 @@ class OrganizationEditEvent(TestCase, Utilities):
         self.assertEqual(json.loads(create_event_response.content)['description'], editDetails['description'])
 
 
+    def test_partial_update(self):
+        organization_dict = {
+            "email": "patchorg@gmail.com",
+            "password": "testpassword123",
+            "name": "patchOrg",
+            "street_address": "700 N, Woodlawn Lane",
+            "city": "Bloomington",
+            "state": "Indiana",
+            "phone_number": "765-426-3678",
+            "organization_motto": "Org Motto"
+        }
+        Utilities.organization_signup(self, organization_dict)
+        access_token = Utilities.organization_login(self, organization_dict)['access']
+        organization = Organization.objects.get(name="patchOrg")
+        event = Event.objects.create(start_time=timezone.now(), end_time=timezone.now() + timedelta(hours=1),
+                                     date=timezone.now().date(), title="Patched", location="IU",
+                                     description="Before", organization=organization)
+        self.signup_register_volunteer(event.id)
+
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + access_token})
+        path = "http://testserver/api/organization/updateEvent/"
+        received = []
+        receiver = lambda sender, **kwargs: received.append(kwargs['changes'])
+        signal_event_updated.connect(receiver)
+        self.addCleanup(signal_event_updated.disconnect, receiver)
+
+        pre_edit_outbox_len = len(mail.outbox)
+        new_end = event.end_time + timedelta(hours=1)
+        response = client.patch(path, json={"id": event.id, "description": "After", "title": "Patched",
+                                            "end_time": new_end.isoformat()})
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertListEqual(json.loads(response.content)['Changed'], ['description', 'end_time'])
+        self.assertDictEqual(received[0], {"description": FieldChange("Before", "After"),
+                                           "end_time": FieldChange(event.end_time, new_end)})
+        self.assertEqual(len(mail.outbox), pre_edit_outbox_len + 1)
+        self.assertIn("description, end time", mail.outbox[-1].body)
+
+        response = client.patch(path, json={"id": event.id, "description": "After"})
+        self.assertListEqual(json.loads(response.content)['Changed'], [])
+        self.assertEqual(len(received), 1, "Receivers were notified of a no-op edit.")
+        self.assertEqual(len(mail.outbox), pre_edit_outbox_len + 1)
+
+        response = client.patch(path, json={"id": event.id, "volunteers": []})
+        self.assertEqual(response.status_code, 400)
+        self.assertDictEqual(json.loads(response.content), {"Error": "Fields can't be edited: volunteers"})
+        response = client.patch(path, json={"id": event.id, "end_time": (event.start_time - timedelta(hours=1))
+                                            .isoformat()})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Event.objects.get(id=event.id).end_time, new_end)
+
+
 class EventSearchTest(TestCase, Utilities):
     today = datetime.today().day
     month = datetime.today().month
@@ -1360,6 +1569,8 @@ class EventSearchTest(TestCase, Utilities):
             current_dict = expected_events[i]
             current_dict['organization'] = {"id": 1, "name": organization_name, "raters": 0, "rating": 0.0}
             current_dict['id'] = current_id
+            current_dict['capacity'] = None
+            current_dict['seats_taken'] = 0
 
         return expected_events
 
@@ -1375,6 +1586,7 @@ class EventSearchTest(TestCase, Utilities):
         return event.id
 
 
+@synchronous_dispatch
 class VolunteerEventSignupTest(TestCase, Utilities):
     tomorrow = datetime.today() + timedelta(days=1)
 
@@ -1458,6 +1670,31 @@ class VolunteerEventSignupTest(TestCase, Utilities):
         self.assertEqual(status, 200, msg="Signup check failed.")
         self.assertDictEqual(content, {"Signed-up": "true"}, msg="Volunteer should be signed up.")
 
+    def test_check_event_signups(self):
+        other_event_id = self.new_event(dict(self.eventDict))
+        self.volunteer_signup_for_event(self.volunteerTokens['access'], self.eventId)
+
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.volunteerTokens['access']})
+        path = "http://testserver/api/events/check/?ids=%d,%d,%d" % (self.eventId, other_event_id, other_event_id + 1)
+
+        # One query authenticates the token, one answers for every event
+        with self.assertNumQueries(2):
+            data_response = client.get(path)
+        content = json.loads(data_response.content)
+
+        self.assertEqual(data_response.status_code, 200, msg="Signup check failed.")
+        self.assertDictEqual(content, {"Signed-up": {str(self.eventId): "true", str(other_event_id): "false",
+                                                     str(other_event_id + 1): "false"}})
+
+        data_response = client.get("http://testserver/api/events/check/?ids=1,a")
+        self.assertEqual(data_response.status_code, 400)
+
+        ids = ','.join(str(event_id) for event_id in range(1, 102))
+        data_response = client.get("http://testserver/api/events/check/?ids=" + ids)
+        self.assertEqual(data_response.status_code, 400)
+        self.assertDictEqual(json.loads(data_response.content), {"Error": "At most 100 events can be checked at once."})
+
     def test_check_bad_event_signup(self):
         client = RequestsClient()
         client.headers.update({'Authorization': 'Bearer ' + self.volunteerTokens['access']})
@@ -1510,6 +1747,844 @@ class VolunteerEventSignupTest(TestCase, Utilities):
         return event.id
 
 
+@synchronous_dispatch
+class EventCapacityTest(TestCase, Utilities):
+    tomorrow = timezone.now() + timedelta(days=1)
+
+    organizationDict = {
+        "email": "capacityorg@gmail.com",
+        "password": "testpassword123",
+        "name": "Capacity Org",
+        "street_address": "1 IU st",
+        "city": "Bloomington",
+        "state": "Indiana",
+        "phone_number": "765-426-3682",
+        "organization_motto": "The motto"
+    }
+
+    def setUp(self):
+        self.organization_signup(self.organizationDict)
+        self.event = Event.objects.create(start_time=self.tomorrow, end_time=self.tomorrow, date=self.tomorrow.date(),
+                                          title="Small event", location="IU", description="Two seats", capacity=2,
+                                          organization=Organization.objects.get(name="Capacity Org"))
+        self.tokens = []
+        for i in range(3):
+            volunteer_dict = {
+                "email": "capacityvol%d@gmail.com" % i,
+                "password": "testpassword2",
+                "first_name": "Volunteer",
+                "last_name": str(i),
+                "phone_number": "765-426-3681",
+                "birthday": "1998-06-12"
+            }
+            self.volunteer_signup(volunteer_dict)
+            self.tokens.append(self.volunteer_login(volunteer_dict)['access'])
+
+    def signup(self, token, data=None):
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + token})
+        path = "http://testserver/api/event/%d/volunteer/" % self.event.id
+        response = client.put(path, json=data)
+        self.assertEqual(response.status_code, 202)
+        return json.loads(response.content)
+
+    def test_waitlist_when_full(self):
+        self.signup(self.tokens[0])
+        self.signup(self.tokens[1])
+        content = self.signup(self.tokens[2])
+
+        self.assertDictEqual(content, {"Success": "Volunteer has been added to the waitlist for event %d"
+                                                  % self.event.id})
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.seats_taken, 2)
+        self.assertEqual(self.event.volunteers.count(), 2)
+        self.assertEqual(WaitlistEntry.objects.filter(event=self.event).count(), 1)
+
+    def test_withdraw_promotes_waitlist(self):
+        self.signup(self.tokens[0])
+        self.signup(self.tokens[1])
+        self.signup(self.tokens[2])
+
+        pre_outbox_len = len(mail.outbox)
+        content = self.signup(self.tokens[0])
+        self.assertDictEqual(content, {"Success": "Volunteer has been removed from event %d" % self.event.id})
+
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.seats_taken, 2)
+        self.assertTrue(self.event.volunteers.filter(end_user__email="capacityvol2@gmail.com").exists())
+        self.assertFalse(WaitlistEntry.objects.filter(event=self.event).exists())
+        self.assertEqual(len(mail.outbox), pre_outbox_len + 1, "The promoted volunteer wasn't emailed.")
+
+    def test_explicit_attending(self):
+        self.signup(self.tokens[0], {"attending": True})
+        content = self.signup(self.tokens[0], {"attending": True})
+        self.assertDictEqual(content, {"Success": "Volunteer has signed up for event %d" % self.event.id})
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.seats_taken, 1)
+
+        self.signup(self.tokens[0], {"attending": False})
+        self.signup(self.tokens[0], {"attending": False})
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.seats_taken, 0)
+        self.assertEqual(self.event.volunteers.count(), 0)
+
+    def test_invalid_capacity(self):
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.organization_login(self.organizationDict)['access']})
+        event_dict = {
+            "start_time": self.tomorrow.isoformat(),
+            "end_time": self.tomorrow.isoformat(),
+            "date": self.tomorrow.date().isoformat(),
+            "title": "Capacity check",
+            "location": "IU",
+            "description": "Capacity check"
+        }
+        for capacity in (0, -3, 2.5, "ten", True):
+            event_dict['capacity'] = capacity
+            response = client.post("http://testserver/api/organization/event/", json=event_dict)
+            self.assertEqual(response.status_code, 400, capacity)
+            self.assertDictEqual(json.loads(response.content), {"Error": "Capacity must be a positive integer or null"})
+        self.assertFalse(Event.objects.filter(title="Capacity check").exists())
+
+        for capacity in (None, 10):
+            event_dict['capacity'] = capacity
+            response = client.post("http://testserver/api/organization/event/", json=event_dict)
+            self.assertEqual(response.status_code, 201, response.content)
+        self.assertListEqual(sorted(Event.objects.filter(title="Capacity check").values_list('capacity', flat=True),
+                                    key=lambda capacity: capacity or 0), [None, 10])
+
+    def test_raise_capacity_promotes_waitlist(self):
+        for token in self.tokens:
+            self.signup(token)
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.organization_login(self.organizationDict)['access']})
+        path = "http://testserver/api/organization/updateEvent/"
+
+        response = client.patch(path, json={"id": self.event.id, "capacity": 1})
+        self.assertEqual(response.status_code, 400)
+        response = client.patch(path, json={"id": self.event.id, "capacity": 0})
+        self.assertEqual(response.status_code, 400)
+        response = client.patch(path, json={"id": self.event.id, "capacity": 3})
+        self.assertListEqual(json.loads(response.content)['Changed'], ['capacity'])
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.seats_taken, 3)
+        self.assertFalse(WaitlistEntry.objects.filter(event=self.event).exists())
+
+    def test_recount_legacy_registrations(self):
+        volunteers = list(Volunteer.objects.filter(end_user__email__in=["capacityvol0@gmail.com",
+                                                                        "capacityvol1@gmail.com"]))
+        # Registered before the counter existed: the rows and chat memberships are there, the count isn't
+        self.event.volunteers.add(*volunteers)
+        Membership.objects.bulk_create([Membership(end_user=volunteer.end_user, room=Room.objects.get(event=self.event))
+                                        for volunteer in volunteers])
+        self.assertEqual(Event.objects.get(id=self.event.id).seats_taken, 0)
+        # A stale counter doesn't stop the volunteer from withdrawing
+        self.signup(self.tokens[0])
+        self.assertEqual(Event.objects.get(id=self.event.id).seats_taken, 0)
+
+        out = StringIO()
+        call_command('recount_event_seats', stdout=out)
+        self.assertIn('Recounted the seats of', out.getvalue())
+        self.assertEqual(Event.objects.get(id=self.event.id).seats_taken, self.event.volunteers.count())
+
+
+@synchronous_dispatch
+class VolunteerBulkSignupTest(TestCase, Utilities):
+    tomorrow = timezone.now() + timedelta(days=1)
+
+    volunteerDict = {
+        "email": "bulkvolunteer@gmail.com",
+        "password": "testpassword2",
+        "first_name": "Bulk",
+        "last_name": "Volunteer",
+        "phone_number": "765-426-3681",
+        "birthday": "1998-06-12"
+    }
+
+    organizationDict = {
+        "email": "bulkorg@gmail.com",
+        "password": "testpassword123",
+        "name": "Bulk Org",
+        "street_address": "1 IU st",
+        "city": "Bloomington",
+        "state": "Indiana",
+        "phone_number": "765-426-3682",
+        "organization_motto": "The motto"
+    }
+
+    def setUp(self):
+        self.volunteer_signup(self.volunteerDict)
+        self.token = self.volunteer_login(self.volunteerDict)['access']
+        self.organization_signup(self.organizationDict)
+        organization = Organization.objects.get(name="Bulk Org")
+        self.event_ids = []
+        for i, capacity in enumerate([None, 5, 0]):
+            event = Event.objects.create(start_time=self.tomorrow + timedelta(days=i), end_time=self.tomorrow,
+                                         date=self.tomorrow.date(), title="Series day %d" % i, location="IU",
+                                         description="Series", capacity=capacity, organization=organization)
+            self.event_ids.append(event.id)
+
+    def bulk(self, data, expected=202):
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.token})
+        response = client.put("http://testserver/api/volunteer/events/signup/", json=data)
+        self.assertEqual(response.status_code, expected)
+        return json.loads(response.content)
+
+    def test_bulk_register_and_withdraw(self):
+        pre_outbox_len = len(mail.outbox)
+        content = self.bulk({"action": "register", "event_ids": self.event_ids + [self.event_ids[-1] + 100]})
+
+        self.assertDictEqual(content, {"registered": self.event_ids[:2], "waitlisted": [self.event_ids[2]],
+                                       "missing": [self.event_ids[-1] + 100]})
+        self.assertEqual(len(mail.outbox), pre_outbox_len + 1, "Expected one confirmation email for the batch.")
+        self.assertIn("Series day 0", mail.outbox[-1].body)
+        self.assertIn("Series day 1", mail.outbox[-1].body)
+        self.assertEqual(Event.objects.get(id=self.event_ids[1]).seats_taken, 1)
+        self.assertEqual(Membership.objects.filter(end_user__email=self.volunteerDict['email'], attending=True,
+                                                   room__event_id__in=self.event_ids).count(), 2)
+
+        content = self.bulk({"action": "register", "event_ids": self.event_ids[:2]})
+        self.assertListEqual(content['registered'], self.event_ids[:2])
+        self.assertEqual(Event.objects.get(id=self.event_ids[1]).seats_taken, 1)
+
+        content = self.bulk({"action": "withdraw", "event_ids": self.event_ids})
+        self.assertDictEqual(content, {"withdrawn": self.event_ids[:2], "left_waitlist": [self.event_ids[2]]})
+        self.assertEqual(Event.objects.get(id=self.event_ids[1]).seats_taken, 0)
+        self.assertFalse(Event.volunteers.through.objects.filter(event_id__in=self.event_ids).exists())
+        self.assertEqual(Membership.objects.filter(end_user__email=self.volunteerDict['email'], attending=True,
+                                                   room__event_id__in=self.event_ids).count(), 0)
+
+    def test_bulk_signup_bad_body(self):
+        content = self.bulk({"event_ids": self.event_ids}, expected=400)
+        self.assertDictEqual(content, {"Error": "Body must contain an action and a list of event_ids."})
+        content = self.bulk({"action": "cancel", "event_ids": self.event_ids}, expected=400)
+        self.assertDictEqual(content, {"Error": "Action must be register or withdraw."})
+        for event_ids in ("123", [1, "2"], [True], None):
+            content = self.bulk({"action": "register", "event_ids": event_ids}, expected=400)
+            self.assertDictEqual(content, {"Error": "Body must contain an action and a list of event_ids."})
+        content = self.bulk({"action": "register", "event_ids": list(range(1, 102))}, expected=400)
+        self.assertDictEqual(content, {"Error": "At most 100 events can be changed at once."})
+
+    def test_batch_email_for_deleted_events(self):
+        volunteer = Volunteer.objects.get(end_user__email=self.volunteerDict['email'])
+        pre_outbox_len = len(mail.outbox)
+        signal_volunteer_event_registration_batch.send(Volunteer, volunteer=volunteer, event_ids=[0], attending=True)
+        self.assertEqual(len(mail.outbox), pre_outbox_len)
+
+
+class OrganizationStatisticsTest(TestCase, Utilities):
+    organizationDict = {
+        "email": "statsorg@gmail.com",
+        "password": "testpassword123",
+        "name": "Stats Org",
+        "street_address": "1 IU st",
+        "city": "Bloomington",
+        "state": "Indiana",
+        "phone_number": "765-426-3682",
+        "organization_motto": "The motto"
+    }
+
+    def setUp(self):
+        self.organization_signup(self.organizationDict)
+        self.token = self.organization_login(self.organizationDict)['access']
+        organization = Organization.objects.get(name="Stats Org")
+        now = timezone.now()
+        self.past = Event.objects.create(start_time=now - timedelta(days=1), end_time=now, date=now.date(),
+                                         title="Past", location="IU", description="Done", capacity=4,
+                                         organization=organization)
+        self.upcoming = Event.objects.create(start_time=now + timedelta(days=1), end_time=now + timedelta(days=1),
+                                             date=now.date(), title="Upcoming", location="IU", description="Soon",
+                                             organization=organization)
+        volunteers = []
+        for i in range(3):
+            end_user = EndUser.objects.create(email="statsvol%d@gmail.com" % i)
+            volunteers.append(Volunteer.objects.create(end_user=end_user, first_name="Stats", last_name=str(i),
+                                                       phone_number="765-426-3681"))
+        self.past.volunteers.add(*volunteers[:2])
+        self.upcoming.volunteers.add(volunteers[2])
+        record_rating(self.past, volunteers[0], 5)
+        record_rating(self.past, volunteers[1], 2)
+
+    def test_organization_statistics(self):
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.token})
+
+        # Token user, organization id and the grouped statistics query
+        with self.assertNumQueries(3):
+            response = client.get("http://testserver/api/organization/stats/")
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+
+        self.assertDictEqual(content['summary'], {"events": 2, "upcoming_events": 1, "signups": 3, "attendance": 2,
+                                                  "fill_rate": 0.5, "ratings": {"average": 3.5, "count": 2}})
+        past, upcoming = content['events']
+        self.assertEqual(past['id'], self.past.id)
+        self.assertEqual(past['signups'], 2)
+        self.assertEqual(past['fill_rate'], 0.5)
+        self.assertDictEqual(past['ratings'], {"average": 3.5, "count": 2})
+        self.assertEqual(upcoming['signups'], 1)
+        self.assertIsNone(upcoming['fill_rate'])
+        self.assertDictEqual(upcoming['ratings'], {"average": 0, "count": 0})
+
+
+class PastEventsTest(TestCase, Utilities):
+    volunteerDict = {
+        "email": "historyvolunteer@gmail.com",
+        "password": "testpassword2",
+        "first_name": "History",
+        "last_name": "Volunteer",
+        "phone_number": "765-426-3681",
+        "birthday": "1998-06-12"
+    }
+
+    organizationDict = {
+        "email": "historyorg@gmail.com",
+        "password": "testpassword123",
+        "name": "History Org",
+        "street_address": "1 IU st",
+        "city": "Bloomington",
+        "state": "Indiana",
+        "phone_number": "765-426-3682",
+        "organization_motto": "The motto"
+    }
+
+    def setUp(self):
+        self.volunteer_signup(self.volunteerDict)
+        self.volunteer_token = self.volunteer_login(self.volunteerDict)['access']
+        self.organization_signup(self.organizationDict)
+        self.organization_token = self.organization_login(self.organizationDict)['access']
+        organization = Organization.objects.get(name="History Org")
+        volunteer = Volunteer.objects.get(end_user__email=self.volunteerDict['email'])
+
+        now = timezone.now()
+        self.past_ids = []
+        # Two events share a start time so the id breaks the tie
+        for days in [1, 2, 2, 3, -1]:
+            start = now - timedelta(days=days)
+            event = Event.objects.create(start_time=start, end_time=start, date=start.date(), title="Day %d" % days,
+                                         location="IU", description="History", organization=organization)
+            event.volunteers.add(volunteer)
+            if days > 0:
+                self.past_ids.append(event.id)
+        # Newest first, ties broken by the larger id
+        self.past_ids = [self.past_ids[0], self.past_ids[2], self.past_ids[1], self.past_ids[3]]
+
+    def page_through(self, path, token):
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + token})
+        ids = []
+        params = {'limit': 2}
+        while True:
+            response = client.get(path, params=params)
+            self.assertEqual(response.status_code, 200)
+            content = json.loads(response.content)
+            ids.extend(event['id'] for event in content['events'])
+            if content['next'] is None:
+                return ids
+            params['cursor'] = content['next']
+
+    def test_organization_past_events(self):
+        ids = self.page_through("http://testserver/api/organization/events/past/", self.organization_token)
+        self.assertListEqual(ids, self.past_ids)
+
+    def test_volunteer_past_events(self):
+        ids = self.page_through("http://testserver/api/volunteer/events/past/", self.volunteer_token)
+        self.assertListEqual(ids, self.past_ids)
+
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.volunteer_token})
+        response = client.get("http://testserver/api/volunteer/events/past/", params={'limit': 'all'})
+        self.assertEqual(response.status_code, 400)
+
+
+@synchronous_dispatch
+class CalendarFeedTest(TestCase, Utilities):
+    tomorrow = timezone.now() + timedelta(days=1)
+
+    volunteerDict = {
+        "email": "calendarvolunteer@gmail.com",
+        "password": "testpassword2",
+        "first_name": "Calendar",
+        "last_name": "Volunteer",
+        "phone_number": "765-426-3681",
+        "birthday": "1998-06-12"
+    }
+
+    organizationDict = {
+        "email": "calendarorg@gmail.com",
+        "password": "testpassword123",
+        "name": "Calendar Org",
+        "street_address": "1 IU st",
+        "city": "Bloomington",
+        "state": "Indiana",
+        "phone_number": "765-426-3682",
+        "organization_motto": "The motto"
+    }
+
+    def setUp(self):
+        cache.clear()
+        self.volunteer_signup(self.volunteerDict)
+        self.volunteer_token = self.volunteer_login(self.volunteerDict)['access']
+        self.organization_signup(self.organizationDict)
+        organization = Organization.objects.get(name="Calendar Org")
+        self.events = [Event.objects.create(start_time=self.tomorrow, end_time=self.tomorrow + timedelta(hours=1),
+                                            date=self.tomorrow.date(), title="Park cleanup, day %d" % i,
+                                            location="IU", description="Bring gloves", organization=organization)
+                       for i in range(2)]
+        self.volunteer_signup_for_event(self.volunteer_token, self.events[0].id)
+
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.volunteer_token})
+        response = client.get("http://testserver/api/calendar/")
+        self.assertEqual(response.status_code, 200)
+        self.feed = json.loads(response.content)['feed']
+
+    def test_feed(self):
+        response = RequestsClient().get(self.feed)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'text/calendar; charset=utf-8')
+        body = response.content.decode('utf-8')
+        self.assertTrue(body.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertEqual(body.count('BEGIN:VEVENT'), 1)
+        self.assertIn('SUMMARY:Park cleanup\\, day 0\r\n', body)
+        self.assertIn('UID:event-%d@voluntyr' % self.events[0].id, body)
+
+    def test_etag_and_invalidation(self):
+        client = RequestsClient()
+        etag = client.get(self.feed).headers['ETag']
+
+        with self.assertNumQueries(0):
+            response = client.get(self.feed, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        with self.assertNumQueries(0):
+            response = client.get(self.feed)
+        self.assertEqual(response.content.decode('utf-8').count('BEGIN:VEVENT'), 1)
+
+        self.volunteer_signup_for_event(self.volunteer_token, self.events[1].id)
+        response = client.get(self.feed, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode('utf-8').count('BEGIN:VEVENT'), 2)
+
+        etag = response.headers['ETag']
+        self.events[1].title = "Renamed"
+        self.events[1].save(update_fields=['title'])
+        response = client.get(self.feed, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('SUMMARY:Renamed', response.content.decode('utf-8'))
+
+    def test_organization_rename(self):
+        client = RequestsClient()
+        etag = client.get(self.feed).headers['ETag']
+        organization = Organization.objects.get(name="Calendar Org")
+        organization.name = "Renamed Org"
+        organization.save()
+
+        response = client.get(self.feed, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Organized by Renamed Org', response.content.decode('utf-8'))
+
+    def test_bad_token(self):
+        response = RequestsClient().get(self.feed[:-3] + "0/")
+        self.assertEqual(response.status_code, 400)
+        invite = URLToken(data={"event_id": 1, "org_id": 1}).get_token()
+        response = RequestsClient().get("http://testserver/api/calendar/%s/" % invite)
+        self.assertEqual(response.status_code, 400)
+
+
+class EventSeriesTest(TestCase, Utilities):
+    organizationDict = {
+        "email": "seriesorg@gmail.com",
+        "password": "testpassword123",
+        "name": "Series Org",
+        "street_address": "1 IU st",
+        "city": "Bloomington",
+        "state": "Indiana",
+        "phone_number": "765-426-3682",
+        "organization_motto": "The motto"
+    }
+
+    def setUp(self):
+        self.organization_signup(self.organizationDict)
+        self.token = self.organization_login(self.organizationDict)['access']
+        self.start = (timezone.now() + timedelta(days=1)).replace(microsecond=0)
+        self.seriesDict = {
+            "title": "Weekly cleanup",
+            "location": "IU",
+            "description": "Every week",
+            "start_time": self.start.isoformat(),
+            "end_time": (self.start + timedelta(hours=2)).isoformat(),
+            "frequency": "weekly",
+            "count": 3
+        }
+
+    def new_series(self, series_dict, expected=201):
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.token})
+        response = client.post("http://testserver/api/organization/series/", json=series_dict)
+        self.assertEqual(response.status_code, expected, response.content)
+        return json.loads(response.content)
+
+    def test_weekly_series(self):
+        content = self.new_series(self.seriesDict)
+        self.assertEqual(content['events'], 3)
+
+        events = list(Event.objects.filter(series_id=content['series']).order_by('start_time'))
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[1].start_time - events[0].start_time, timedelta(weeks=1))
+        self.assertEqual(events[2].end_time - events[2].start_time, timedelta(hours=2))
+        organization = Organization.objects.get(name="Series Org")
+        self.assertEqual(Membership.objects.filter(room__event__in=events, end_user_id=organization.end_user_id)
+                         .count(), 3)
+
+    def test_constant_queries(self):
+        with CaptureQueriesContext(connection) as small:
+            self.new_series(self.seriesDict)
+        self.seriesDict['count'] = 40
+        with CaptureQueriesContext(connection) as large:
+            self.new_series(self.seriesDict)
+        self.assertEqual(len(small), len(large))
+
+    def test_monthly_occurrences_clamp_day(self):
+        start = timezone.make_aware(datetime(2021, 1, 31, 17, 0))
+        series = EventSeries(start_time=start, end_time=start + timedelta(hours=1), frequency=EventSeries.MONTHLY,
+                             count=3)
+        self.assertListEqual([occurrence.date() for occurrence, _ in series.get_occurrences()],
+                             [datetime(2021, 1, 31).date(), datetime(2021, 2, 28).date(), datetime(2021, 3, 31).date()])
+
+        series.count = None
+        series.until = start + timedelta(days=40)
+        self.assertEqual(len(series.get_occurrences()), 2)
+
+    def test_invalid_series(self):
+        self.seriesDict['frequency'] = 'yearly'
+        self.assertDictEqual(self.new_series(self.seriesDict, 400),
+                             {"Error": "Frequency must be daily, weekly or monthly"})
+        self.seriesDict['frequency'] = 'daily'
+        del self.seriesDict['count']
+        self.assertDictEqual(self.new_series(self.seriesDict, 400), {"Error": "Series needs a count or an until date"})
+        self.seriesDict['start_time'] = 'tomorrow'
+        self.assertDictEqual(self.new_series(self.seriesDict, 400), {"Error": "Event series information is invalid"})
+
+    def test_series_out_of_range(self):
+        self.seriesDict['interval'] = 3000000
+        self.assertDictEqual(self.new_series(self.seriesDict, 400),
+                             {"Error": "Interval must be between 1 and %d" % EventSeries.MAX_INTERVAL})
+        self.seriesDict.update(frequency='monthly', interval=EventSeries.MAX_INTERVAL,
+                               count=EventSeries.MAX_OCCURRENCES)
+        self.assertDictEqual(self.new_series(self.seriesDict, 400),
+                             {"Error": "Series runs past the last supported date"})
+
+        self.seriesDict.update(interval=1, count=None, until=(self.start - timedelta(days=1)).isoformat())
+        self.assertDictEqual(self.new_series(self.seriesDict, 400),
+                             {"Error": "Series can't end before its first event"})
+        self.assertFalse(EventSeries.objects.exists())
+
+    def test_until_past_max_occurrences(self):
+        del self.seriesDict['count']
+        self.seriesDict['frequency'] = 'daily'
+        self.seriesDict['until'] = (self.start + timedelta(days=EventSeries.MAX_OCCURRENCES)).isoformat()
+        self.assertDictEqual(self.new_series(self.seriesDict, 400),
+                             {"Error": "Until allows more than %d events" % EventSeries.MAX_OCCURRENCES})
+        self.assertFalse(EventSeries.objects.exists())
+
+        self.seriesDict['until'] = (self.start + timedelta(days=EventSeries.MAX_OCCURRENCES - 1)).isoformat()
+        self.assertEqual(self.new_series(self.seriesDict)['events'], EventSeries.MAX_OCCURRENCES)
+
+    def test_invalid_capacity(self):
+        for capacity in (0, -1, "5"):
+            self.seriesDict['capacity'] = capacity
+            self.assertDictEqual(self.new_series(self.seriesDict, 400),
+                                 {"Error": "Capacity must be a positive integer or null"})
+        self.assertFalse(EventSeries.objects.exists())
+        self.seriesDict['capacity'] = 5
+        content = self.new_series(self.seriesDict)
+        self.assertSetEqual(set(Event.objects.filter(series_id=content['series']).values_list('capacity', flat=True)),
+                            {5})
+
+
+class EventImportTest(TestCase, Utilities):
+    organizationDict = {
+        "email": "importorg@gmail.com",
+        "password": "testpassword123",
+        "name": "Import Org",
+        "street_address": "1 IU st",
+        "city": "Bloomington",
+        "state": "Indiana",
+        "phone_number": "765-426-3682",
+        "organization_motto": "The motto"
+    }
+
+    def setUp(self):
+        self.organization_signup(self.organizationDict)
+        self.token = self.organization_login(self.organizationDict)['access']
+        self.organization = Organization.objects.get(name="Import Org")
+        self.start = (timezone.now() + timedelta(days=1)).replace(microsecond=0)
+
+    def csv_text(self, rows):
+        lines = ['title,location,description,start_time,end_time,capacity']
+        for title, hours, capacity in rows:
+            lines.append('%s,IU,"Imported, event",%s,%s,%s' % (title, self.start.isoformat(),
+                                                                (self.start + timedelta(hours=hours)).isoformat(),
+                                                                capacity))
+        return '\n'.join(lines) + '\n'
+
+    def upload(self, text, expected=200):
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.token})
+        response = client.post("http://testserver/api/organization/events/import/",
+                               files={'file': ('events.csv', text)})
+        self.assertEqual(response.status_code, expected, response.content)
+        return json.loads(response.content)
+
+    def test_import(self):
+        report = self.upload(self.csv_text([("First", 2, 10), ("Second", 3, "")]))
+        self.assertDictEqual(report, {"created": 2, "failed": 0, "errors": []})
+
+        events = list(Event.objects.filter(organization=self.organization).order_by('title'))
+        self.assertListEqual([(event.title, event.description, event.capacity) for event in events],
+                             [("First", "Imported, event", 10), ("Second", "Imported, event", None)])
+        self.assertEqual(Membership.objects.filter(room__event__in=events,
+                                                   end_user_id=self.organization.end_user_id).count(), 2)
+
+    def test_invalid_rows_are_reported(self):
+        text = self.csv_text([("Good", 2, 5), ("Backwards", -1, 5), ("Full", 1, "many"), ("x" * 101, 1, "")])
+        report = self.upload(text)
+        self.assertEqual(report['created'], 1)
+        self.assertEqual(report['failed'], 3)
+        self.assertListEqual([(error['row'], sorted(error['errors'])) for error in report['errors']],
+                             [(3, ['end_time']), (4, ['capacity']), (5, ['title'])])
+        self.assertTrue(Event.objects.filter(title="Good").exists())
+
+    def test_non_positive_capacity(self):
+        report = self.upload(self.csv_text([("Negative", 1, -3), ("Zero", 1, 0), ("One", 1, 1)]))
+        self.assertEqual(report['created'], 1)
+        self.assertListEqual([(error['row'], sorted(error['errors'])) for error in report['errors']],
+                             [(2, ['capacity']), (3, ['capacity'])])
+
+    def test_oversized_field_is_reported(self):
+        text = self.csv_text([("Before", 1, "")]) + 'Huge,IU,"%s",x,x,\n' % ('x' * (csv.field_size_limit() + 1)) + \
+            self.csv_text([("After", 1, "")]).split('\n', 1)[1]
+        report = self.upload(text)
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(report['failed'], 1)
+        self.assertListEqual(list(report['errors'][0]['errors']), ['row'])
+        titles = Event.objects.filter(organization=self.organization).values_list('title', flat=True)
+        self.assertListEqual(sorted(titles), ["After", "Before"])
+
+    def test_bad_encoding_imports_nothing(self):
+        text = self.csv_text([("Row %d" % i, 1, "") for i in range(CHUNK_SIZE + 1)] + [("Caf\xe9", 1, "")])
+        self.assertDictEqual(self.upload(text.encode('latin-1'), 400), {"Error": "File must be UTF-8 encoded CSV"})
+        self.assertFalse(Event.objects.filter(organization=self.organization).exists())
+
+    def test_missing_columns(self):
+        self.assertDictEqual(self.upload("title,location\nA,B\n", 400),
+                             {"Error": "CSV is missing columns: description, start_time, end_time"})
+        self.assertDictEqual(self.upload("", 400),
+                             {"Error": "CSV is missing columns: title, location, description, start_time, end_time"})
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_file:
+            csv_file.write(self.csv_text([("One", 1, ""), ("Two", 1, ""), ("Three", 0, "-")]))
+        self.addCleanup(os.remove, csv_file.name)
+
+        out, err = StringIO(), StringIO()
+        call_command('import_events', str(self.organization.id), csv_file.name, '--chunk-size', '1', stdout=out,
+                     stderr=err)
+        self.assertIn('Imported 2 events, 1 rows failed', out.getvalue())
+        self.assertIn('Row 4: capacity', err.getvalue())
+        self.assertEqual(Event.objects.filter(organization=self.organization).count(), 2)
+
+
+class DeferredDispatcherTest(TransactionTestCase):
+    def test_runs_after_commit_on_worker_thread(self):
+        deferred = DeferredDispatcher(max_workers=2, synchronous=False)
+        threads = []
+        with transaction.atomic():
+            deferred.submit('record', lambda: threads.append(threading.current_thread()))
+            self.assertListEqual(threads, [], "Ran before the transaction committed.")
+        deferred.flush(timeout=5)
+
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+        self.assertEqual(deferred.get_metrics()['record']['calls'], 1)
+
+    def test_discarded_on_rollback(self):
+        deferred = DeferredDispatcher(max_workers=2, synchronous=False)
+        calls = []
+        try:
+            with transaction.atomic():
+                deferred.submit('record', lambda: calls.append(1))
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        deferred.flush(timeout=5)
+        self.assertListEqual(calls, [])
+
+    def test_errors_are_counted(self):
+        deferred = DeferredDispatcher(max_workers=2, synchronous=False)
+        with self.assertLogs('api.dispatch', level='ERROR'):
+            deferred.submit('fail', lambda: 1 / 0)
+            deferred.flush(timeout=5)
+        self.assertEqual(deferred.get_metrics()['fail']['errors'], 1)
+
+        deferred.synchronous = True
+        with self.assertRaises(ZeroDivisionError):
+            deferred.submit('fail', lambda: 1 / 0)
+        self.assertEqual(deferred.get_metrics()['fail']['calls'], 2)
+
+    def test_delete_on_commit(self):
+        with transaction.atomic():
+            cache.set('dispatch-test', 1)
+            delete_on_commit(['dispatch-test'])
+            self.assertIsNone(cache.get('dispatch-test'))
+            # Another request caches what it read before the commit
+            cache.set('dispatch-test', 1)
+        self.assertIsNone(cache.get('dispatch-test'))
+
+
+@synchronous_dispatch
+class SignupBenchmarkCommandTest(TransactionTestCase):
+    def test_no_oversubscription(self):
+        out = StringIO()
+        call_command('benchmark_signups', volunteers=12, capacity=5, threads=4, stdout=out)
+        self.assertIn('No oversubscription', out.getvalue())
+        self.assertFalse(Event.objects.exists())
+        self.assertFalse(EndUser.objects.exists())
+
+
+class EventRecommendationTest(TestCase):
+    """
+    Tests the precomputed event suggestions sent after a volunteer registers for an event
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.organizations = []
+        for i in range(2):
+            end_user = EndUser.objects.create_user('recommendorg%d@gmail.com' % i, 'testpassword123', '209891210')
+            self.organizations.append(Organization.objects.create(end_user=end_user, name='Org %d' % i,
+                                                                  street_address='1 IU st', city='Bloomington',
+                                                                  state='Indiana', phone_number='765-426-3690'))
+        end_user = EndUser.objects.create_user('recommendvolunteer@gmail.com', 'testpassword2', '209891210')
+        self.volunteer = Volunteer.objects.create(end_user=end_user, first_name='new', last_name='volunteer',
+                                                  phone_number='765-426-3691')
+
+        self.events = []
+        for day, organization in [(1, 0), (2, 1), (3, 0), (4, 1), (5, 0)]:
+            start = timezone.now() + timedelta(days=day)
+            self.events.append(Event.objects.create(start_time=start, end_time=start + timedelta(hours=1),
+                                                    date=start.date(), title='Event %d' % day, location='IU',
+                                                    description='Test event',
+                                                    organization=self.organizations[organization]))
+        Event.objects.create(start_time=timezone.now() - timedelta(days=1), end_time=timezone.now(),
+                             date=timezone.now().date(), title='Past event', location='IU',
+                             description='Test event', organization=self.organizations[0])
+
+    def test_same_organization_first(self):
+        suggestions = recommender.suggest(self.volunteer.id, self.organizations[0].id)
+        self.assertEqual([e.id for e in suggestions], [self.events[0].id, self.events[2].id, self.events[4].id])
+
+    def test_fills_from_other_organizations(self):
+        self.register(self.events[0])
+        self.register(self.events[2])
+        suggestions = recommender.suggest(self.volunteer.id, self.organizations[0].id)
+        self.assertEqual([e.id for e in suggestions], [self.events[4].id, self.events[1].id, self.events[3].id])
+
+    def test_constant_queries(self):
+        recommender.suggest(self.volunteer.id, self.organizations[0].id)
+        self.register(self.events[4])
+        # The registration dropped the registered set, which the next suggestion rebuilds once
+        with self.assertNumQueries(2):
+            suggestions = recommender.suggest(self.volunteer.id, self.organizations[0].id)
+        self.assertNotIn(self.events[4].id, [e.id for e in suggestions])
+        with self.assertNumQueries(1):
+            recommender.suggest(self.volunteer.id, self.organizations[0].id)
+
+    def test_new_event_invalidates_candidates(self):
+        recommender.suggest(self.volunteer.id, self.organizations[1].id)
+        start = timezone.now() + timedelta(hours=1)
+        event = Event.objects.create(start_time=start, end_time=start + timedelta(hours=1), date=start.date(),
+                                     title='New event', location='IU', description='Test event',
+                                     organization=self.organizations[1])
+        suggestions = recommender.suggest(self.volunteer.id, self.organizations[1].id)
+        self.assertEqual(suggestions[0].id, event.id)
+
+    def register(self, event):
+        event.volunteers.add(self.volunteer.id)
+        signal_volunteer_event_registration.send(Volunteer, vol_id=self.volunteer.id, event_id=event.id,
+                                                 volunteer=self.volunteer, attending=True)
+
+
+class CollaborativeRecommendationTest(TestCase, Utilities):
+    """
+    Tests the co-attendance based "events you may like" endpoint
+    """
+    volunteerDict = {
+        "email": "testemail40@gmail.com",
+        "password": "testpassword2",
+        "first_name": "newuser",
+        "last_name": "volunteer",
+        "phone_number": "765-426-3692",
+        "birthday": "1998-06-12"
+    }
+
+    organizationDict = {
+        "email": "testorgemail40@gmail.com",
+        "password": "testpassword123",
+        "name": "testOrg1",
+        "street_address": "1 IU st",
+        "city": "Bloomington",
+        "state": "Indiana",
+        "phone_number": "765-426-3693",
+        "organization_motto": "The motto"
+    }
+
+    def setUp(self):
+        self.volunteer_signup(self.volunteerDict)
+        self.volunteerTokens = self.volunteer_login(self.volunteerDict)
+        self.organization_signup(self.organizationDict)
+        organization = Organization.objects.get(name=self.organizationDict['name'])
+        self.volunteer = Volunteer.objects.get(end_user__email=self.volunteerDict['email'])
+
+        end_user = EndUser.objects.create_user('testemail41@gmail.com', 'testpassword2', '209891210')
+        self.peer = Volunteer.objects.create(end_user=end_user, first_name='peer', last_name='volunteer',
+                                             phone_number='765-426-3694')
+
+        self.events = []
+        for day in [-2, 1, 2]:
+            start = timezone.now() + timedelta(days=day)
+            self.events.append(Event.objects.create(start_time=start, end_time=start + timedelta(hours=1),
+                                                    date=start.date(), title='Event %d' % day, location='IU',
+                                                    description='Test event', organization=organization))
+        past, liked, other = self.events
+        past.volunteers.add(self.volunteer, self.peer)
+        liked.volunteers.add(self.peer)
+
+    def test_recommended_events(self):
+        call_command('build_event_recommendations', stdout=StringIO())
+
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.volunteerTokens['access']})
+        response = client.get("http://testserver/api/volunteer/events/recommended/")
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual([event['id'] for event in content], [self.events[1].id])
+
+        self.events[1].volunteers.add(self.volunteer)
+        response = client.get("http://testserver/api/volunteer/events/recommended/")
+        self.assertEqual(json.loads(response.content), [])
+
+    def test_no_recommendations_before_build(self):
+        client = RequestsClient()
+        client.headers.update({'Authorization': 'Bearer ' + self.volunteerTokens['access']})
+        response = client.get("http://testserver/api/volunteer/events/recommended/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), [])
+
+
 class OrganizationDashboardTest(TestCase):
 
     def test_organization_account_info(self):
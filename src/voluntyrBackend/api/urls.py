@@ -7,7 +7,10 @@ from .views import OrganizationSignupAPIView, VolunteerSignupAPIView, \
     OrganizationEmailVolunteers, CheckSignupAPIView, EventVolunteers, EventDetailAPIView, \
     OrganizationEventUpdateAPIView, VolunteerOrganizationAPIView, VolunteerEventAPIView, InviteVolunteersAPIView, \
     InviteAPIView, EventAPIView, ObtainDualAuthView, VolunteerUnratedEventsAPIView, RateEventAPIView, \
-    RecoverPasswordView, ResetPasswordView, ObtainSocialTokenPairView
+    RecoverPasswordView, ResetPasswordView, ObtainSocialTokenPairView, VolunteerRecommendedEventsAPIView, \
+    EventRatingsAPIView, VolunteerEventsSignupAPIView, CheckSignupsAPIView, OrganizationStatisticsAPIView, \
+    EventRosterAPIView, VolunteerPastEventsAPIView, OrganizationPastEventsAPIView, CalendarFeedLinkAPIView, \
+    CalendarFeedAPIView, OrganizationEventSeriesAPIView, OrganizationEventImportAPIView
 
 from .urlTokens.converter import TokenConverter
 
@@ -26,20 +29,32 @@ urlpatterns = [
     path('volunteer/', VolunteerAPIView.as_view()),
     path('volunteer/events/', VolunteerEventsAPIView.as_view()),
     path('volunteer/events/unrated/', VolunteerUnratedEventsAPIView.as_view()),
+    path('volunteer/events/past/', VolunteerPastEventsAPIView.as_view()),
+    path('volunteer/events/recommended/', VolunteerRecommendedEventsAPIView.as_view()),
+    path('volunteer/events/signup/', VolunteerEventsSignupAPIView.as_view()),
     path('volunteer/event/<int:event_id>/', VolunteerEventAPIView.as_view()),
     path('organization/', OrganizationAPIView.as_view()),
     path('organization/<int:org_id>/', VolunteerOrganizationAPIView.as_view()),
     path('organization/events/', OrganizationEventsAPIView.as_view()),
+    path('organization/events/past/', OrganizationPastEventsAPIView.as_view()),
+    path('organization/stats/', OrganizationStatisticsAPIView.as_view()),
     path('organization/event/', OrganizationEventAPIView().as_view()),
+    path('organization/series/', OrganizationEventSeriesAPIView.as_view()),
+    path('organization/events/import/', OrganizationEventImportAPIView.as_view()),
     path('events/', SearchEventsAPIView.as_view()),
     path('event/<int:event_id>/volunteer/', VolunteerEventSignupAPIView.as_view()),
     path('event/<int:event_id>/email/', OrganizationEmailVolunteers.as_view()),
     path('event/<int:event_id>/', EventAPIView.as_view()),
     path('event/<int:event_id>/rate/', RateEventAPIView.as_view()),
+    path('event/<int:event_id>/ratings/', EventRatingsAPIView.as_view()),
     path('event/<int:event_id>/check/', CheckSignupAPIView.as_view()),
+    path('events/check/', CheckSignupsAPIView.as_view()),
     path('event/<int:event_id>/volunteers/', EventVolunteers.as_view()),
+    path('event/<int:event_id>/roster/', EventRosterAPIView.as_view()),
     path('event/<int:event_id>/invite/', InviteVolunteersAPIView.as_view()),
     path('invite/<url_token:invite_code>/', InviteAPIView.as_view()),
+    path('calendar/', CalendarFeedLinkAPIView.as_view()),
+    path('calendar/<url_token:feed_token>/', CalendarFeedAPIView.as_view()),
     path('organization/event/<int:event_id>/', EventDetailAPIView.as_view()),
     path('organization/updateEvent/', OrganizationEventUpdateAPIView.as_view()),
 ]
@@ -1,3 +1,4 @@
+import codecs
 import json
 import sys
 import time
@@ -5,19 +6,30 @@ import math
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import send_mass_mail, send_mail
+from django.core.mail import send_mail
 from django.db import IntegrityError
 from django.db.models import Q
-from django.http import HttpRequest
+from django.http import HttpRequest, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from django.utils import timezone
-from api.signals import signal_volunteer_event_registration
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import generics, status
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.views import TokenObtainPairView
 from authy.api import AuthyApiClient
 
-from .models import Event, Organization, Volunteer, EndUser, Rating
+from .calendars import calendar_feeds
+from .events import create_series, is_valid_capacity, update_event, EventUpdateError
+from .imports import import_events, is_utf8, EventImportError
+from .mailing import send_event_mass_mail
+from .models import Event, Organization, Volunteer, EndUser, Rating, EventRecommendation, EventRatingAggregate, \
+    EventVolunteer, EventSeries
+from .pagination import KeysetPaginator, InvalidCursor
+from .pages import organization_pages
+from .ratings import record_rating
+from . import registration
+from .statistics import organization_statistics
 from .serializers import EventsSerializer, ObtainTokenPairSerializer, OrganizationSerializer, VolunteerSerializer, \
     EndUserSerializer, OrganizationEventSerializer, VolunteerOrganizationSerializer, \
     SearchEventsSerializer, ObtainDualAuthSerializer, ObtainSocialTokenPairSerializer
@@ -270,6 +282,24 @@ class OrganizationEventsAPIView(generics.ListAPIView):
         return AuthCheck.unauthorized_response()
 
 
+class OrganizationStatisticsAPIView(generics.RetrieveAPIView, AuthCheck):
+    """
+    Class view for organizations to get dashboard statistics over all their events
+    """
+
+    def retrieve(self, req, *args, **kwargs):
+        """
+        Returns signup counts, fill rates, attendance and rating summaries for each of the organization's events, and
+        totals over all of them
+        :param req: Request
+        :return: 200 with {"summary": {...}, "events": [...]}, 401 if the token is not an organization's
+        """
+        if AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Organization']):
+            org_id = Organization.objects.values_list('id', flat=True).get(end_user_id=AuthCheck.get_user_id(req))
+            return Response(data=organization_statistics(org_id), status=status.HTTP_200_OK)
+        return AuthCheck.unauthorized_response()
+
+
 class OrganizationAPIView(generics.RetrieveAPIView):
     serializer_class = OrganizationSerializer
 
@@ -359,6 +389,54 @@ class VolunteerEventsAPIView(generics.ListAPIView, AuthCheck):
             return AuthCheck.unauthorized_response()
 
 
+class PastEventsAPIView(generics.ListAPIView, AuthCheck):
+    """
+    Base class view for paging backwards through past events, newest first. Subclasses set scope and get_queryset.
+    """
+    serializer_class = SearchEventsSerializer
+    keyset_paginator = KeysetPaginator('start_time', descending=True)
+    scope = None
+
+    def list(self, req, *args, **kwargs):
+        """
+        Returns one page of past events. Takes optional query parameters:
+            cursor: The "next" value of the previous page
+            limit: Page size, 50 by default and at most 200
+        :param req: Request
+        :return: 200 with {"next": <cursor or null>, "events": [...]}, 400 if the cursor is malformed
+        """
+        if AuthCheck.is_authorized(req, settings.SCOPE_TYPES[self.scope]):
+            events = self.get_queryset().filter(start_time__lt=timezone.now()).select_related('organization')
+            try:
+                page, cursor = self.keyset_paginator.paginate(events, req.query_params.get('cursor'),
+                                                       req.query_params.get('limit'))
+            except InvalidCursor:
+                return Response(data={"Error": "Invalid cursor or limit."}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(data={"next": cursor, "events": self.get_serializer(page, many=True).data},
+                            status=status.HTTP_200_OK)
+        return AuthCheck.unauthorized_response()
+
+
+class VolunteerPastEventsAPIView(PastEventsAPIView):
+    """
+    Class View for past events which a volunteer signed up for
+    """
+    scope = 'Volunteer'
+
+    def get_queryset(self):
+        return Event.objects.filter(volunteers__end_user_id=AuthCheck.get_user_id(self.request))
+
+
+class OrganizationPastEventsAPIView(PastEventsAPIView):
+    """
+    Class View for past events run by the organization in the requesting JWT
+    """
+    scope = 'Organization'
+
+    def get_queryset(self):
+        return Event.objects.filter(organization__end_user_id=AuthCheck.get_user_id(self.request))
+
+
 class VolunteerUnratedEventsAPIView(generics.ListAPIView, AuthCheck):
     """
     Class View for past events which a volunteer has signed up for and have not been rated
@@ -380,6 +458,30 @@ class VolunteerUnratedEventsAPIView(generics.ListAPIView, AuthCheck):
             return AuthCheck.unauthorized_response()
 
 
+class VolunteerRecommendedEventsAPIView(generics.ListAPIView, AuthCheck):
+    """
+    Class View for upcoming events liked by volunteers who joined the same events as the requesting volunteer.
+    Reads the lists precomputed by the build_event_recommendations management command.
+    """
+    serializer_class = SearchEventsSerializer
+
+    def get_queryset(self):
+        req = self.request
+        user_id = AuthCheck.get_user_id(req)
+        volunteer = Volunteer.objects.get(end_user_id=user_id)
+        # The lists are built in batches, so leave out events the volunteer registered for since the last build
+        recommended = EventRecommendation.objects.filter(volunteer=volunteer, event__start_time__gte=timezone.now()) \
+            .exclude(event__volunteers=volunteer)
+        return [recommendation.event for recommendation in
+                recommended.select_related('event__organization').order_by('-score')]
+
+    def list(self, req, *args, **kwargs):
+        if AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Volunteer']):
+            return super().list(req, *args, **kwargs)
+        else:
+            return AuthCheck.unauthorized_response()
+
+
 class OrganizationSignupAPIView(generics.CreateAPIView):
     """
     Class View for new organization signups.
@@ -544,18 +646,10 @@ class RateEventAPIView(generics.GenericAPIView, AuthCheck):
                                 , status=status.HTTP_400_BAD_REQUEST)
             body = json.loads(str(req.body, encoding='utf-8'))
             rating = int(body['rating'])
-            if volunteer in event.volunteers.all():
+            if Event.volunteers.through.objects.filter(event_id=event.id, volunteer_id=volunteer.id).exists():
                 if 0 < rating < 6:
                     if event.end_time < timezone.now():
-                        if Rating.objects.filter(volunteer=volunteer, event__id=event.id).count() == 0:
-                            organization = event.organization
-                            new_rating = ((organization.rating * organization.raters) + rating) / (
-                                    organization.raters + 1)
-                            organization.raters += 1
-                            organization.rating = round(new_rating, 2)
-                            organization.save()
-
-                            Rating.objects.create(event=event, volunteer=volunteer, rating=rating)
+                        if record_rating(event, volunteer, rating):
                             return Response(data={"Result": "Rating accepted"}, status=status.HTTP_202_ACCEPTED)
                         else:
                             return Response(data={"Error": "This volunteer has already rated this event"},
@@ -574,6 +668,34 @@ class RateEventAPIView(generics.GenericAPIView, AuthCheck):
         return AuthCheck.unauthorized_response()
 
 
+class EventRatingsAPIView(generics.RetrieveAPIView, AuthCheck):
+    """
+    Class View for the average, count and star histogram of an event's ratings
+    """
+
+    def get_object(self):
+        return Event.objects.select_related('rating_aggregate').get(id=self.kwargs['event_id'])
+
+    def retrieve(self, req, *args, **kwargs):
+        """
+        GET endpoint for volunteers and organizations
+        :return: 200 with the event's rating summary, 400 if the event doesn't exist
+        """
+        if AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Volunteer']) or \
+                AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Organization']):
+            try:
+                event = self.get_object()
+            except ObjectDoesNotExist:
+                return Response(data={"Error": "Given event ID does not exist."}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                aggregate = event.rating_aggregate
+            except EventRatingAggregate.DoesNotExist:
+                aggregate = EventRatingAggregate(event=event)
+            return Response(data=aggregate.get_summary(), status=status.HTTP_200_OK)
+
+        return AuthCheck.unauthorized_response()
+
+
 class VolunteerEventSignupAPIView(generics.GenericAPIView, AuthCheck):
     """
     Class view for volunteers to signup for events
@@ -585,32 +707,86 @@ class VolunteerEventSignupAPIView(generics.GenericAPIView, AuthCheck):
 
     def put(self, req, *args, **kwargs):
         """
-        Endpoint to add or removed a volunteer to an event
+        Endpoint to add or removed a volunteer to an event. Toggles the volunteer's registration unless the body has
+        an "attending" key, in which case the volunteer is registered if it is true and withdrawn if it is false.
+        Volunteers registering for a full event are put on its waitlist.
         :param req: Request
         :return:    Returns status 400 if the event doesn't exist,
-                    or status 202 if the volunteer was successfully signed up.
+                    or status 202 if the volunteer was successfully signed up, waitlisted or removed.
         """
         if AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Volunteer']):
             user_id = AuthCheck.get_user_id(req)
-            volunteer = Volunteer.objects.get(end_user_id=user_id)
-            vol_id = volunteer.id
+            volunteer = Volunteer.objects.select_related('end_user').get(end_user_id=user_id)
+            event_id = self.kwargs['event_id']
 
-            try:
-                current_event = self.get_object()
-            except ObjectDoesNotExist:
+            if not Event.objects.filter(id=event_id).exists():
                 return Response(data={"Error": "Given event ID does not exist."}, status=status.HTTP_400_BAD_REQUEST)
-            if volunteer in current_event.volunteers.all():
-                current_event.volunteers.remove(vol_id)
-                signal_volunteer_event_registration.send(Volunteer, vol_id=vol_id, event_id=self.kwargs['event_id'],
-                                                         volunteer=volunteer, attending=False)
-                return Response(data={"Success": "Volunteer has been removed from event %s" % self.kwargs['event_id']},
-                                status=status.HTTP_202_ACCEPTED)
+
+            body = json.loads(str(req.body, encoding='utf-8')) if req.body else {}
+            if 'attending' not in body:
+                outcome = registration.toggle(event_id, volunteer)
+            elif body['attending']:
+                outcome = registration.register(event_id, volunteer)
+            else:
+                outcome = registration.withdraw(event_id, volunteer)
+
+            if outcome == registration.REGISTERED:
+                message = "Volunteer has signed up for event %s" % event_id
+            elif outcome == registration.WAITLISTED:
+                message = "Volunteer has been added to the waitlist for event %s" % event_id
+            elif outcome == registration.LEFT_WAITLIST:
+                message = "Volunteer has been removed from the waitlist for event %s" % event_id
+            else:
+                message = "Volunteer has been removed from event %s" % event_id
+            return Response(data={"Success": message}, status=status.HTTP_202_ACCEPTED)
+
+        return AuthCheck.unauthorized_response()
+
+
+class VolunteerEventsSignupAPIView(generics.GenericAPIView, AuthCheck):
+    """
+    Class view for volunteers to signup for, or withdraw from, many events at once
+    """
+    REGISTER = 'register'
+    WITHDRAW = 'withdraw'
+    MAX_EVENTS = 100
+
+    def put(self, req, *args, **kwargs):
+        """
+        Endpoint to add or remove a volunteer to a list of events.
+        Receives JSON in body: {"event_ids": [1, 2, 3], "action": "register" or "withdraw"}
+        Volunteers registering for a full event are put on its waitlist.
+        :param req: Request
+        :return:    Returns status 400 if the body is malformed or has more than MAX_EVENTS event ids,
+                    or status 202 with the event ids grouped by outcome. Registering returns "registered", "waitlisted"
+                    and "missing" lists, withdrawing returns "withdrawn" and "left_waitlist" lists.
+        """
+        if AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Volunteer']):
+            user_id = AuthCheck.get_user_id(req)
+            volunteer = Volunteer.objects.select_related('end_user').get(end_user_id=user_id)
+
+            try:
+                body = json.loads(str(req.body, encoding='utf-8'))
+                action = body['action']
+                event_ids = body['event_ids']
+            except (ValueError, TypeError, KeyError):
+                event_ids = None
+            if not isinstance(event_ids, list) \
+                    or not all(isinstance(event_id, int) and not isinstance(event_id, bool) for event_id in event_ids):
+                return Response(data={"Error": "Body must contain an action and a list of event_ids."},
+                                status=status.HTTP_400_BAD_REQUEST)
+            if len(event_ids) > self.MAX_EVENTS:
+                return Response(data={"Error": "At most %d events can be changed at once." % self.MAX_EVENTS},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            if action == self.REGISTER:
+                outcomes = registration.register_many(event_ids, volunteer)
+            elif action == self.WITHDRAW:
+                outcomes = registration.withdraw_many(event_ids, volunteer)
             else:
-                current_event.volunteers.add(vol_id)
-                signal_volunteer_event_registration.send(Volunteer, vol_id=vol_id, event_id=self.kwargs['event_id'],
-                                                         volunteer=volunteer, attending=True)
-                return Response(data={"Success": "Volunteer has signed up for event %s" % self.kwargs['event_id']},
-                                status=status.HTTP_202_ACCEPTED)
+                return Response(data={"Error": "Action must be register or withdraw."},
+                                status=status.HTTP_400_BAD_REQUEST)
+            return Response(data=outcomes, status=status.HTTP_202_ACCEPTED)
 
         return AuthCheck.unauthorized_response()
 
@@ -633,10 +809,14 @@ class OrganizationEventAPIView(generics.CreateAPIView):
                 organization = Organization.objects.get(end_user_id=user_id)
                 org_id = organization.id
                 body = json.loads(str(request.body, encoding='utf-8'))
+                if not is_valid_capacity(body.get('capacity')):
+                    return Response(data={"Error": "Capacity must be a positive integer or null"},
+                                    status=status.HTTP_400_BAD_REQUEST)
                 event = Event.objects.create(start_time=body['start_time'], end_time=body['end_time'],
                                              date=body['date'],
                                              title=body['title'], location=body['location'],
                                              description=body['description'],
+                                             capacity=body.get('capacity'),
                                              organization_id=org_id)
 
                 return Response(data={"Success": "Event has been created"},
@@ -648,6 +828,110 @@ class OrganizationEventAPIView(generics.CreateAPIView):
         return AuthCheck.unauthorized_response()
 
 
+class OrganizationEventSeriesAPIView(generics.CreateAPIView, AuthCheck):
+    """
+    Class View for organization to create a recurring event series
+    """
+
+    def create(self, request, *args, **kwargs):
+        """
+        POST endpoint to create a series and all of its events at once.
+        Receives JSON in body with the event fields of the first occurrence (title, location, description, start_time,
+        end_time, optional capacity) and the recurrence rule: frequency ("daily", "weekly" or "monthly"), optional
+        interval (default 1), and count and/or until bounding the series.
+        :return 201 with the series id and number of events created, 400 if the series is invalid
+        """
+        if AuthCheck.is_authorized(request, settings.SCOPE_TYPES['Organization']):
+            organization_id = Organization.objects.values_list('id', flat=True) \
+                .get(end_user_id=AuthCheck.get_user_id(request))
+            try:
+                body = json.loads(str(request.body, encoding='utf-8'))
+                series = EventSeries(organization_id=organization_id, title=body['title'], location=body['location'],
+                                     description=body['description'], capacity=body.get('capacity'),
+                                     start_time=self._parse_time(body['start_time']),
+                                     end_time=self._parse_time(body['end_time']), frequency=body['frequency'],
+                                     interval=int(body.get('interval', 1)), count=body.get('count'),
+                                     until=self._parse_time(body['until']) if body.get('until') else None)
+                if series.count is not None:
+                    series.count = int(series.count)
+            except (KeyError, TypeError, ValueError):
+                return Response(data={"Error": "Event series information is invalid"},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            error = self._validate(series)
+            if error is not None:
+                return Response(data={"Error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+            event_ids = create_series(series)
+            return Response(data={"Success": "Event series has been created", "series": series.id,
+                                  "events": len(event_ids)}, status=status.HTTP_201_CREATED)
+
+        return AuthCheck.unauthorized_response()
+
+    @staticmethod
+    def _parse_time(value):
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError('Invalid date time')
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+    @staticmethod
+    def _validate(series):
+        if series.frequency not in dict(EventSeries.FREQUENCY_CHOICES):
+            return "Frequency must be daily, weekly or monthly"
+        if not 1 <= series.interval <= EventSeries.MAX_INTERVAL:
+            return "Interval must be between 1 and %d" % EventSeries.MAX_INTERVAL
+        if series.end_time < series.start_time:
+            return "Events can't end before they start"
+        if series.count is None and series.until is None:
+            return "Series needs a count or an until date"
+        if series.until is not None and series.until < series.start_time:
+            return "Series can't end before its first event"
+        if series.count is not None and not 1 <= series.count <= EventSeries.MAX_OCCURRENCES:
+            return "Count must be between 1 and %d" % EventSeries.MAX_OCCURRENCES
+        try:
+            if series.exceeds_max_occurrences():
+                return "Until allows more than %d events" % EventSeries.MAX_OCCURRENCES
+            series.get_occurrences()
+        except (OverflowError, ValueError):
+            return "Series runs past the last supported date"
+        if not is_valid_capacity(series.capacity):
+            return "Capacity must be a positive integer or null"
+        return None
+
+
+class OrganizationEventImportAPIView(generics.CreateAPIView, AuthCheck):
+    """
+    Class View for organization to import events from a CSV file
+    """
+
+    def create(self, request, *args, **kwargs):
+        """
+        POST endpoint to import events. Receives a multipart form with the CSV in the "file" field; see
+        api.imports.import_events for its columns. The file is read row by row and valid rows are imported even if
+        others fail. The whole file is checked to be UTF-8 before anything is imported.
+        :return 200 with the number of events created and failed, and the errors of the failed rows,
+                400 if there is no file, it isn't UTF-8 or its header is missing columns
+        """
+        if AuthCheck.is_authorized(request, settings.SCOPE_TYPES['Organization']):
+            organization_id = Organization.objects.values_list('id', flat=True) \
+                .get(end_user_id=AuthCheck.get_user_id(request))
+            upload = request.FILES.get('file')
+            if upload is None:
+                return Response(data={"Error": "No file was uploaded"}, status=status.HTTP_400_BAD_REQUEST)
+            if not is_utf8(upload):
+                return Response(data={"Error": "File must be UTF-8 encoded CSV"}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                report = import_events(organization_id, codecs.iterdecode(upload, 'utf-8-sig'))
+            except EventImportError as e:
+                return Response(data={"Error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(data=report, status=status.HTTP_200_OK)
+
+        return AuthCheck.unauthorized_response()
+
+
 # Refactor: 2 classes below should be refactored into a single class
 class OrganizationEventUpdateAPIView(generics.UpdateAPIView):
     """
@@ -657,36 +941,21 @@ class OrganizationEventUpdateAPIView(generics.UpdateAPIView):
 
     def update(self, request, *args, **kwargs):
         """
-        PUT endpoint to update an existing event
+        PUT and PATCH endpoint to update an existing event. The body has the event's id and any of the editable fields;
+        only fields whose value changed are written, and volunteers are only notified if something changed.
+        :return 201 with the names of the changed fields, 400 if the event doesn't exist or a field is invalid
         """
         if AuthCheck.is_authorized(request, settings.SCOPE_TYPES['Organization']):
+            user_id = AuthCheck.get_user_id(request)
+            org_id = Organization.objects.values_list('id', flat=True).get(end_user_id=user_id)
+            body = request.data
             try:
-                user_id = AuthCheck.get_user_id(request)
-                organization = Organization.objects.get(end_user_id=user_id)
-                org_id = organization.id
-                body = json.loads(str(request.body, encoding='utf-8'))
-                event = Event.objects.get(id=body['id'], organization_id=org_id)
-
-                e = OrganizationEventSerializer(instance=event).data
-                diffs = []
-                for key in body:
-                    if key in e:
-                        if body[key] != e[key]:
-                            diffs.append(key)
-                    else:
-                        diffs.append(key)
-
-                if len(diffs) > 0:
-                    event.start_time = body['start_time']
-                    event.end_time = body['end_time']
-                    event.date = body['date']
-                    event.title = body['title']
-                    event.location = body['location']
-                    event.description = body['description']
-                    event.save(update_fields=diffs)
-                return Response(status=status.HTTP_201_CREATED)
-            except IntegrityError:
-                return Response(status=status.HTTP_400_BAD_REQUEST)
+                changes = update_event(org_id, body['id'], body)
+            except EventUpdateError as e:
+                return Response(data={"Error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            except (KeyError, ValueError, ObjectDoesNotExist):
+                return Response(data={"Error": "Given event ID does not exist."}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(data={"Changed": sorted(changes)}, status=status.HTTP_201_CREATED)
         return AuthCheck.unauthorized_response()
 
 
@@ -736,6 +1005,70 @@ class InviteAPIView(generics.GenericAPIView, AuthCheck):
         return AuthCheck.unauthorized_response()
 
 
+class CalendarFeedLinkAPIView(generics.RetrieveAPIView, AuthCheck):
+    """
+    Class view to get the iCalendar feed url of the requesting volunteer or organization
+    """
+
+    def retrieve(self, req, *args, **kwargs):
+        """
+        Returns a signed url of the requester's calendar feed. Volunteers' feeds have the events they signed up for,
+        organizations' feeds have the events they run.
+        :param req: Request
+        :return: 200 with {"feed": <url>}, 401 if the token is neither a volunteer's nor an organization's
+        """
+        if AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Volunteer']):
+            kind = calendar_feeds.VOLUNTEER
+            owner_id = Volunteer.objects.values_list('id', flat=True).get(end_user_id=AuthCheck.get_user_id(req))
+        elif AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Organization']):
+            kind = calendar_feeds.ORGANIZATION
+            owner_id = Organization.objects.values_list('id', flat=True).get(end_user_id=AuthCheck.get_user_id(req))
+        else:
+            return AuthCheck.unauthorized_response()
+
+        path = "/api/calendar/%s/" % calendar_feeds.get_token(kind, owner_id)
+        return Response(data={"feed": req.build_absolute_uri(path)}, status=status.HTTP_200_OK)
+
+
+class CalendarFeedAPIView(generics.GenericAPIView):
+    """
+    View serving iCalendar feeds to calendar clients, authenticated by the signed token in the url
+    """
+    authentication_classes = []
+    permission_classes = []
+
+    def get(self, req, *args, **kwargs):
+        """
+        Returns the feed as text/calendar with an ETag, or 304 if the client's If-None-Match has the current ETag
+        :param req: Request
+        :return: 200 with the feed, 304 if it hasn't changed, 400 if the token is invalid or expired
+        """
+        feed_token = self.kwargs['feed_token']
+        data = feed_token.get_data() if feed_token.is_valid() else None
+        # Other signed tokens, such as invites, are valid too but don't address a feed
+        if not isinstance(data, dict) or data.get('calendar') not in (calendar_feeds.VOLUNTEER,
+                                                                      calendar_feeds.ORGANIZATION) \
+                or not isinstance(data.get('id'), int):
+            return Response(data={"Error": "The provided token is invalid."}, status=status.HTTP_400_BAD_REQUEST)
+        kind = data['calendar']
+        owner_id = data['id']
+
+        version = calendar_feeds.get_version(kind, owner_id)
+        etag = quote_etag(version)
+        if etag in parse_etags(req.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            feed = calendar_feeds.get_cached(kind, owner_id, version)
+            if feed is None:
+                response = StreamingHttpResponse(calendar_feeds.stream(kind, owner_id, version),
+                                                 content_type='text/calendar; charset=utf-8')
+            else:
+                response = HttpResponse(feed, content_type='text/calendar; charset=utf-8')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
 class InviteVolunteersAPIView(generics.GenericAPIView):
     """
     View to generate an invite code for an event. GET will return an invite code for this event and POST will email
@@ -776,7 +1109,6 @@ class OrganizationEmailVolunteers(generics.CreateAPIView, AuthCheck):
             organizer = Organization.objects.get(end_user__id=AuthCheck.get_user_id(req))
             if organizer.id == event.organization.id:
                 body = json.loads(str(req.body, encoding='utf-8'))
-                volunteer_emails = self._get_volunteer_emails(event)
                 eventdate = event.date.strftime("%m/%d/%Y")
                 subject = "You received a message from " + organizer.name + " for their " + event.title + \
                           " event on " + eventdate
@@ -785,37 +1117,15 @@ class OrganizationEmailVolunteers(generics.CreateAPIView, AuthCheck):
                           "\nMessage: " + body['message'] + "\n\n\n\n---------------------------------------------\n" \
                           + "This email is not monitored, if you would like to respond to " + organizer.name \
                           + " about this event, you may email them at " + body['replyto'] + "."
-                emails = self._make_emails(volunteer_emails, settings.DEFAULT_FROM_EMAIL, subject, message)
-                send_mass_mail(emails)
+                send_event_mass_mail(event.id, subject, message, settings.DEFAULT_FROM_EMAIL)
                 return Response(data={"Success": "Emails sent."}, status=status.HTTP_200_OK)
             return Response(data={"Unauthorized": "Requesting token does not manage this event."},
                             status=status.HTTP_401_UNAUTHORIZED)
         return AuthCheck.unauthorized_response()
 
-    def _make_emails(self, to_emails, from_email, subject, message):
-        """
-        Builds a tuple of the emails to send
-        :param to_emails: List of volunteer emails
-        :param from_email: From email address
-        :param subject: Subject of the emails
-        :param message: Message of the emails
-        :return: Tuple of the emails to send
-        """
-        emails = []
-        for volunteer in to_emails:
-            emails.append((subject, message, from_email, [volunteer]))
-        return tuple(emails)
-
     def _get_event(self, event_id):
         return Event.objects.get(id=event_id)
 
-    def _get_volunteer_emails(self, event):
-        volunteers = event.volunteers.all()
-        emails = []
-        for volunteer in volunteers:
-            emails.append(volunteer.end_user.email)
-        return emails
-
 
 class CheckSignupAPIView(generics.RetrieveAPIView, AuthCheck):
     """
@@ -835,14 +1145,12 @@ class CheckSignupAPIView(generics.RetrieveAPIView, AuthCheck):
         """
         if AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Volunteer']):
             user_id = AuthCheck.get_user_id(req)
-            volunteer = Volunteer.objects.get(end_user_id=user_id)
+            event_id = self.kwargs['event_id']
 
-            try:
-                current_event = self.get_object()
-            except ObjectDoesNotExist:
+            if not Event.objects.filter(id=event_id).exists():
                 return Response(data={"Error": "Given event ID does not exist."}, status=status.HTTP_400_BAD_REQUEST)
 
-            if volunteer in current_event.volunteers.all():
+            if Event.volunteers.through.objects.filter(event_id=event_id, volunteer__end_user_id=user_id).exists():
                 return Response(data={"Signed-up": "true"}, status=status.HTTP_200_OK)
             else:
                 return Response(data={"Signed-up": "false"}, status=status.HTTP_200_OK)
@@ -850,6 +1158,40 @@ class CheckSignupAPIView(generics.RetrieveAPIView, AuthCheck):
         return AuthCheck.unauthorized_response()
 
 
+class CheckSignupsAPIView(generics.RetrieveAPIView, AuthCheck):
+    """
+    Class view to check which of many events a volunteer has signed up for
+    """
+    MAX_EVENTS = 100
+
+    def retrieve(self, req, *args, **kwargs):
+        """
+        Endpoint to check if a volunteer has signed up for each of a list of events, with one query.
+        Takes the event ids as a comma separated ids query parameter, e.g. ?ids=1,2,3
+        :param req: request
+        :return: 400 if ids is missing, malformed or has more than MAX_EVENTS ids,
+                 200 with {"Signed-up": {"<event id>": "true" or "false"}}. Event ids that don't exist map to "false".
+        """
+        if AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Volunteer']):
+            user_id = AuthCheck.get_user_id(req)
+            try:
+                event_ids = {int(event_id) for event_id in req.query_params['ids'].split(',') if event_id}
+            except (KeyError, ValueError):
+                return Response(data={"Error": "ids must be a comma separated list of event IDs."},
+                                status=status.HTTP_400_BAD_REQUEST)
+            if len(event_ids) > self.MAX_EVENTS:
+                return Response(data={"Error": "At most %d events can be checked at once." % self.MAX_EVENTS},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            signed_up = set(Event.volunteers.through.objects
+                            .filter(volunteer__end_user_id=user_id, event_id__in=event_ids)
+                            .values_list('event_id', flat=True))
+            flags = {str(event_id): "true" if event_id in signed_up else "false" for event_id in sorted(event_ids)}
+            return Response(data={"Signed-up": flags}, status=status.HTTP_200_OK)
+
+        return AuthCheck.unauthorized_response()
+
+
 class EventVolunteers(generics.ListAPIView, AuthCheck):
     """
     Class view for organizations to get a list of volunteers signed up for an event
@@ -884,6 +1226,49 @@ class EventVolunteers(generics.ListAPIView, AuthCheck):
         return AuthCheck.unauthorized_response()
 
 
+class EventRosterAPIView(generics.ListAPIView, AuthCheck):
+    """
+    Class view for organizations to page through the roster of an event
+    """
+    keyset_paginator = KeysetPaginator('date_registered')
+
+    def list(self, req, *args, **kwargs):
+        """
+        Returns one page of the event's volunteers in signup order. Takes optional query parameters:
+            search: Only return volunteers whose first or last name contains every whitespace separated term
+            cursor: The "next" value of the previous page
+            limit: Page size, 50 by default and at most 200
+        :param req: Request
+        :return:    200 with {"count": <roster size>, "next": <cursor or null>, "volunteers": [{"name", "email",
+                    "signed_up"}]}, 400 if the event doesn't exist, isn't this organization's or the cursor is
+                    malformed, 401 if the token is not an organization's
+        """
+        if AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Organization']):
+            try:
+                count = Event.objects.values_list('seats_taken', flat=True) \
+                    .get(id=self.kwargs['event_id'], organization__end_user_id=AuthCheck.get_user_id(req))
+            except ObjectDoesNotExist:
+                return Response(data={"Error": "Given event ID does not exist."}, status=status.HTTP_400_BAD_REQUEST)
+
+            roster = EventVolunteer.objects.filter(event_id=self.kwargs['event_id'])
+            for term in req.query_params.get('search', '').split():
+                roster = roster.filter(Q(volunteer__first_name__icontains=term) |
+                                       Q(volunteer__last_name__icontains=term))
+            roster = roster.values('id', 'date_registered', 'volunteer__first_name', 'volunteer__last_name',
+                                   'volunteer__end_user__email')
+            try:
+                rows, cursor = self.keyset_paginator.paginate(roster, req.query_params.get('cursor'),
+                                                       req.query_params.get('limit'))
+            except InvalidCursor:
+                return Response(data={"Error": "Invalid cursor or limit."}, status=status.HTTP_400_BAD_REQUEST)
+
+            volunteers = [{"name": row['volunteer__first_name'] + " " + row['volunteer__last_name'],
+                           "email": row['volunteer__end_user__email'],
+                           "signed_up": row['date_registered']} for row in rows]
+            return Response(data={"count": count, "next": cursor, "volunteers": volunteers}, status=status.HTTP_200_OK)
+        return AuthCheck.unauthorized_response()
+
+
 class VolunteerOrganizationAPIView(generics.ListAPIView, AuthCheck):
     """
     Class view for volunteers to view organizations
@@ -891,22 +1276,18 @@ class VolunteerOrganizationAPIView(generics.ListAPIView, AuthCheck):
 
     serializer_class = VolunteerOrganizationSerializer
 
-    def get_object(self):
-        return Organization.objects.get(id=self.kwargs['org_id'])
-
     def list(self, req, *args, **kwargs):
         """
-        Returns organization in the path's details and upcoming events
+        Returns organization in the path's details and upcoming events. Both parts come from the organization page
+        cache, see api/pages.py.
         :param req:
         """
         if AuthCheck.is_authorized(req, settings.SCOPE_TYPES['Volunteer']):
-            try:
-                org = self.get_object()
-            except ObjectDoesNotExist:
+            header = organization_pages.get_header(self.kwargs['org_id'])
+            if header is None:
                 return Response(data={"Error": "Organization with the given Id does not exist."},
                                 status=status.HTTP_400_BAD_REQUEST)
-            data = {'organization': VolunteerOrganizationSerializer(org).data}
-            events = Event.objects.filter(Q(organization_id=org.id) & Q(start_time__gte=timezone.now()))
-            data['events'] = EventsSerializer(events, many=True).data
+            data = dict(header)
+            data['events'] = organization_pages.get_events(self.kwargs['org_id'])
             return Response(data=data, status=status.HTTP_200_OK)
         return AuthCheck.unauthorized_response()
@@ -1,63 +1,90 @@
-import uuid
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
 
-from asgiref.sync import async_to_sync
+from api.models import EndUser
+from api.pagination import KeysetPaginator, InvalidCursor
+from chat.models import Room, Membership, Message
+from chat.presence import presence
 
-from channels.generic.websocket import JsonWebsocketConsumer
-from django.utils import timezone
+logger = logging.getLogger(__name__)
 
-from api.models import EndUser
-from chat.models import Room, Membership, Message, StatusMembership
 
+class AuthenticatedConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Base of the chat consumers. They run on the event loop and only leave it for the database, grouping each message's
+    queries into a single database_sync_to_async call, so an idle or waiting socket doesn't hold a worker thread.
+    """
 
-class TypingConsumer(JsonWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.room_group_name = None
-        self.room_id = None
-        self.user = None
+        self.user_id = None
         self.username = None
 
-    def connect(self):
-        if self._is_authenticated():
-            print("Room Connection Authenticate!")
-            self.user = EndUser.objects.get(id=self.scope['user_id'])
-            self.room_id = self.scope['url_route']['kwargs']['room_id']
-            self.room_group_name = "typing-" + self.room_id
-            self.username = self.user.email
+    async def refuse(self, text):
+        """
+        Accepts the connection only to send the error and close it with the AuthError code
+        """
+        await self.accept()
+        await self.send_json(make_server_message("error", text))
+        await self.close(code=4001)  # AuthError Code
 
-            try:
-                Membership.objects.get(room__id=self.room_id, end_user__email=self.username)
+    def _is_authenticated(self):
+        if 'auth_error' in self.scope:
+            return False
+        if "user_id" not in self.scope.keys():
+            return False
+        return True
+
+    def _get_username(self):
+        """
+        Must be called from a database_sync_to_async call.
+        :return: Email of the authenticated user, None if the user doesn't exist
+        """
+        self.user_id = self.scope['user_id']
+        self.username = EndUser.objects.filter(id=self.user_id).values_list('email', flat=True).first()
+        return self.username
 
-                async_to_sync(self.channel_layer.group_add)(
-                    self.room_group_name,
-                    self.channel_name
-                )
 
-                self.accept()
-                self.send_json(make_server_message("success", "joined room"))
+class TypingConsumer(AuthenticatedConsumer):
+    """
+    Typing indicators of a room's members. Frames go through typing_throttle, so the room only hears about changes.
+    """
 
-            except Membership.DoesNotExist:
-                print("Failed to Connect Typing - Not in group")
-                self.accept()
-                self.send_json(make_server_message("error", "You are not in this room"))
-                self.close(code=4001)  # AuthError Code
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.room_group_name = None
+        self.room_id = None
 
+    async def connect(self):
+        if self._is_authenticated():
+            self.room_id = self.scope['url_route']['kwargs']['room_id']
+            if await self._join():
+                self.room_group_name = typing_group(self.room_id)
+                await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+                await self.accept()
+                await self.send_json(make_server_message("success", "joined room"))
+            else:
+                logger.info('Refused typing socket: user %s is not in room %s', self.user_id, self.room_id)
+                await self.refuse("You are not in this room")
         else:
-            print("Failed to connect")
-            print(str(self.scope))
-            self.accept()
-            self.send_json(make_server_message("error", "Something is wrong"))
-            self.close(code=4001)  # AuthError Code
-
-    def disconnect(self, code):
-        self.send_json(self.make_typing_message(self.username, "false"))
-        async_to_sync(self.channel_layer.group_discard)(
-            self.room_group_name,
-            self.channel_name
-        )
-        self.close()
-
-    def receive_json(self, content, **kwargs):
+            logger.info('Refused typing socket: %s', self.scope.get('auth_error', 'no user'))
+            await self.refuse("Something is wrong")
+
+    async def disconnect(self, code):
+        if self.room_group_name is not None:
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+            await typing_throttle.stop(self.channel_layer, self.room_id, self.username)
+
+    async def receive_json(self, content, **kwargs):
         """
         Example Message:
             {
@@ -71,78 +98,62 @@ class TypingConsumer(JsonWebsocketConsumer):
             if 'type' in content.keys():
                 if check_type(content, "typing_message"):
                     if 'typing' in content.keys():
-                        typing = content['typing']
-                        async_to_sync(self.channel_layer.group_send)(
-                            self.room_group_name,
-                            self.make_typing_message(self.username, typing)
-                        )
+                        await typing_throttle.update(self.channel_layer, self.room_id, self.username,
+                                                     is_typing(content['typing']))
                     else:
-                        self.send_json(content=make_server_message("error", "Missing typing key"))
+                        await self.send_json(content=make_server_message("error", "Missing typing key"))
                 else:
-                    self.send_json(content=make_server_message("error", "Invalid message type"))
+                    await self.send_json(content=make_server_message("error", "Invalid message type"))
             else:
-                self.send_json(content=make_server_message("error", "Missing type key"))
+                await self.send_json(content=make_server_message("error", "Missing type key"))
         else:
-            self.send_json(content=make_server_message("error", "Must send json"))
+            await self.send_json(content=make_server_message("error", "Must send json"))
 
-    def typing_message(self, event):
-        user = event['user']
-        typing = event['typing']
+    async def typing_message(self, event):
+        await self.send_json(content=make_typing_message(event['user'], event['typing']))
 
-        self.send_json(content=self.make_typing_message(user, typing))
+    @database_sync_to_async
+    def _join(self):
+        """
+        :return: True if the user exists and is a member of the room
+        """
+        return self._get_username() is not None and _is_member(self.room_id, self.user_id)
 
-    def make_typing_message(self, user, typing):
-        return {
-            'type': "typing_message",
-            'user': user,
-            'typing': typing
-        }
 
-    def _is_authenticated(self):
-        if hasattr(self.scope, 'auth_error'):
-            return False
-        if "user_id" not in self.scope.keys():
-            return False
-        return True
+class RoomConsumer(AuthenticatedConsumer):
+    """
+    Online status of the members of the user's rooms. The consumer joins the presence group of each room the user
+    attends, so a status change only reaches the users who share that room instead of everyone connected. Setting the
+    status online claims the user's presence in the room until it is set offline or the socket closes.
+    """
 
-
-class RoomConsumer(JsonWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.room_group_name = None
-        self.user = None
-        self.username = None
-
-    def connect(self):
-        if self._is_authenticated():
-            print("Room Connection Authenticate!")
-            self.user = EndUser.objects.get(id=self.scope['user_id'])
-            self.room_group_name = "online-group-room"
-            print("Room Group: %s" % str(self.room_group_name))
-            self.username = self.user.email
-
-            async_to_sync(self.channel_layer.group_add)(
-                self.room_group_name,
-                self.channel_name
-            )
-
-            self.accept()
-
+        self.rooms = set()
+        self.online_rooms = set()
+
+    async def connect(self):
+        room_ids = await self._get_rooms() if self._is_authenticated() else None
+        if room_ids is not None:
+            await self.join_rooms(room_ids)
+            await self.accept()
         else:
-            print("Failed to connect")
-            print(str(self.scope))
-            self.accept()
-            self.send_json(make_server_message("error", "Something is wrong"))
-            self.close(code=4001)  # AuthError Code
-
-    def disconnect(self, code):
-        async_to_sync(self.channel_layer.group_discard)(
-            self.room_group_name,
-            self.channel_name
-        )
-        self.close()
-
-    def receive_json(self, content, **kwargs):
+            logger.info('Refused presence socket: %s', self.scope.get('auth_error', 'user not found'))
+            await self.refuse("Something is wrong")
+
+    async def disconnect(self, code):
+        await asyncio.gather(*[self.channel_layer.group_discard(presence_group(room_id), self.channel_name)
+                               for room_id in self.rooms])
+        if self.online_rooms:
+            await presence.disconnect(self.online_rooms, self.user_id)
+
+    async def join_rooms(self, room_ids):
+        room_ids = [room_id for room_id in room_ids if room_id not in self.rooms]
+        await asyncio.gather(*[self.channel_layer.group_add(presence_group(room_id), self.channel_name)
+                               for room_id in room_ids])
+        self.rooms.update(room_ids)
+
+    async def receive_json(self, content, **kwargs):
         """
         Example Message:
             {
@@ -157,125 +168,88 @@ class RoomConsumer(JsonWebsocketConsumer):
             if 'type' in content.keys():
                 if check_type(content, "online_message"):
                     if 'room' in content.keys():
-                        if Room.objects.filter(id=content['room']).count() > 0:
-                            room = Room.objects.get(id=content['room'])
-                            if 'status' in content.keys():
-                                try:
-                                    membership = Membership.objects.get(room=room, end_user=self.user)
-                                    status = content['status']
-                                    if status == "get":
-                                        self.send_all_members(room)
-
-                                    else:
-                                        membership.online = (status == "online")
-                                        membership.save(update_fields=["online"])
-                                        async_to_sync(self.channel_layer.group_send)(
-                                            self.room_group_name,
-                                            self.make_online_message(self.username, str(room.id), status)
-                                        )
-
-                                except Membership.DoesNotExist:
-                                    self.send_json(
-                                        content=make_server_message("error", "You are not a member of this room."))
-                            else:
-                                self.send_json(content=make_server_message("error", "Missing status key"))
+                        if 'status' in content.keys():
+                            await self.update_status(str(content['room']), content['status'])
                         else:
-                            self.send_json(content=make_server_message("error", "Room doesn't exist"))
+                            await self.send_json(content=make_server_message("error", "Missing status key"))
                     else:
-                        self.send_json(content=make_server_message("error", "Missing room key"))
+                        await self.send_json(content=make_server_message("error", "Missing room key"))
                 else:
-                    self.send_json(content=make_server_message("error", "Invalid message type"))
+                    await self.send_json(content=make_server_message("error", "Invalid message type"))
             else:
-                self.send_json(content=make_server_message("error", "Missing type key"))
+                await self.send_json(content=make_server_message("error", "Missing type key"))
         else:
-            self.send_json(content=make_server_message("error", "Must send json"))
+            await self.send_json(content=make_server_message("error", "Must send json"))
 
-    def online_message(self, event):
-        user = event['user']
-        room = event['room']
-        status = event['status']
-
-        self.send_json(content=self.make_online_message(user, room, status))
-
-    def send_all_members(self, room):
-        for member in Membership.objects.filter(room=room, attending=True):
-            self.send_json(content=self.make_online_message(str(member.end_user.email), str(room.id), str(member.online)))
+    async def update_status(self, room_id, status):
+        """
+        Sends the online status of all members of the room if status is "get", otherwise sets the user's status in the
+        room and tells the other consumers
+        """
+        error, members = await database_sync_to_async(_check_status)(room_id, self.user_id, status)
+        if error is not None:
+            await self.send_json(content=make_server_message("error", error))
+        elif status == "get":
+            for email, online in members:
+                await self.send_json(content=make_online_message(email, room_id, str(online)))
+        else:
+            if status == "online" and room_id not in self.online_rooms:
+                self.online_rooms.add(room_id)
+                await presence.connect([room_id], self.user_id)
+            elif status != "online" and room_id in self.online_rooms:
+                self.online_rooms.discard(room_id)
+                await presence.disconnect([room_id], self.user_id)
+            # The user may have joined the room after connecting
+            await self.join_rooms([room_id])
+            await self.channel_layer.group_send(
+                presence_group(room_id),
+                make_online_message(self.username, room_id, status)
+            )
 
-    def make_online_message(self, user, room, status):
-        return {
-            'type': "online_message",
-            'room': room,
-            'user': user,
-            'status': status
-        }
+    async def online_message(self, event):
+        await self.send_json(content=make_online_message(event['user'], event['room'], event['status']))
 
-    def _is_authenticated(self):
-        if hasattr(self.scope, 'auth_error'):
-            return False
-        if "user_id" not in self.scope.keys():
-            return False
-        return True
+    @database_sync_to_async
+    def _get_rooms(self):
+        """
+        :return: Ids of the rooms the user attends, None if the user doesn't exist
+        """
+        if self._get_username() is None:
+            return None
+        return [str(room_id) for room_id in Membership.objects.filter(end_user_id=self.user_id, attending=True)
+                .values_list('room_id', flat=True)]
 
 
-class ChatConsumer(JsonWebsocketConsumer):
+class ChatConsumer(AuthenticatedConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.room_id = None
-        # self.room_group_name = None
-        self.user = None
-        self.username = None
-        self.RECENT_MESSAGES = 10
+        self.joined = False
 
-    def connect(self):
+    async def connect(self):
         if self._is_authenticated():
-            print("Chat Connection Authenticate!")
-            self.user = EndUser.objects.get(id=self.scope['user_id'])
-            self.room_id = self.scope['url_route']['kwargs']['room_id']
-            self.username = self.user.email
-
-            try:
-                membership = Membership.objects.get(room__id=self.room_id, end_user__email=self.username)
-                membership.online = True
-                membership.save()
-
-                async_to_sync(self.channel_layer.group_add)(
-                    self.room_id,
-                    self.channel_name
-                )
-
-                self.accept()
-                self.send_json(make_server_message("success", "joined room"))
-
-                self.recent_messages()
-            except Membership.DoesNotExist:
-                print("Failed to Connect Chat - Not in group")
-                self.accept()
-                self.send_json(make_server_message("error", "You are not in this room"))
-                self.close(code=4001)  # AuthError Code
-
+            self.room_id = self.scope['url_route']['kwargs'].get('room_id')
+            history = await self._join()
+            if history is not None:
+                self.joined = True
+                await presence.connect([self.room_id], self.user_id)
+                await self.channel_layer.group_add(self.room_id, self.channel_name)
+                await self.accept()
+                await self.send_json(make_server_message("success", "joined room"))
+                await self.send_history(*history)
+            else:
+                logger.info('Refused chat socket: user %s is not in room %s', self.user_id, self.room_id)
+                await self.refuse("You are not in this room")
         else:
-            print("Failed to Connect Chat")
-            self.accept()
-            self.send_json(make_server_message("error", "Something is wrong"))
-            self.close(code=4001)  # AuthError Code
-
-    def disconnect(self, code):
-        print("Chat Discon Room: %s" % str(self.room_id))
-        if self.room_id is not None:
-            async_to_sync(self.channel_layer.group_discard)(
-                self.room_id,
-                self.channel_name
-            )
-
-        self.close()
+            logger.info('Refused chat socket: %s', self.scope.get('auth_error', 'no user'))
+            await self.refuse("Something is wrong")
 
-    def close(self, code=None):
-        memberships = Membership.objects.filter(end_user__email=self.username)
-        for membership in memberships:
-            membership.online = False
-            membership.save()
+    async def disconnect(self, code):
+        if self.joined:
+            await self.channel_layer.group_discard(self.room_id, self.channel_name)
+            await presence.disconnect([self.room_id], self.user_id)
 
-    def receive_json(self, content, **kwargs):
+    async def receive_json(self, content, **kwargs):
         """
         Example Message:
             {
@@ -285,126 +259,578 @@ class ChatConsumer(JsonWebsocketConsumer):
                 "sender": sender,
                 "message": message,
             }
+
+        Older history is requested with the "next" cursor of the last history frame received:
+            {
+                "type": "history_message",
+                "cursor": cursor,
+                "limit": 50
+            }
+
+        Every message up to and including a message is acknowledged as read with:
+            {
+                "type": "read_message",
+                "id": id
+            }
         """
 
         if isinstance(content, dict):
             if 'type' in content.keys():
                 if check_type(content, "chat_message"):
                     if 'room' in content.keys():
-                        if Room.objects.filter(id=content['room']).count() > 0:
-                            room = Room.objects.get(id=content['room'])
-                            if 'message' in content.keys():
-                                try:
-                                    Membership.objects.get(room=room, end_user=self.user)
-                                    room = content['room']
-                                    message = content['message']
-                                    msg = Message.objects.create(
-                                        room_id=uuid.UUID(room),
-                                        sender=self.user,
-                                        message=message
-                                    )
-                                    self.set_status_for_all_members(msg)
-
-                                    async_to_sync(self.channel_layer.group_send)(
-                                        room,
-                                        make_chat_message(msg.id, self.username, room, message, None)
-                                    )
-                                    self.send_json(content=make_server_message("sent", msg.id))
-                                except Membership.DoesNotExist:
-                                    self.send_json(
-                                        content=make_server_message("error", "You are not a member of this room."))
-                            else:
-                                self.send_json(content=make_server_message("error", "Missing message key"))
+                        if 'message' in content.keys():
+                            await self.create_message(str(content['room']), content['message'])
                         else:
-                            self.send_json(content=make_server_message("error", "Room doesn't exist"))
+                            await self.send_json(content=make_server_message("error", "Missing message key"))
                     else:
-                        self.send_json(content=make_server_message("error", "Missing room key"))
-                elif check_type(content, "status_message"):
-                    if "message" in content.keys():
-                        message_id = content['id']
-                        try:
-                            message = Message.objects.get(id=message_id)
-                            status = StatusMembership.objects.get(end_user__email=self.username, message=message)
-                            status.status = StatusMembership.READ
-                            status.save(update_fields=['status'])
-
-                            if message.sender.email != self.username:
-                                async_to_sync(self.channel_layer.group_send)(
-                                    self.room_id,
-                                    self.make_status_message(message.id, self.room_id)
-                                )
-                        except Message.DoesNotExist:
-                            self.send_json(content=make_server_message("error", "Message does not exist"))
+                        await self.send_json(content=make_server_message("error", "Missing room key"))
+                elif check_type(content, "read_message") or check_type(content, "status_message"):
+                    if "id" in content.keys():
+                        await self.read_message(content['id'])
                     else:
-                        self.send_json(content=make_server_message("error", "Missing message key"))
+                        await self.send_json(content=make_server_message("error", "Missing id key"))
+                elif check_type(content, "history_message"):
+                    if content.get('cursor'):
+                        await self.load_history(content['cursor'], content.get('limit'))
+                    else:
+                        await self.send_json(content=make_server_message("error", "Missing cursor key"))
                 else:
-                    self.send_json(content=make_server_message("error", "Invalid message type"))
+                    await self.send_json(content=make_server_message("error", "Invalid message type"))
             else:
-                self.send_json(content=make_server_message("error", "Missing type key"))
+                await self.send_json(content=make_server_message("error", "Missing type key"))
         else:
-            self.send_json(content=make_server_message("error", "Must send json"))
-
-    def status_message(self, event):
-        message_id = event['id']
-        room = event['room']
-        self.send_status(message_id, room)
-
-    def chat_message(self, event):
-        _id = event['id']
-        sender = event['sender']
-        message = event['message']
-        room = event['room']
-        self.send_message(_id, sender, message, room)
-
-    def recent_messages(self):
-        messages = Message.objects.filter(room__id=self.room_id)  # [:self.RECENT_MESSAGES]
-        for message in messages:
-            self.send_message(status=message.get_status(), **message.get_message_to_send())
-
-    def set_status_for_all_members(self, message):
-        message = Message.objects.get(id=message.id)
-        members = Membership.objects.filter(room=message.room, attending=True).values_list('end_user', flat=True)
-        # members = message.room.membership_set.values_list('end_user', flat=True)
-        for member in members:
-            end_user = EndUser.objects.get(id=member)
-            StatusMembership.objects.create(
-                end_user=end_user,
-                message=message,
-                status=StatusMembership.SENT
-            )
+            await self.send_json(content=make_server_message("error", "Must send json"))
+
+    async def create_message(self, room, text):
+        error, message_id = await database_sync_to_async(_create_message)(room, self.user_id, text)
+        if error is not None:
+            await self.send_json(content=make_server_message("error", error))
+            return
+        await self.channel_layer.group_send(room, make_chat_message(message_id, self.username, room, text, None))
+        await self.send_json(content=make_server_message("sent", message_id))
+
+    async def read_message(self, message_id):
+        if not isinstance(message_id, int) and not str(message_id).isdigit():
+            await self.send_json(content=make_server_message("error", "Message does not exist"))
+        elif await database_sync_to_async(_acknowledge)(self.room_id, self.user_id, int(message_id)):
+            receipts.changed(self.channel_layer, self.room_id)
+
+    async def receipt_message(self, event):
+        await self.send_json(content=event)
+
+    async def chat_message(self, event):
+        await self.send_json(content=make_chat_message(event['id'], event['sender'], event['room'], event['message'],
+                                                       Message.SENT))
+        if await database_sync_to_async(_deliver)(event['room'], self.user_id, event['id']):
+            receipts.changed(self.channel_layer, event['room'])
+
+    async def load_history(self, cursor, limit):
+        try:
+            history = await database_sync_to_async(_history_page)(self.room_id, self.user_id, cursor, limit)
+        except InvalidCursor as e:
+            await self.send_json(content=make_server_message("error", str(e)))
+            return
+        await self.send_history(*history)
+
+    async def send_history(self, history, delivered):
+        """
+        :param history: History frame to send the user
+        :param delivered: True if the history moved the user's delivered watermark
+        """
+        await self.send_json(content=history)
+        if delivered:
+            receipts.changed(self.channel_layer, history['room'])
 
-    def make_status_message(self, _id, room):
-        message = Message.objects.get(id=_id)
-        return make_chat_message(int(_id), message.sender.email, room, message.message, message.get_status(), typ="status_message")
+    @database_sync_to_async
+    def _join(self):
+        """
+        Loads the latest page of the room's history
+        :return: Tuple of the history frame and whether the watermark moved as in _history_page, None if the user isn't
+                 a member of the room
+        """
+        if self._get_username() is None or self.room_id is None or not _is_member(self.room_id, self.user_id):
+            return None
+        return _history_page(self.room_id, self.user_id, None, None)
+
+
+class MultiplexConsumer(AuthenticatedConsumer):
+    """
+    One socket for every room a client has open. Instead of a ChatConsumer and a TypingConsumer socket per room plus a
+    RoomConsumer socket, the client subscribes to the chat, typing and presence streams of each room over this one, so
+    the token is validated and the user looked up once. Frames in both directions are wrapped in an envelope naming
+    the stream and the room, and their payloads are the frames of the single room consumers:
+        {"stream": "chat", "room": room, "action": "subscribe"}
+        {"stream": "chat", "room": room, "payload": {"type": "chat_message", "message": message}}
+        {"stream": "typing", "room": room, "payload": {"type": "typing_message", "typing": "true"}}
+        {"stream": "presence", "room": room, "payload": {"type": "online_message", "status": "online"}}
+        {"stream": "chat", "room": room, "action": "unsubscribe"}
+    Subscribing to a room's chat sends its latest history, like connecting a ChatConsumer. Frames about the socket
+    itself have neither stream nor room.
+    """
+    CHAT = 'chat'
+    TYPING = 'typing'
+    PRESENCE = 'presence'
+    STREAMS = (CHAT, TYPING, PRESENCE)
 
-    def send_status(self, _id, room):
-        self.send_json(content=self.make_status_message(_id, room))
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.subscriptions = set()
+        self.online_rooms = set()
 
-    def send_message(self, _id, sender, message, room, status=StatusMembership.SENT):
-        self.send_json(content=make_chat_message(_id, sender, room, message, status))
+    async def connect(self):
+        if self._is_authenticated() and await database_sync_to_async(self._get_username)() is not None:
+            await self.accept()
+            await self.send_stream(None, None, make_server_message("success", "connected"))
+        else:
+            logger.info('Refused multiplexed socket: %s', self.scope.get('auth_error', 'user not found'))
+            await self.refuse("Something is wrong")
+
+    async def disconnect(self, code):
+        await asyncio.gather(*[self.leave(stream, room_id) for stream, room_id in list(self.subscriptions)])
+
+    async def receive_json(self, content, **kwargs):
+        if not isinstance(content, dict):
+            await self.send_error(None, None, "Must send json")
+        elif content.get('stream') not in self.STREAMS:
+            await self.send_error(None, None, "Invalid stream")
+        elif 'room' not in content.keys():
+            await self.send_error(content['stream'], None, "Missing room key")
+        else:
+            stream, room_id = content['stream'], str(content['room'])
+            if content.get('action') == "subscribe":
+                await self.subscribe(stream, room_id)
+            elif content.get('action') == "unsubscribe":
+                await self.unsubscribe(stream, room_id)
+            elif 'action' in content.keys():
+                await self.send_error(stream, room_id, "Invalid action")
+            elif not isinstance(content.get('payload'), dict) or 'type' not in content['payload'].keys():
+                await self.send_error(stream, room_id, "Missing payload")
+            elif (stream, room_id) not in self.subscriptions:
+                await self.send_error(stream, room_id, "Not subscribed to this stream")
+            else:
+                await getattr(self, 'receive_' + stream)(room_id, content['payload'])
 
-        sts = StatusMembership.objects.get_or_create(message_id=_id, end_user=self.user)[0]
-        if sts.status == StatusMembership.SENT:
-            sts.status = StatusMembership.DELIVERED
-            sts.save(update_fields=['status'])
+    async def send_stream(self, stream, room_id, payload):
+        await self.send_json(content={"stream": stream, "room": room_id, "payload": payload})
 
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_id,
-            self.make_status_message(_id, room)
-        )
+    async def send_error(self, stream, room_id, text):
+        await self.send_stream(stream, room_id, make_server_message("error", text))
+
+    async def subscribe(self, stream, room_id):
+        if (stream, room_id) in self.subscriptions:
+            await self.send_stream(stream, room_id, make_server_message("success", "subscribed"))
+            return
+        if stream == self.CHAT:
+            history = await database_sync_to_async(self._join_chat)(room_id)
+            joined = history is not None
+        else:
+            joined = await database_sync_to_async(_is_member)(room_id, self.user_id)
+        if not joined:
+            await self.send_error(stream, room_id, "You are not in this room")
+            return
+
+        self.subscriptions.add((stream, room_id))
+        if stream == self.CHAT:
+            await presence.connect([room_id], self.user_id)
+        await self.channel_layer.group_add(self._group(stream, room_id), self.channel_name)
+        await self.send_stream(stream, room_id, make_server_message("success", "subscribed"))
+        if stream == self.CHAT:
+            await self.send_history(*history)
+
+    async def unsubscribe(self, stream, room_id):
+        if (stream, room_id) not in self.subscriptions:
+            await self.send_error(stream, room_id, "Not subscribed to this stream")
+            return
+        await self.leave(stream, room_id)
+        await self.send_stream(stream, room_id, make_server_message("success", "unsubscribed"))
+
+    async def leave(self, stream, room_id):
+        """
+        Leaves the stream's group and releases what the subscription held
+        """
+        self.subscriptions.discard((stream, room_id))
+        await self.channel_layer.group_discard(self._group(stream, room_id), self.channel_name)
+        if stream == self.CHAT:
+            await presence.disconnect([room_id], self.user_id)
+        elif stream == self.TYPING:
+            await typing_throttle.stop(self.channel_layer, room_id, self.username)
+        elif room_id in self.online_rooms:
+            self.online_rooms.discard(room_id)
+            await presence.disconnect([room_id], self.user_id)
+
+    async def receive_chat(self, room_id, payload):
+        if check_type(payload, "chat_message"):
+            if 'message' in payload.keys():
+                error, message_id = await database_sync_to_async(_create_message)(room_id, self.user_id,
+                                                                                  payload['message'])
+                if error is not None:
+                    await self.send_error(self.CHAT, room_id, error)
+                    return
+                await self.channel_layer.group_send(room_id, make_chat_message(message_id, self.username, room_id,
+                                                                               payload['message'], None))
+                await self.send_stream(self.CHAT, room_id, make_server_message("sent", message_id))
+            else:
+                await self.send_error(self.CHAT, room_id, "Missing message key")
+        elif check_type(payload, "read_message") or check_type(payload, "status_message"):
+            message_id = payload.get('id')
+            if not isinstance(message_id, int) and not str(message_id).isdigit():
+                await self.send_error(self.CHAT, room_id, "Message does not exist")
+            elif await database_sync_to_async(_acknowledge)(room_id, self.user_id, int(message_id)):
+                receipts.changed(self.channel_layer, room_id)
+        elif check_type(payload, "history_message"):
+            if payload.get('cursor'):
+                try:
+                    history = await database_sync_to_async(_history_page)(room_id, self.user_id, payload['cursor'],
+                                                                          payload.get('limit'))
+                except InvalidCursor as e:
+                    await self.send_error(self.CHAT, room_id, str(e))
+                    return
+                await self.send_history(*history)
+            else:
+                await self.send_error(self.CHAT, room_id, "Missing cursor key")
+        else:
+            await self.send_error(self.CHAT, room_id, "Invalid message type")
+
+    async def receive_typing(self, room_id, payload):
+        if not check_type(payload, "typing_message"):
+            await self.send_error(self.TYPING, room_id, "Invalid message type")
+        elif 'typing' not in payload.keys():
+            await self.send_error(self.TYPING, room_id, "Missing typing key")
+        else:
+            await typing_throttle.update(self.channel_layer, room_id, self.username, is_typing(payload['typing']))
+
+    async def receive_presence(self, room_id, payload):
+        if not check_type(payload, "online_message"):
+            await self.send_error(self.PRESENCE, room_id, "Invalid message type")
+        elif 'status' not in payload.keys():
+            await self.send_error(self.PRESENCE, room_id, "Missing status key")
+        elif payload['status'] == "get":
+            error, members = await database_sync_to_async(_check_status)(room_id, self.user_id, "get")
+            if error is not None:
+                await self.send_error(self.PRESENCE, room_id, error)
+                return
+            for email, online in members:
+                await self.send_stream(self.PRESENCE, room_id, make_online_message(email, room_id, str(online)))
+        else:
+            # Membership was checked when subscribing
+            status = payload['status']
+            if status == "online" and room_id not in self.online_rooms:
+                self.online_rooms.add(room_id)
+                await presence.connect([room_id], self.user_id)
+            elif status != "online" and room_id in self.online_rooms:
+                self.online_rooms.discard(room_id)
+                await presence.disconnect([room_id], self.user_id)
+            await self.channel_layer.group_send(presence_group(room_id),
+                                                make_online_message(self.username, room_id, status))
+
+    async def send_history(self, history, delivered):
+        await self.send_stream(self.CHAT, history['room'], history)
+        if delivered:
+            receipts.changed(self.channel_layer, history['room'])
+
+    async def chat_message(self, event):
+        await self.send_stream(self.CHAT, event['room'], make_chat_message(event['id'], event['sender'], event['room'],
+                                                                           event['message'], Message.SENT))
+        if await database_sync_to_async(_deliver)(event['room'], self.user_id, event['id']):
+            receipts.changed(self.channel_layer, event['room'])
+
+    async def receipt_message(self, event):
+        await self.send_stream(self.CHAT, event['room'], event)
+
+    async def typing_message(self, event):
+        await self.send_stream(self.TYPING, event['room'], make_typing_message(event['user'], event['typing']))
+
+    async def online_message(self, event):
+        await self.send_stream(self.PRESENCE, event['room'],
+                               make_online_message(event['user'], event['room'], event['status']))
+
+    def _group(self, stream, room_id):
+        if stream == self.CHAT:
+            return room_id
+        if stream == self.TYPING:
+            return typing_group(room_id)
+        return presence_group(room_id)
+
+    def _join_chat(self, room_id):
+        """
+        :return: Latest history of the room as in _history_page, None if the user isn't a member of the room
+        """
+        if not _is_member(room_id, self.user_id):
+            return None
+        return _history_page(room_id, self.user_id, None, None)
+
+
+# Newest messages first, so each page of history is older than the one before it
+history_paginator = KeysetPaginator('timestamp', descending=True)
+
+
+def _is_member(room_id, user_id):
+    """
+    :return: True if the user is a member of the room, False if not or if the room id is malformed
+    """
+    try:
+        return Membership.objects.filter(room_id=room_id, end_user_id=user_id).exists()
+    except ValidationError:
+        return False
+
+
+def _history_page(room_id, user_id, cursor, limit):
+    """
+    Loads a page of the room's history, newest first, and marks its messages delivered to the user
+    :param cursor: Cursor of the page, None for the latest messages
+    :param limit: Maximum number of messages on the page
+    :return: Tuple of the history frame, with the page's messages oldest first and the cursor of the next older page,
+             and True if the page moved the user's delivered watermark
+    :raises InvalidCursor: If the cursor or limit is malformed
+    """
+    rows, next_cursor = history_paginator.paginate(
+        Message.objects.filter(room_id=room_id).values('id', 'timestamp', 'message', 'sender_id', 'sender__email'),
+        cursor, limit)
+    rows.reverse()
+
+    delivered = bool(rows) and _advance_watermarks(room_id, user_id, delivered=rows[-1]['id']) > 0
+    statuses = Message.get_statuses(room_id, [(row['id'], row['sender_id'], row['timestamp']) for row in rows])
+    messages = [make_chat_message(row['id'], row['sender__email'], room_id, row['message'], statuses[row['id']])
+                for row in rows]
+    history = {"type": "history_message", "room": room_id, "messages": messages, "next": next_cursor}
+    return history, delivered
+
+
+def _create_message(room_id, user_id, text):
+    """
+    Saves a message, which the sender has read by definition
+    :return: Tuple of the error to send, None if there is none, and the new message's id
+    """
+    try:
+        if not Room.objects.filter(id=room_id).exists():
+            return "Room doesn't exist", None
+    except ValidationError:
+        return "Room doesn't exist", None
+    if not Membership.objects.filter(room_id=room_id, end_user_id=user_id).exists():
+        return "You are not a member of this room.", None
+
+    message = Message.objects.create(room_id=room_id, sender_id=user_id, message=text)
+    _advance_watermarks(room_id, user_id, read=message.id)
+    return None, message.id
+
+
+def _deliver(room_id, user_id, message_id):
+    """
+    Marks a message delivered to the user
+    :return: True if the user's delivered watermark moved
+    """
+    return _advance_watermarks(room_id, user_id, delivered=message_id) > 0
+
+
+def _acknowledge(room_id, user_id, message_id):
+    """
+    Marks every message in the room up to and including message_id read by the user with a single UPDATE. Ids of
+    messages that aren't in the room are ignored, so a client can't move its watermark past the newest message.
+    :return: True if the user's read watermark moved
+    """
+    return Membership.objects.filter(room_id=room_id, end_user_id=user_id, last_read__lt=message_id,
+                                     room__message__id=message_id) \
+        .update(last_read=message_id, last_delivered=Greatest(F('last_delivered'), Value(message_id))) > 0
+
+
+def _check_status(room_id, user_id, status):
+    """
+    Checks an online status update of the user in the room
+    :return: Tuple of the error to send, None if there is none, and for "get" the (email, online) pairs of the room's
+             attending members, online as registered in presence
+    """
+    try:
+        if not Room.objects.filter(id=room_id).exists():
+            return "Room doesn't exist", None
+    except ValidationError:
+        return "Room doesn't exist", None
+
+    if not Membership.objects.filter(room_id=room_id, end_user_id=user_id).exists():
+        return "You are not a member of this room.", None
+    if status != "get":
+        return None, None
+    members = list(Membership.objects.filter(room_id=room_id, attending=True)
+                   .values_list('end_user__email', 'end_user_id'))
+    online = presence.get_online(room_id, [member_id for _, member_id in members])
+    return None, [(email, member_id in online) for email, member_id in members]
+
+
+def _advance_watermarks(room_id, user_id, delivered=None, read=None):
+    """
+    Moves the user's delivered and read watermarks in the room forward to the given message ids. Watermarks never move
+    back, so replayed or out of order receipts are harmless.
+    :return: Number of watermarks that moved
+    """
+    moved = 0
+    memberships = Membership.objects.filter(room_id=room_id, end_user_id=user_id)
+    if read is not None:
+        moved += memberships.filter(last_read__lt=read).update(last_read=read)
+        # What was read was delivered
+        delivered = max(delivered or 0, read)
+    if delivered is not None:
+        moved += memberships.filter(last_delivered__lt=delivered).update(last_delivered=delivered)
+    return moved
+
+
+class ReceiptBroadcaster:
+    """
+    Debounces the receipt broadcasts of each room. Deliveries and read acknowledgements only mark their room changed;
+    the first change schedules a flush CHAT_RECEIPT_INTERVAL seconds later, which sends the room a single
+    receipt_message with the statuses of its latest messages that changed since the previous flush. However many
+    receipts arrive, a room gets at most one receipt frame per interval from each worker.
+
+    The statuses last sent are only kept for the ROOMS most recently flushed rooms. A room that was dropped gets all
+    statuses of its latest messages again on its next flush.
+    """
+    MESSAGES = 50
+    ROOMS = 1000
+
+    def __init__(self):
+        self.pending = set()
+        self.sent = OrderedDict()
+
+    def changed(self, channel_layer, room_id):
+        if room_id not in self.pending:
+            self.pending.add(room_id)
+            asyncio.ensure_future(self._flush(channel_layer, room_id))
+
+    async def _flush(self, channel_layer, room_id):
+        try:
+            await asyncio.sleep(settings.CHAT_RECEIPT_INTERVAL)
+        finally:
+            self.pending.discard(room_id)
+        statuses = await database_sync_to_async(self._get_statuses)(room_id)
+        sent = self.sent.pop(room_id, {})
+        self.sent[room_id] = statuses
+        if len(self.sent) > self.ROOMS:
+            self.sent.popitem(last=False)
+        changed = {str(message_id): status for message_id, status in statuses.items()
+                   if sent.get(message_id) != status}
+        if changed:
+            await channel_layer.group_send(room_id, {"type": "receipt_message", "room": room_id, "statuses": changed})
+
+    def _get_statuses(self, room_id):
+        messages = Message.objects.filter(room_id=room_id).order_by('-timestamp', '-id') \
+            .values_list('id', 'sender_id', 'timestamp')[:self.MESSAGES]
+        return Message.get_statuses(room_id, messages)
+
+
+receipts = ReceiptBroadcaster()
+
+
+class TypingThrottle:
+    """
+    Coalesces the typing frames of each user in each room before they reach the room's group. Only changes between
+    typing and not typing are forwarded, plus a repeated "true" at most once every CHAT_TYPING_REPEAT_INTERVAL seconds.
+    A user who stops sending "true" frames without sending "false" is reported as no longer typing CHAT_TYPING_TIMEOUT
+    seconds after the last one. The numbers of frames forwarded and dropped, and of indicators that expired, are
+    counted; see get_metrics.
+    """
+
+    def __init__(self):
+        # (room id, user) -> [time the last "true" was forwarded, handle of the expiry]
+        self.typing = {}
+        self.metrics = Counter()
+
+    async def update(self, channel_layer, room_id, user, typing):
+        """
+        :param channel_layer: Channel layer of the consumer
+        :param room_id: Id of the room
+        :param user: Email of the user
+        :param typing: True if the user is typing
+        """
+        key = (room_id, user)
+        state = self.typing.get(key)
+        if typing:
+            if state is not None:
+                state[1].cancel()
+            expiry = asyncio.get_event_loop().call_later(settings.CHAT_TYPING_TIMEOUT, self._expire,
+                                                         channel_layer, key)
+            if state is None or time.monotonic() - state[0] >= settings.CHAT_TYPING_REPEAT_INTERVAL:
+                self.typing[key] = [time.monotonic(), expiry]
+                await self._forward(channel_layer, key, "true")
+            else:
+                state[1] = expiry
+                self.metrics['dropped'] += 1
+        elif state is not None:
+            await self.stop(channel_layer, room_id, user)
+        else:
+            self.metrics['dropped'] += 1
+
+    async def stop(self, channel_layer, room_id, user):
+        """
+        Ends the user's typing indicator when their socket leaves the room. Unlike a "false" frame from the client,
+        nothing is counted as dropped if the user wasn't typing.
+        """
+        state = self.typing.pop((room_id, user), None)
+        if state is not None:
+            state[1].cancel()
+            await self._forward(channel_layer, (room_id, user), "false")
+
+    def get_metrics(self):
+        """
+        :return: Dictionary with the number of typing frames forwarded to rooms and dropped, and the number of typing
+                 indicators that expired; expired indicators are also counted as forwarded "false" frames
+        """
+        return {name: self.metrics[name] for name in ('forwarded', 'dropped', 'expired')}
+
+    def reset_metrics(self):
+        self.metrics.clear()
+
+    def _expire(self, channel_layer, key):
+        if key in self.typing:
+            del self.typing[key]
+            self.metrics['expired'] += 1
+            asyncio.ensure_future(self._forward(channel_layer, key, "false"))
+
+    async def _forward(self, channel_layer, key, typing):
+        self.metrics['forwarded'] += 1
+        room_id, user = key
+        await channel_layer.group_send(typing_group(room_id), dict(make_typing_message(user, typing), room=room_id))
 
-    def _is_authenticated(self):
-        if hasattr(self.scope, 'auth_error'):
-            return False
-        if "user_id" not in self.scope.keys():
-            return False
-        return True
+
+typing_throttle = TypingThrottle()
+
+
+def typing_group(room_id):
+    """
+    :return: Name of the group of the typing consumers of a room's members
+    """
+    return "typing-" + str(room_id)
+
+
+def presence_group(room_id):
+    """
+    :return: Name of the group of the presence consumers of a room's members
+    """
+    return "online-" + str(room_id)
 
 
 def check_type(event, t):
     return event['type'] == t
 
 
+def make_typing_message(user, typing):
+    return {
+        'type': "typing_message",
+        'user': user,
+        'typing': typing
+    }
+
+
+def make_online_message(user, room, status):
+    return {
+        'type': "online_message",
+        'room': room,
+        'user': user,
+        'status': status
+    }
+
+
+def is_typing(value):
+    return str(value).lower() == "true"
+
+
 def make_chat_message(_id, sender, room, message, status, typ="chat_message"):
     return {
         "type": typ,
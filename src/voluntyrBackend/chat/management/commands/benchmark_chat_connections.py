@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api.models import EndUser
+from chat.models import Membership, Message, Room
+
+
+class Command(BaseCommand):
+    help = 'Opens many chat websockets to one room concurrently in this process, as a single worker would serve them, ' \
+           'then broadcasts messages to all of them. Reports how long connecting and fan-out took and how many threads ' \
+           'the worker needed. Uses an in-memory channel layer and creates its own throwaway room and users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=100, help='Number of concurrent websockets')
+        parser.add_argument('--messages', type=int, default=3, help='Number of messages broadcast to the room')
+        parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for any one frame')
+
+    def handle(self, *args, **options):
+        # Imported here so the routing, and the consumers, load after the settings
+        from voluntyrBackend.routing import application
+
+        tag = uuid.uuid4().hex[:12]
+        layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 100000}}}
+        room, users = self._create_fixtures(tag, options['sockets'])
+        try:
+            with override_settings(CHANNEL_LAYERS=layers):
+                results = async_to_sync(self._run)(application, room, users, options['messages'], options['timeout'])
+            self._report(options['sockets'], options['messages'], *results)
+        finally:
+            self._delete_fixtures(tag, room)
+
+    async def _run(self, application, room, users, messages, timeout):
+        path = '/ws/chat/token/%s/' % room.id
+        sockets = [WebsocketCommunicator(application, path, headers=[(b'authorization',
+                                                                       b'Bearer ' + token.encode())])
+                   for token in users]
+        threads = _ThreadSampler()
+        threads.start()
+        try:
+            start = time.perf_counter()
+            await asyncio.gather(*[self._connect(socket, timeout) for socket in sockets])
+            connected = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for i in range(messages):
+                await sockets[i % len(sockets)].send_json_to({"type": "chat_message", "room": str(room.id),
+                                                              "message": "Benchmark %d" % i})
+            await asyncio.gather(*[self._receive(socket, messages, timeout) for socket in sockets])
+            fanned_out = time.perf_counter() - start
+        finally:
+            threads.stop()
+            await asyncio.gather(*[socket.disconnect() for socket in sockets], return_exceptions=True)
+        return connected, fanned_out, threads.peak
+
+    async def _connect(self, socket, timeout):
+        connected, _ = await socket.connect(timeout=timeout)
+        joined = await socket.receive_json_from(timeout=timeout)
+        if not connected or joined['status'] != 'success':
+            raise CommandError('Socket failed to join the room: %s' % joined['message'])
+
+    async def _receive(self, socket, messages, timeout):
+        received = 0
+        while received < messages:
+            try:
+                content = await socket.receive_json_from(timeout=timeout)
+            except asyncio.TimeoutError:
+                raise CommandError('Timed out waiting for messages; raise --timeout or lower --sockets')
+            if content['type'] == 'chat_message':
+                received += 1
+
+    def _report(self, sockets, messages, connected, fanned_out, peak_threads):
+        self.stdout.write('%d sockets connected in %.2fs (%.0f connections/s)' % (sockets, connected,
+                                                                                 sockets / connected))
+        self.stdout.write('%d messages delivered to every socket in %.2fs (%.0f deliveries/s)'
+                          % (messages, fanned_out, sockets * messages / fanned_out))
+        self.stdout.write(self.style.SUCCESS('Peak threads: %d' % peak_threads))
+
+    def _create_fixtures(self, tag, count):
+        room = Room.objects.create()
+        users = [EndUser(email='benchmark-%s-%d@voluntyr.invalid' % (tag, i), authy_id='bench') for i in range(count)]
+        EndUser.objects.bulk_create(users)
+        users = list(EndUser.objects.filter(email__startswith='benchmark-%s-' % tag))
+        Membership.objects.bulk_create([Membership(end_user=user, room=room) for user in users])
+        return room, [str(AccessToken.for_user(user)) for user in users]
+
+    def _delete_fixtures(self, tag, room):
+        Message.objects.filter(room=room).delete()
+        Membership.objects.filter(room=room).delete()
+        room.delete()
+        EndUser.objects.filter(email__startswith='benchmark-%s-' % tag).delete()
+
+
+class _ThreadSampler:
+    """
+    Samples the number of live threads, not counting its own, in the background and keeps the highest
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count() - 1)
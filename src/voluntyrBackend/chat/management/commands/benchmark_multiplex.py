@@ -0,0 +1,106 @@
+import asyncio
+import gc
+import tracemalloc
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api.models import EndUser
+from chat.models import Membership, Room
+
+
+class Command(BaseCommand):
+    help = 'Connects users with several rooms open, once with a chat and a typing socket per room plus a presence ' \
+           'socket each, and once with a single multiplexed socket each subscribed to the same streams. Reports the ' \
+           'number of sockets and the memory they hold in this process, measured with tracemalloc. Uses an in-memory ' \
+           'channel layer and creates its own throwaway rooms and users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Number of connected users')
+        parser.add_argument('--rooms', type=int, default=5, help='Number of rooms every user has open')
+        parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for any one frame')
+
+    def handle(self, *args, **options):
+        # Imported here so the routing, and the consumers, load after the settings
+        from voluntyrBackend.routing import application
+
+        tag = uuid.uuid4().hex[:12]
+        layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 100000}}}
+        rooms, users = self._create_fixtures(tag, options['users'], options['rooms'])
+        try:
+            with override_settings(CHANNEL_LAYERS=layers):
+                for name, connect in (('per-room sockets', self._connect_per_room),
+                                      ('multiplexed socket', self._connect_multiplexed)):
+                    sockets, memory = async_to_sync(self._run)(application, connect, rooms, users,
+                                                               options['timeout'])
+                    self.stdout.write('%s: %d sockets for %d users, %.0f KiB (%.1f KiB per user)'
+                                      % (name, sockets, len(users), memory / 1024, memory / 1024 / len(users)))
+        finally:
+            self._delete_fixtures(tag, rooms)
+
+    async def _run(self, application, connect, rooms, users, timeout):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            sockets = []
+            await asyncio.gather(*[connect(application, rooms, token, sockets, timeout) for token in users])
+            gc.collect()
+            memory = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+            await asyncio.gather(*[socket.disconnect() for socket in sockets], return_exceptions=True)
+        return len(sockets), memory
+
+    async def _connect_per_room(self, application, rooms, token, sockets, timeout):
+        for room_id in rooms:
+            chat = await self._open(application, '/ws/chat/token/%s/' % room_id, token, sockets, timeout)
+            await self._expect(chat, timeout)
+            await chat.receive_json_from(timeout=timeout)
+            typing = await self._open(application, '/ws/typing/token/%s/' % room_id, token, sockets, timeout)
+            await self._expect(typing, timeout)
+        await self._open(application, '/ws/online/token/', token, sockets, timeout)
+
+    async def _connect_multiplexed(self, application, rooms, token, sockets, timeout):
+        socket = await self._open(application, '/ws/multiplex/token/', token, sockets, timeout)
+        await self._expect(socket, timeout)
+        for room_id in rooms:
+            for stream in ('chat', 'typing', 'presence'):
+                await socket.send_json_to({"stream": stream, "room": room_id, "action": "subscribe"})
+                await self._expect(socket, timeout)
+                if stream == 'chat':
+                    await socket.receive_json_from(timeout=timeout)
+
+    async def _open(self, application, path, token, sockets, timeout):
+        socket = WebsocketCommunicator(application, path, headers=[(b'authorization', b'Bearer ' + token.encode())])
+        sockets.append(socket)
+        connected, _ = await socket.connect(timeout=timeout)
+        if not connected:
+            raise CommandError('Socket failed to connect to %s' % path)
+        return socket
+
+    async def _expect(self, socket, timeout):
+        """
+        Checks that the next frame, plain or multiplexed, is a success message
+        """
+        content = await socket.receive_json_from(timeout=timeout)
+        content = content.get('payload', content)
+        if content['status'] != 'success':
+            raise CommandError('Socket failed to join: %s' % content['message'])
+
+    def _create_fixtures(self, tag, users, rooms):
+        rooms = [Room.objects.create() for _ in range(rooms)]
+        EndUser.objects.bulk_create([EndUser(email='benchmark-%s-%d@voluntyr.invalid' % (tag, i), authy_id='bench')
+                                     for i in range(users)])
+        users = list(EndUser.objects.filter(email__startswith='benchmark-%s-' % tag))
+        Membership.objects.bulk_create([Membership(end_user=user, room=room) for user in users for room in rooms])
+        return [str(room.id) for room in rooms], [str(AccessToken.for_user(user)) for user in users]
+
+    def _delete_fixtures(self, tag, rooms):
+        Membership.objects.filter(room_id__in=rooms).delete()
+        Room.objects.filter(id__in=rooms).delete()
+        EndUser.objects.filter(email__startswith='benchmark-%s-' % tag).delete()
@@ -0,0 +1,55 @@
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from chat.consumers import presence_group
+
+# The single group every presence consumer used to join
+GLOBAL_GROUP = "online-group-room"
+
+
+class Command(BaseCommand):
+    help = 'Simulates presence fan-out for many connections on an in-memory channel layer, once with every connection ' \
+           'in one global presence group and once with per-room presence groups. Connections are split into rooms of ' \
+           '--room-size members; each status change is sent from a different room and every frame it produces is ' \
+           'received, as the consumers would.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=10000, help='Number of simulated connections')
+        parser.add_argument('--room-size', type=int, default=50, help='Members per room')
+        parser.add_argument('--changes', type=int, default=20, help='Number of online status changes')
+
+    def handle(self, *args, **options):
+        for name, per_room in (('global group', False), ('per-room groups', True)):
+            frames, elapsed = async_to_sync(self._run)(options['connections'], options['room_size'],
+                                                       options['changes'], per_room)
+            self.stdout.write('%s: %d changes delivered %d frames (%.0f per change) in %.2fs'
+                              % (name, options['changes'], frames, frames / options['changes'], elapsed))
+
+    async def _run(self, connections, room_size, changes, per_room):
+        layer = InMemoryChannelLayer(capacity=changes + 1)
+        rooms = (connections + room_size - 1) // room_size
+        channels = [await layer.new_channel() for _ in range(connections)]
+        for i, channel in enumerate(channels):
+            await layer.group_add(presence_group(i // room_size) if per_room else GLOBAL_GROUP, channel)
+
+        start = time.perf_counter()
+        for change in range(changes):
+            room = change % rooms
+            await layer.group_send(presence_group(room) if per_room else GLOBAL_GROUP, {
+                'type': "online_message",
+                'room': str(room),
+                'user': 'user%d@voluntyr.invalid' % (room * room_size),
+                'status': "online"
+            })
+        # Drain the queues directly: receive() scans every channel for expired messages on each call, which would
+        # swamp what is being measured at this many connections
+        frames = 0
+        for channel in channels:
+            queue = layer.channels.get(channel)
+            while queue is not None and not queue.empty():
+                queue.get_nowait()
+                frames += 1
+        return frames, time.perf_counter() - start
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Q
+
+from chat.models import Membership, Message, StatusMembership
+
+
+class Command(BaseCommand):
+    help = 'Converts the per message receipts in StatusMembership to the last_delivered and last_read watermarks of ' \
+           'each membership. A watermark becomes the newest message the member had received or read, and senders ' \
+           'have read their own messages. Safe to run more than once; watermarks only move forward.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true', help='Delete the receipts once converted')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Memberships updated per query')
+
+    def handle(self, *args, **options):
+        watermarks = {}
+
+        def advance(end_user_id, room_id, delivered, read):
+            current = watermarks.setdefault((end_user_id, room_id), [0, 0])
+            current[0] = max(current[0], delivered or 0, read or 0)
+            current[1] = max(current[1], read or 0)
+
+        receipts = StatusMembership.objects.values('end_user_id', 'message__room_id').order_by().annotate(
+            delivered=Max('message_id', filter=Q(status__in=[StatusMembership.DELIVERED, StatusMembership.READ])),
+            read=Max('message_id', filter=Q(status=StatusMembership.READ)))
+        for row in receipts.iterator():
+            advance(row['end_user_id'], row['message__room_id'], row['delivered'], row['read'])
+        sent = Message.objects.values('sender_id', 'room_id').order_by().annotate(newest=Max('id'))
+        for row in sent.iterator():
+            advance(row['sender_id'], row['room_id'], row['newest'], row['newest'])
+
+        with transaction.atomic():
+            changed = []
+            for membership in Membership.objects.only('end_user_id', 'room_id', 'last_delivered', 'last_read') \
+                    .iterator():
+                delivered, read = watermarks.get((membership.end_user_id, membership.room_id), (0, 0))
+                if delivered > membership.last_delivered or read > membership.last_read:
+                    membership.last_delivered = max(membership.last_delivered, delivered)
+                    membership.last_read = max(membership.last_read, read)
+                    changed.append(membership)
+            Membership.objects.bulk_update(changed, ['last_delivered', 'last_read'], batch_size=options['batch_size'])
+
+            deleted = 0
+            if options['delete']:
+                deleted, _ = StatusMembership.objects.all().delete()
+
+        self.stdout.write(self.style.SUCCESS('Updated the watermarks of %d memberships, deleted %d receipts'
+                                             % (len(changed), deleted)))
@@ -26,17 +26,25 @@ class Membership(models.Model):
     online = models.BooleanField(default=False)
     attending = models.BooleanField(default=True)
     date_joined = models.DateTimeField(auto_now_add=True)
+    # Watermarks: ids of the newest messages in the room delivered to and read by the member. Message ids increase, so
+    # every message up to a watermark counts as delivered or read. last_delivered is never behind last_read.
+    last_delivered = models.IntegerField(default=0)
+    last_read = models.IntegerField(default=0)
 
 
 class Message(models.Model):
+    SENT = 'Sent'
+    DELIVERED = 'Delivered'
+    READ = 'Read'
+
     room = models.ForeignKey(Room, on_delete=models.PROTECT)
     sender = models.ForeignKey('api.EndUser', on_delete=models.PROTECT, related_name="sender")
     message = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
-    status = models.ManyToManyField('api.EndUser', through="StatusMembership")
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [models.Index(fields=['room', '-timestamp', '-id'])]
 
     def get_room_id(self):
         return str(self.room.id)
@@ -45,20 +53,81 @@ class Message(models.Model):
         return {"_id": str(self.id), "sender": str(self.sender.email), "message": str(self.message), "room": self.get_room_id()}
 
     def get_status(self):
-        status = StatusMembership.objects.filter(message=self).exclude(end_user=self.sender)
-        receipts = set(status.values_list('status', flat=True))
-        if len(receipts) == 1:
-            return str(receipts.pop())
-        if StatusMembership.SENT in receipts:
-            return StatusMembership.SENT
-        return StatusMembership.DELIVERED
+        return self.get_statuses(self.room_id, [(self.id, self.sender_id, self.timestamp)])[self.id]
+
+    @classmethod
+    def get_statuses(cls, room_id, messages):
+        """
+        Derives the status of messages from the watermarks of the room's attending members. A message is Read once
+        every member other than its sender who joined before it was sent has read it, Delivered once they all received
+        it and Sent otherwise. Costs one query for the room's memberships, however many messages there are.
+        :param room_id: Id of the room the messages are in
+        :param messages: Iterable of (id, sender id, timestamp) tuples of messages in the room
+        :return: Dictionary of each message's status by id
+        """
+        messages = sorted(messages, key=lambda message: message[2])
+        if not messages:
+            return {}
+        members = Membership.objects.filter(room_id=room_id, attending=True, date_joined__lte=messages[-1][2]) \
+            .order_by('date_joined').values_list('end_user_id', 'date_joined', 'last_delivered', 'last_read')
+
+        # Members are added as messages get newer, keeping the two lowest watermarks of different members so the
+        # lowest of everyone but the sender is known without another pass
+        delivered, read = _LowestTwo(), _LowestTwo()
+        members = iter(members)
+        member = next(members, None)
+        statuses = {}
+        for message_id, sender_id, timestamp in messages:
+            while member is not None and member[1] <= timestamp:
+                delivered.add(member[2], member[0])
+                read.add(member[3], member[0])
+                member = next(members, None)
+            lowest_delivered = delivered.lowest(excluding=sender_id)
+            if lowest_delivered is None:
+                # Nobody else is in the room, so there is no one left to deliver it to
+                statuses[message_id] = cls.DELIVERED
+            elif message_id <= read.lowest(excluding=sender_id):
+                statuses[message_id] = cls.READ
+            elif message_id <= lowest_delivered:
+                statuses[message_id] = cls.DELIVERED
+            else:
+                statuses[message_id] = cls.SENT
+        return statuses
+
+
+class _LowestTwo:
+    def __init__(self):
+        self.values = []
+
+    def add(self, value, owner):
+        for i, (existing, existing_owner) in enumerate(self.values):
+            if existing_owner == owner:
+                value = min(value, existing)
+                del self.values[i]
+                break
+        self.values.append((value, owner))
+        self.values.sort(key=lambda entry: entry[0])
+        del self.values[2:]
+
+    def lowest(self, excluding):
+        """
+        :return: The lowest value not owned by excluding, None if there is none
+        """
+        for value, owner in self.values:
+            if owner != excluding:
+                return value
+        return None
 
 
 # https://docs.djangoproject.com/en/dev/topics/db/models/#extra-fields-on-many-to-many-relationships
 class StatusMembership(models.Model):
-    SENT = 'Sent'
-    DELIVERED = 'Delivered'
-    READ = 'Read'
+    """
+    Per message receipts, replaced by the watermarks on Membership and no longer written. Kept until the
+    convert_message_receipts command has moved existing receipts onto the watermarks.
+    """
+    SENT = Message.SENT
+    DELIVERED = Message.DELIVERED
+    READ = Message.READ
     MESSAGE_STATUS_CHOICES = [
         (SENT, 'Sent'),
         (DELIVERED, 'Delivered'),
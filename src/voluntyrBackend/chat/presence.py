@@ -0,0 +1,123 @@
+import asyncio
+from collections import Counter, defaultdict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from chat.models import Membership
+
+
+class PresenceRegistry:
+    """
+    Who is online in which chat room.
+
+    Every socket of a user in a room holds a claim on the user's presence there. While the sockets of this process hold
+    a claim, the user has an entry in the cache that expires after CHAT_PRESENCE_TTL seconds. One heartbeat refreshes
+    the entries of all claims of this process every CHAT_PRESENCE_HEARTBEAT seconds, so the presence held by a process
+    that dies without closing its sockets expires on its own. Production uses the Redis cache shared by all workers, so
+    every worker sees the same presence. A user's sockets may be spread over workers, so a process dropping its last
+    claim doesn't delete the entry; it shortens it to expire after two heartbeats, and any other process still holding
+    a claim refreshes it before then. With the default local-memory cache presence is per process.
+
+    The registry is what answers who is online. Membership.online is only a snapshot for other readers: changes are
+    collected and, unless CHAT_PRESENCE_FLUSH_INTERVAL is None, written every interval with one UPDATE per room and
+    state instead of a write per connect and disconnect.
+
+    Claims are counted on the event loop; the cache and the database are only used from database_sync_to_async.
+    """
+    KEY = 'chat:presence:%s:%s'
+
+    def __init__(self):
+        self.claims = Counter()
+        self.changes = {}
+        self.heartbeat = None
+        self.flushing = False
+
+    async def connect(self, room_ids, user_id):
+        """
+        Claims the user's presence in the rooms for one socket
+        :param room_ids: Ids of the rooms as strings
+        :param user_id: Id of the EndUser
+        """
+        online = []
+        for room_id in room_ids:
+            self.claims[room_id, user_id] += 1
+            if self.claims[room_id, user_id] == 1:
+                online.append((room_id, user_id))
+        if self.heartbeat is None and self.claims:
+            self.heartbeat = asyncio.ensure_future(self._beat())
+        if online:
+            self._changed(online, True)
+            await database_sync_to_async(self._write)(online, [])
+
+    async def disconnect(self, room_ids, user_id):
+        """
+        Releases the claims a socket made with connect. The user goes offline in the rooms no other socket claims within
+        two heartbeats.
+        """
+        offline = []
+        for room_id in room_ids:
+            if self.claims[room_id, user_id] <= 1:
+                del self.claims[room_id, user_id]
+                offline.append((room_id, user_id))
+            else:
+                self.claims[room_id, user_id] -= 1
+        if offline:
+            self._changed(offline, False)
+            await database_sync_to_async(self._write)([], offline)
+
+    def get_online(self, room_id, user_ids):
+        """
+        Reads the cache, so call it from a thread like the database
+        :return: Set of the ids of the given users who are online in the room
+        """
+        keys = {self.KEY % (room_id, user_id): user_id for user_id in user_ids}
+        return {keys[key] for key in cache.get_many(list(keys))}
+
+    def _write(self, online, offline):
+        if online:
+            cache.set_many({self.KEY % key: True for key in online}, settings.CHAT_PRESENCE_TTL)
+        if offline:
+            cache.set_many({self.KEY % key: True for key in offline},
+                           min(settings.CHAT_PRESENCE_TTL, 2 * settings.CHAT_PRESENCE_HEARTBEAT))
+
+    async def _beat(self):
+        try:
+            while self.claims:
+                await asyncio.sleep(settings.CHAT_PRESENCE_HEARTBEAT)
+                await database_sync_to_async(self._write)(list(self.claims), [])
+        finally:
+            self.heartbeat = None
+
+    def _changed(self, keys, online):
+        if settings.CHAT_PRESENCE_FLUSH_INTERVAL is None:
+            return
+        for key in keys:
+            self.changes[key] = online
+        if not self.flushing:
+            self.flushing = True
+            asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        try:
+            await asyncio.sleep(settings.CHAT_PRESENCE_FLUSH_INTERVAL)
+        finally:
+            self.flushing = False
+        changes, self.changes = self.changes, {}
+        await database_sync_to_async(self._save)(changes)
+
+    def _save(self, changes):
+        """
+        Writes the collected changes to Membership.online with one UPDATE per room and state
+        """
+        users = defaultdict(list)
+        for (room_id, user_id), online in changes.items():
+            users[room_id, online].append(user_id)
+        with transaction.atomic():
+            for (room_id, online), user_ids in users.items():
+                Membership.objects.filter(room_id=room_id, end_user_id__in=user_ids).update(online=online)
+
+
+presence = PresenceRegistry()
@@ -1,9 +1,10 @@
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
-from api.models import Event
-from api.signals import signal_volunteer_event_registration
-from chat.models import Room, Membership, StatusMembership
+from api.models import Event, Organization
+from api.signals import signal_volunteer_event_registration, signal_volunteer_event_registration_batch, \
+    signal_events_bulk_created
+from chat.models import Room, Membership
 from chat.utilities import get_room_or_error
 
 
@@ -15,6 +16,14 @@ def new_event_receiver(sender, **kwargs):
         Membership.objects.create(end_user=event.organization.end_user, room=room)
 
 
+@receiver(signal_events_bulk_created)
+def new_events_bulk_receiver(sender, **kwargs):
+    end_user_id = Organization.objects.values_list('end_user_id', flat=True).get(id=kwargs['organization_id'])
+    rooms = [Room(event_id=event_id) for event_id in kwargs['event_ids']]
+    Room.objects.bulk_create(rooms)
+    Membership.objects.bulk_create([Membership(end_user_id=end_user_id, room_id=room.id) for room in rooms])
+
+
 @receiver(signal_volunteer_event_registration)
 def volunteer_event_registration_change(sender, **kwargs):
     end_user = kwargs['volunteer'].end_user
@@ -31,4 +40,15 @@ def volunteer_event_registration_change(sender, **kwargs):
         membership = Membership.objects.get(end_user=end_user, room=room)
         membership.attending = False
         membership.save(update_fields=['attending'])
-        StatusMembership.objects.filter(end_user=end_user).delete()
+
+
+@receiver(signal_volunteer_event_registration_batch)
+def volunteer_event_registration_batch_change(sender, **kwargs):
+    end_user = kwargs['volunteer'].end_user
+    room_ids = Room.objects.filter(event_id__in=kwargs['event_ids']).values_list('id', flat=True)
+    memberships = Membership.objects.filter(end_user=end_user, room_id__in=room_ids)
+    memberships.update(attending=kwargs['attending'])
+    if kwargs['attending']:
+        existing = set(memberships.values_list('room_id', flat=True))
+        Membership.objects.bulk_create([Membership(end_user=end_user, room_id=room_id)
+                                        for room_id in room_ids if room_id not in existing])
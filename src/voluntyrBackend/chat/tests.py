@@ -1,15 +1,26 @@
+import asyncio
 import json
 import copy
 from datetime import timedelta
-
-from django.test import TestCase
+from io import StringIO
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils import timezone
 from rest_framework.test import RequestsClient
+from rest_framework_simplejwt.tokens import AccessToken
 
 from api import tests
 from api.models import EndUser, Event
 
-from chat.models import Room, Membership
+from chat.consumers import make_server_message, typing_throttle, ReceiptBroadcaster
+from chat.models import Room, Membership, Message, StatusMembership
+from chat.presence import presence
+from voluntyrBackend.routing import application
 
 
 class Utilities(tests.Utilities):
@@ -32,6 +43,7 @@ class Utilities(tests.Utilities):
 
 
 # https://channels.readthedocs.io/en/latest/tutorial/part_4.html
+@tests.synchronous_dispatch
 class RoomTests(TestCase, Utilities):
     volunteerDicts = [
         {
@@ -267,3 +279,342 @@ class RoomTests(TestCase, Utilities):
     def _assert_private_chat_room(self, room):
         self.assertIsNone(room.event)
         self.assertIn('Private Chat Room', room.get_room_name())
+
+
+@override_settings(CHAT_RECEIPT_INTERVAL=0.05, CHAT_PRESENCE_FLUSH_INTERVAL=None)
+class ConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.users = [EndUser.objects.create(email='chatuser%d@gmail.com' % i, authy_id='test') for i in range(3)]
+        self.room = Room.objects.create()
+        for user in self.users[:2]:
+            Membership.objects.create(end_user=user, room=self.room)
+
+    def communicator(self, user, path):
+        token = str(AccessToken.for_user(user))
+        return WebsocketCommunicator(application, path, headers=[(b'authorization', b'Bearer ' + token.encode())])
+
+    async def receive_type(self, communicator, typ):
+        while True:
+            content = await communicator.receive_json_from(timeout=5)
+            if content['type'] == typ:
+                return content
+
+    def test_chat_message(self):
+        async_to_sync(self._test_chat_message)()
+
+    async def _test_chat_message(self):
+        path = '/ws/chat/token/%s/' % self.room.id
+        sender, receiver = self.communicator(self.users[0], path), self.communicator(self.users[1], path)
+        for communicator in (sender, receiver):
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual((await communicator.receive_json_from())['message'], "joined room")
+
+        await sender.send_json_to({"type": "chat_message", "room": str(self.room.id), "message": "Hello"})
+        received = await self.receive_type(receiver, "chat_message")
+        self.assertEqual((received['sender'], received['message']), (self.users[0].email, "Hello"))
+        receipt = await self.receive_type(sender, "receipt_message")
+        self.assertDictEqual(receipt['statuses'], {str(received['id']): Message.DELIVERED})
+
+        await receiver.send_json_to({"type": "read_message", "id": received['id']})
+        receipt = await self.receive_type(sender, "receipt_message")
+        self.assertDictEqual(receipt['statuses'], {str(received['id']): Message.READ})
+        await sender.disconnect()
+        await receiver.disconnect()
+
+        message = Message.objects.get(room=self.room)
+        self.assertEqual(Membership.objects.get(room=self.room, end_user=self.users[1]).last_read, message.id)
+        self.assertEqual(message.get_status(), Message.READ)
+        self.assertFalse(Membership.objects.filter(room=self.room, online=True).exists())
+
+    def test_history_marks_delivered(self):
+        message = Message.objects.create(room=self.room, sender=self.users[0], message="Earlier")
+        self.assertEqual(message.get_status(), Message.SENT)
+        async_to_sync(self._test_history_marks_delivered)()
+        self.assertEqual(Membership.objects.get(room=self.room, end_user=self.users[1]).last_delivered, message.id)
+
+    async def _test_history_marks_delivered(self):
+        communicator = self.communicator(self.users[1], '/ws/chat/token/%s/' % self.room.id)
+        await communicator.connect()
+        await communicator.receive_json_from()
+        history = await communicator.receive_json_from()
+        self.assertEqual(history['type'], "history_message")
+        self.assertIsNone(history['next'])
+        self.assertEqual((history['messages'][0]['message'], history['messages'][0]['status']),
+                         ("Earlier", Message.DELIVERED))
+        await communicator.disconnect()
+
+    def test_history_pages(self):
+        Message.objects.bulk_create([Message(room=self.room, sender=self.users[0], message=str(i)) for i in range(60)])
+        async_to_sync(self._test_history_pages)()
+
+    async def _test_history_pages(self):
+        communicator = self.communicator(self.users[1], '/ws/chat/token/%s/' % self.room.id)
+        await communicator.connect()
+        await communicator.receive_json_from()
+        latest = await communicator.receive_json_from()
+        self.assertListEqual([message['message'] for message in latest['messages']], [str(i) for i in range(10, 60)])
+
+        await communicator.send_json_to({"type": "history_message", "cursor": latest['next'], "limit": 20})
+        older = await self.receive_type(communicator, "history_message")
+        self.assertListEqual([message['message'] for message in older['messages']], [str(i) for i in range(10)])
+        self.assertIsNone(older['next'])
+
+        await communicator.send_json_to({"type": "history_message", "cursor": "bogus"})
+        self.assertEqual(await self.receive_type(communicator, "server"), make_server_message("error",
+                                                                                             "Malformed cursor"))
+        await communicator.disconnect()
+
+    def test_not_a_member(self):
+        async_to_sync(self._test_not_a_member)()
+
+    async def _test_not_a_member(self):
+        for path in ('/ws/chat/token/%s/' % self.room.id, '/ws/typing/token/%s/' % self.room.id):
+            communicator = self.communicator(self.users[2], path)
+            await communicator.connect()
+            self.assertEqual((await communicator.receive_json_from())['message'], "You are not in this room")
+            self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4001})
+            await communicator.disconnect()
+
+    def test_typing_and_online(self):
+        async_to_sync(self._test_typing_and_online)()
+
+    async def _test_typing_and_online(self):
+        path = '/ws/typing/token/%s/' % self.room.id
+        typist, watcher = self.communicator(self.users[0], path), self.communicator(self.users[1], path)
+        for communicator in (typist, watcher):
+            await communicator.connect()
+            await communicator.receive_json_from()
+        await typist.send_json_to({"type": "typing_message", "typing": "true"})
+        self.assertDictEqual(await watcher.receive_json_from(),
+                             {"type": "typing_message", "user": self.users[0].email, "typing": "true"})
+        await typist.disconnect()
+        self.assertEqual((await watcher.receive_json_from())['typing'], "false")
+        await watcher.disconnect()
+
+        online = self.communicator(self.users[0], '/ws/online/token/')
+        connected, _ = await online.connect()
+        self.assertTrue(connected)
+        await online.send_json_to({"type": "online_message", "room": str(self.room.id), "status": "online"})
+        self.assertEqual((await online.receive_json_from())['status'], "online")
+        await online.send_json_to({"type": "online_message", "room": str(self.room.id), "status": "get"})
+        members = [await online.receive_json_from() for _ in range(2)]
+        self.assertListEqual(sorted((member['user'], member['status']) for member in members),
+                             [(self.users[0].email, "True"), (self.users[1].email, "False")])
+        await online.disconnect()
+
+    @override_settings(CHAT_TYPING_REPEAT_INTERVAL=10, CHAT_TYPING_TIMEOUT=0.2)
+    def test_typing_throttled(self):
+        typing_throttle.reset_metrics()
+        async_to_sync(self._test_typing_throttled)()
+        self.assertDictEqual(typing_throttle.get_metrics(), {"forwarded": 4, "dropped": 5, "expired": 1})
+
+    async def _test_typing_throttled(self):
+        path = '/ws/typing/token/%s/' % self.room.id
+        typist, watcher = self.communicator(self.users[0], path), self.communicator(self.users[1], path)
+        for communicator in (typist, watcher):
+            await communicator.connect()
+            await communicator.receive_json_from()
+        for _ in range(5):
+            await typist.send_json_to({"type": "typing_message", "typing": "true"})
+        self.assertEqual((await watcher.receive_json_from())['typing'], "true")
+        # No more frames until the indicator expires
+        self.assertEqual((await watcher.receive_json_from(timeout=2))['typing'], "false")
+        await typist.send_json_to({"type": "typing_message", "typing": "false"})
+        await typist.send_json_to({"type": "typing_message", "typing": "true"})
+        await typist.send_json_to({"type": "typing_message", "typing": "false"})
+        self.assertEqual((await watcher.receive_json_from())['typing'], "true")
+        self.assertEqual((await watcher.receive_json_from())['typing'], "false")
+        await typist.disconnect()
+        self.assertTrue(await watcher.receive_nothing())
+        await watcher.disconnect()
+
+    def test_presence_scoped_to_rooms(self):
+        Membership.objects.create(end_user=self.users[2], room=Room.objects.create())
+        async_to_sync(self._test_presence_scoped_to_rooms)()
+
+    async def _test_presence_scoped_to_rooms(self):
+        sender, member, outsider = [self.communicator(user, '/ws/online/token/') for user in self.users]
+        for communicator in (sender, member, outsider):
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+        await sender.send_json_to({"type": "online_message", "room": str(self.room.id), "status": "online"})
+        for communicator in (sender, member):
+            self.assertDictEqual(await communicator.receive_json_from(),
+                                 {"type": "online_message", "room": str(self.room.id), "user": self.users[0].email,
+                                  "status": "online"})
+        self.assertTrue(await outsider.receive_nothing())
+        for communicator in (sender, member, outsider):
+            await communicator.disconnect()
+
+    @override_settings(CHAT_PRESENCE_TTL=1, CHAT_PRESENCE_HEARTBEAT=0.2, CHAT_PRESENCE_FLUSH_INTERVAL=0.1)
+    def test_presence_registry(self):
+        async_to_sync(self._test_presence_registry)()
+        self.assertFalse(Membership.objects.get(room=self.room, end_user=self.users[0]).online)
+
+    async def _test_presence_registry(self):
+        room_id, user_ids = str(self.room.id), [user.id for user in self.users[:2]]
+        get_online = database_sync_to_async(presence.get_online)
+        await presence.connect([room_id], user_ids[0])
+        await presence.connect([room_id], user_ids[0])
+        # The heartbeat keeps the entry alive past its TTL
+        await asyncio.sleep(1.5)
+        self.assertSetEqual(await get_online(room_id, user_ids), {user_ids[0]})
+        self.assertTrue(await database_sync_to_async(
+            Membership.objects.filter(room=self.room, end_user_id=user_ids[0], online=True).exists)())
+
+        await presence.disconnect([room_id], user_ids[0])
+        self.assertSetEqual(await get_online(room_id, user_ids), {user_ids[0]})
+        await presence.disconnect([room_id], user_ids[0])
+        # Another process may still hold a claim, so the entry expires two heartbeats later instead of being deleted
+        self.assertSetEqual(await get_online(room_id, user_ids), {user_ids[0]})
+        await asyncio.sleep(0.6)
+        self.assertSetEqual(await get_online(room_id, user_ids), set())
+
+    @override_settings(CHAT_PRESENCE_HEARTBEAT=0.1)
+    def test_multiplexed_streams(self):
+        async_to_sync(self._test_multiplexed_streams)()
+
+    async def receive_stream(self, communicator, stream, typ):
+        while True:
+            content = await communicator.receive_json_from(timeout=5)
+            if content['stream'] == stream and content['payload']['type'] == typ:
+                return content
+
+    async def _test_multiplexed_streams(self):
+        room = str(self.room.id)
+        sockets = [self.communicator(user, '/ws/multiplex/token/') for user in self.users]
+        for socket in sockets:
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            self.assertEqual((await socket.receive_json_from())['payload']['message'], "connected")
+        sender, receiver, outsider = sockets
+        for socket in (sender, receiver):
+            for stream in ("chat", "typing", "presence"):
+                await socket.send_json_to({"stream": stream, "room": room, "action": "subscribe"})
+                self.assertDictEqual(await socket.receive_json_from(),
+                                     {"stream": stream, "room": room,
+                                      "payload": make_server_message("success", "subscribed")})
+                if stream == "chat":
+                    self.assertEqual((await socket.receive_json_from())['payload']['type'], "history_message")
+        await outsider.send_json_to({"stream": "chat", "room": room, "action": "subscribe"})
+        self.assertEqual((await outsider.receive_json_from())['payload']['message'], "You are not in this room")
+        await outsider.send_json_to({"stream": "chat", "room": room, "payload": {"type": "chat_message",
+                                                                                 "message": "Hi"}})
+        self.assertEqual((await outsider.receive_json_from())['payload']['message'], "Not subscribed to this stream")
+
+        await sender.send_json_to({"stream": "chat", "room": room, "payload": {"type": "chat_message",
+                                                                               "message": "Hello"}})
+        received = await self.receive_stream(receiver, "chat", "chat_message")
+        self.assertEqual((received['room'], received['payload']['sender'], received['payload']['message']),
+                         (room, self.users[0].email, "Hello"))
+        await sender.send_json_to({"stream": "typing", "room": room, "payload": {"type": "typing_message",
+                                                                                 "typing": "true"}})
+        received = await self.receive_stream(receiver, "typing", "typing_message")
+        self.assertDictEqual(received['payload'], {"type": "typing_message", "user": self.users[0].email,
+                                                   "typing": "true"})
+        await sender.send_json_to({"stream": "presence", "room": room, "payload": {"type": "online_message",
+                                                                                   "status": "online"}})
+        received = await self.receive_stream(receiver, "presence", "online_message")
+        self.assertEqual((received['payload']['user'], received['payload']['status']), (self.users[0].email, "online"))
+
+        await receiver.send_json_to({"stream": "chat", "room": room, "action": "unsubscribe"})
+        await self.receive_stream(receiver, "chat", "server")
+        await sender.send_json_to({"stream": "chat", "room": room, "payload": {"type": "chat_message",
+                                                                               "message": "Gone"}})
+        await self.receive_stream(sender, "chat", "chat_message")
+        while not await receiver.receive_nothing(timeout=0.3):
+            self.assertNotEqual((await receiver.receive_json_from())['stream'], "chat")
+        for socket in sockets:
+            await socket.disconnect()
+        await asyncio.sleep(0.3)
+        self.assertFalse(await database_sync_to_async(presence.get_online)(room, [self.users[0].id]))
+
+    def test_presence_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_presence_fanout', '--connections', '100', '--room-size', '10', '--changes', '2',
+                     stdout=out)
+        self.assertIn('global group: 2 changes delivered 200 frames', out.getvalue())
+        self.assertIn('per-room groups: 2 changes delivered 20 frames', out.getvalue())
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_chat_connections', '--sockets', '5', '--messages', '2', stdout=out)
+        self.assertIn('5 sockets connected', out.getvalue())
+        self.assertIn('2 messages delivered to every socket', out.getvalue())
+        self.assertFalse(EndUser.objects.filter(email__startswith='benchmark-').exists())
+
+    def test_multiplex_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_multiplex', '--users', '2', '--rooms', '2', stdout=out)
+        self.assertIn('per-room sockets: 10 sockets for 2 users', out.getvalue())
+        self.assertIn('multiplexed socket: 2 sockets for 2 users', out.getvalue())
+        self.assertFalse(EndUser.objects.filter(email__startswith='benchmark-').exists())
+
+    @override_settings(CHAT_RECEIPT_INTERVAL=0.3)
+    def test_read_acknowledgements_are_coalesced(self):
+        messages = [Message.objects.create(room=self.room, sender=self.users[0], message=str(i)) for i in range(5)]
+        async_to_sync(self._test_read_acknowledgements_are_coalesced)(messages)
+        membership = Membership.objects.get(room=self.room, end_user=self.users[1])
+        self.assertEqual((membership.last_delivered, membership.last_read), (messages[-1].id, messages[-1].id))
+
+    async def _test_read_acknowledgements_are_coalesced(self, messages):
+        path = '/ws/chat/token/%s/' % self.room.id
+        sender, reader = self.communicator(self.users[0], path), self.communicator(self.users[1], path)
+        for communicator in (sender, reader):
+            await communicator.connect()
+            await self.receive_type(communicator, "history_message")
+
+        for message in messages:
+            await reader.send_json_to({"type": "read_message", "id": message.id})
+        # Past the newest message, so ignored
+        await reader.send_json_to({"type": "read_message", "id": messages[-1].id + 100})
+        receipt = await self.receive_type(sender, "receipt_message")
+        self.assertDictEqual(receipt['statuses'], {str(message.id): Message.READ for message in messages})
+        self.assertTrue(await sender.receive_nothing(timeout=0.5))
+        await sender.disconnect()
+        await reader.disconnect()
+
+    def test_receipt_rooms_are_bounded(self):
+        broadcaster = ReceiptBroadcaster()
+        broadcaster.ROOMS = 2
+        rooms = [str(Room.objects.create().id) for _ in range(3)]
+        layer = get_channel_layer()
+        for room_id in rooms + rooms[1:2]:
+            async_to_sync(broadcaster._flush)(layer, room_id)
+        self.assertListEqual(list(broadcaster.sent), [rooms[2], rooms[1]])
+
+    def test_statuses_from_watermarks(self):
+        messages = [Message.objects.create(room=self.room, sender=self.users[i % 2], message=str(i)) for i in range(3)]
+        late = Membership.objects.create(end_user=self.users[2], room=self.room)
+        Membership.objects.filter(end_user=self.users[1]).update(last_delivered=messages[2].id,
+                                                                  last_read=messages[0].id)
+        Membership.objects.filter(end_user=self.users[0]).update(last_delivered=messages[1].id)
+
+        statuses = Message.get_statuses(self.room.id, [(m.id, m.sender_id, m.timestamp) for m in messages])
+        # users[2] joined after every message, so doesn't hold any of them back
+        self.assertListEqual([statuses[m.id] for m in messages], [Message.READ, Message.DELIVERED, Message.DELIVERED])
+
+        Message.objects.create(room=self.room, sender=self.users[0], message="after")
+        last = Message.objects.latest('id')
+        self.assertEqual(last.get_status(), Message.SENT)
+        Membership.objects.filter(id=late.id).update(attending=False)
+        Membership.objects.filter(end_user=self.users[1]).update(last_delivered=last.id)
+        self.assertEqual(last.get_status(), Message.DELIVERED)
+
+    def test_convert_receipts(self):
+        first = Message.objects.create(room=self.room, sender=self.users[0], message="first")
+        second = Message.objects.create(room=self.room, sender=self.users[0], message="second")
+        StatusMembership.objects.bulk_create([
+            StatusMembership(message=first, end_user=self.users[1], status=StatusMembership.READ),
+            StatusMembership(message=second, end_user=self.users[1], status=StatusMembership.DELIVERED),
+        ])
+
+        out = StringIO()
+        call_command('convert_message_receipts', '--delete', stdout=out)
+        self.assertIn('Updated the watermarks of 2 memberships, deleted 2 receipts', out.getvalue())
+        self.assertEqual(list(Membership.objects.filter(room=self.room).order_by('end_user_id')
+                              .values_list('last_delivered', 'last_read')),
+                         [(second.id, second.id), (second.id, first.id)])
+        self.assertEqual(first.get_status(), Message.READ)
+        self.assertEqual(second.get_status(), Message.DELIVERED)
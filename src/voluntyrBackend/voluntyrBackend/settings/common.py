@@ -94,6 +94,29 @@ SCOPE_TYPES = {
 }
 
 INVITE_LINK_LIFETIME = timedelta(days=1)
+CALENDAR_FEED_LIFETIME = timedelta(days=365)
+
+# Receivers run through api.dispatch after commit on a pool of MAX_WORKERS threads, or inline when SYNCHRONOUS is set.
+# Tests that assert on the receivers' effects turn SYNCHRONOUS on with override_settings.
+DEFERRED_DISPATCH = {
+    'MAX_WORKERS': 4,
+    'SYNCHRONOUS': False,
+}
+
+# Seconds chat receipts are collected for before each room is sent one frame with the statuses that changed
+CHAT_RECEIPT_INTERVAL = 0.5
+
+# Chat presence lives in the cache (chat.presence). Entries expire CHAT_PRESENCE_TTL seconds after the last heartbeat,
+# or two heartbeats after the last socket closes, and changes are written to Membership.online every
+# CHAT_PRESENCE_FLUSH_INTERVAL seconds, or never if it is None.
+CHAT_PRESENCE_TTL = 60
+CHAT_PRESENCE_HEARTBEAT = 20
+CHAT_PRESENCE_FLUSH_INTERVAL = 5
+
+# A typing indicator is repeated to the room at most every CHAT_TYPING_REPEAT_INTERVAL seconds and cleared
+# CHAT_TYPING_TIMEOUT seconds after the user's last typing frame
+CHAT_TYPING_REPEAT_INTERVAL = 3
+CHAT_TYPING_TIMEOUT = 6
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
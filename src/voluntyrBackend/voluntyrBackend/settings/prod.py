@@ -52,3 +52,16 @@ CHANNEL_LAYERS = {
         },
     },
 }
+
+# Shared by every worker, so chat presence, cached pages and calendar feed versions are the same on all of them and
+# invalidating a cache entry reaches every process
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL'),
+        'KEY_PREFIX': 'voluntyr',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+}